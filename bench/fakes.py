@@ -0,0 +1,209 @@
+# Поддельные Telegram Bot API и OpenAI для нагрузочных тестов: aiohttp-серверы
+# с настраиваемой задержкой. Крутятся в отдельном потоке со своим event loop,
+# чтобы не мерить их работу как задержку цикла бота.
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+import uuid
+
+from aiohttp import web
+
+SENTINEL = "∎"  # каждым ответом модели заканчивается — по нему видно, что ответ дошёл до пользователя
+
+
+class FakeOpenAI:
+    """
+    /v1/chat/completions: обычный и потоковый ответ. Задержка до первого токена
+    ttft ± jitter, дальше tokens_per_sec; usage — оценка входа len/4 и tokens на выход.
+    """
+
+    def __init__(self, ttft: float = 0.4, tokens_per_sec: float = 80, tokens: int = 150, jitter: float = 0.3):
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.jitter = jitter
+        self.requests = 0
+
+    def _delay(self) -> float:
+        return max(0.0, self.ttft * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def _words(self) -> list[str]:
+        words = ["Ответ", "по", "существу:"] + [f"пункт{i}" for i in range(self.tokens - 4)]
+        return [w + " " for w in words] + [SENTINEL]
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        raw = await request.read()
+        body = json.loads(raw)
+        self.requests += 1
+        prompt = len(raw) // 4
+        usage = {"prompt_tokens": prompt, "completion_tokens": self.tokens, "total_tokens": prompt + self.tokens}
+        words = self._words()
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": body["model"]}
+        await asyncio.sleep(self._delay())
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(words) / self.tokens_per_sec)
+            return web.json_response({**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(words)}}]})
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+
+        async def send(obj):
+            await resp.write(b"data: " + json.dumps({**base, "object": "chat.completion.chunk", **obj}).encode() + b"\n\n")
+
+        step = 5  # слов в чанке
+        for i in range(0, len(words), step):
+            await send({"choices": [{"index": 0, "finish_reason": None, "delta": {"content": "".join(words[i:i + step])}}]})
+            await asyncio.sleep(step / self.tokens_per_sec)
+        await send({"choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send({"choices": [], "usage": usage})
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.completions)
+        return app
+
+
+class FakeTelegram:
+    """
+    Bot API: отвечает на вызовы, которыми пользуется бот, и отдаёт файлы,
+    зарегистрированные через add_file(). Каждый исходящий текст передаётся в
+    on_text(chat_id, text, parse_mode), ответ на callback — в on_callback(query_id).
+    Для режима polling getUpdates раздаёт апдейты, добавленные через add_update().
+    """
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.files: dict[str, tuple[str, bytes]] = {}
+        self.calls: dict[str, int] = {}
+        self.first_call: dict[str, float] = {}  # метод -> perf_counter первого вызова
+        self.updates: list[dict] = []
+        self.on_text = lambda chat_id, text, parse_mode: None
+        self.on_callback = lambda query_id: None
+        self._msg_id = 0
+
+    def add_file(self, file_id: str, name: str, data: bytes):
+        self.files[file_id] = (name, data)
+
+    def add_update(self, update: dict):
+        self.updates.append(update)  # list.append атомарен — можно звать из другого потока
+
+    async def _get_updates(self, offset: int, timeout: float) -> list[dict]:
+        # long polling: ждём новый апдейт до timeout (но не дольше секунды, чтобы бот быстро останавливался)
+        deadline = time.monotonic() + min(timeout, 1.0)
+        while True:
+            fresh = [u for u in self.updates if u["update_id"] >= offset]
+            if fresh or time.monotonic() >= deadline:
+                return fresh
+            await asyncio.sleep(0.02)
+
+    def _message(self, chat_id: int, text: str) -> dict:
+        self._msg_id += 1
+        return {"message_id": self._msg_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"}}
+
+    async def method(self, request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.first_call.setdefault(name, time.perf_counter())
+        form = dict(await request.post()) if request.can_read_body else {}
+        await asyncio.sleep(self.latency)
+
+        if name in ("sendMessage", "editMessageText"):
+            chat_id, text = int(form.get("chat_id", 0)), form.get("text", "")
+            self.on_text(chat_id, text, form.get("parse_mode"))
+            result = self._message(chat_id, text)
+        elif name == "answerCallbackQuery":
+            self.on_callback(form.get("callback_query_id"))
+            result = True
+        elif name == "getFile":
+            file_id = form["file_id"]
+            if file_id not in self.files:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"})
+            fname, data = self.files[file_id]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data), "file_path": f"docs/{fname}"}
+        elif name == "getUpdates":
+            result = await self._get_updates(int(form.get("offset") or 0), float(form.get("timeout") or 0))
+        elif name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request: web.Request) -> web.Response:
+        name = request.match_info["path"].rsplit("/", 1)[-1]
+        for fname, data in self.files.values():
+            if fname == name:
+                return web.Response(body=data)
+        return web.Response(status=404)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file)
+        return app
+
+
+class FakeServers:
+    """
+    Поднимает оба сервера в фоновом потоке. start() возвращает (telegram_url, openai_url).
+    """
+
+    def __init__(self, telegram: FakeTelegram, openai: FakeOpenAI, host: str = "127.0.0.1"):
+        self.telegram = telegram
+        self.openai = openai
+        self.host = host
+        self.loop = asyncio.new_event_loop()
+        self._runners: list[web.AppRunner] = []
+        self._thread = threading.Thread(target=self.loop.run_forever, name="fakes", daemon=True)
+
+    async def _serve(self, app: web.Application) -> int:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, 0)
+        await site.start()
+        self._runners.append(runner)
+        return site._server.sockets[0].getsockname()[1]
+
+    def start(self) -> tuple[str, str]:
+        self._thread.start()
+        tg = asyncio.run_coroutine_threadsafe(self._serve(self.telegram.app()), self.loop).result()
+        oa = asyncio.run_coroutine_threadsafe(self._serve(self.openai.app()), self.loop).result()
+        return f"http://{self.host}:{tg}", f"http://{self.host}:{oa}/v1"
+
+    def stop(self):
+        async def cleanup():
+            for r in self._runners:
+                await r.cleanup()
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+def make_docx(paragraphs: list[str]) -> bytes:
+    import docx
+    d = docx.Document()
+    for p in paragraphs:
+        d.add_paragraph(p)
+    buf = io.BytesIO()
+    d.save(buf)
+    return buf.getvalue()
+
+
+def make_png(lines: list[str], size: tuple[int, int] = (1600, 1200)) -> bytes:
+    from PIL import Image, ImageDraw
+    im = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(im)
+    for i, line in enumerate(lines):
+        draw.text((40, 40 + i * 30), line, fill="black")
+    buf = io.BytesIO()
+    im.save(buf, "PNG")
+    return buf.getvalue()
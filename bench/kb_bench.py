@@ -0,0 +1,112 @@
+# Нагрузочная проверка поиска по базе знаний: синтетический корпус «регламентов»
+# индексируется во временную БД, затем гоняются запросы и считаются перцентили.
+#
+#   python -m bench.kb_bench --passages 30000 --queries 2000
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from bot.kb import KnowledgeBase, prepare_document
+from bot.storage import Storage
+
+WORDS = """
+абонент тариф роуминг баланс платёж договор оператор связь номер сим-карта перенос услуга
+подключение отключение заявка клиент офис паспорт доверенность блокировка разблокировка
+интернет трафик минуты пакет абонентская плата списание возврат компенсация претензия
+срок рабочий день сотрудник регламент порядок проверка документ подпись уведомление
+сообщение звонок переадресация голосовая почта корпоративный лицевой счёт детализация
+задолженность лимит кредит ограничение восстановление замена утеря кража eSIM модем
+роутер покрытие станция жалоба качество скорость тест настройка APN MMS SMS USSD
+""".split()
+
+QUERIES = [
+    "как перенести номер к другому оператору",
+    "возврат денег за ошибочный платёж",
+    "блокировка сим-карты при утере",
+    "сколько стоит роуминг за границей",
+    "какие документы нужны для замены сим-карты",
+    "детализация звонков по лицевому счёту",
+    "настройка APN для мобильного интернета",
+    "срок рассмотрения претензии клиента",
+    "переадресация на голосовую почту",
+    "лимит кредита корпоративного абонента",
+]
+
+SYLLABLES = "ба ве ги до жу за ки ло ми но па ре си ту фа хо це чи ша ны ра ль ст пр кр ов ен ия ость ние".split()
+
+
+def vocabulary(rnd: random.Random, size: int) -> tuple[list[str], list[float]]:
+    """
+    Словарь с ципфовским распределением частот, как в живом тексте: предметные
+    слова рассыпаны по рангам, остальное — псевдослова из слогов.
+    """
+    words = set()
+    while len(words) < size - len(WORDS):
+        words.add("".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))))
+    vocab = list(words)
+    for w in WORDS:
+        vocab.insert(rnd.randrange(20, len(vocab)), w)
+    return vocab, [1 / (r + 1) for r in range(len(vocab))]
+
+
+def synth_text(rnd: random.Random, vocab, weights, n_passages: int, passage_chars: int) -> str:
+    paras = []
+    for _ in range(n_passages):
+        words = rnd.choices(vocab, weights, k=passage_chars // 12)
+        paras.append(" ".join(words).capitalize() + ".")
+    return "\n\n".join(paras)
+
+
+def pct(values: list[float], p: float) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+async def main(args):
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = Storage(os.path.join(tmp, "kb.sqlite3"))
+        await storage.open()
+        kb = KnowledgeBase(storage, args.passage_chars)
+
+        vocab, weights = vocabulary(rnd, args.vocab)
+        t0 = time.perf_counter()
+        per_doc = max(1, args.passages // args.docs)
+        total = 0
+        for i in range(args.docs):
+            items = prepare_document(synth_text(rnd, vocab, weights, per_doc, args.passage_chars), args.passage_chars)
+            await kb.add(f"Регламент {i + 1}", f"{i:064x}", 0, items)
+            total += len(items)
+        print(f"indexed {total} passages in {args.docs} docs: {time.perf_counter() - t0:.1f} s")
+
+        await kb.search(QUERIES[0], args.k)  # прогрев страничного кэша
+        lat = []
+        for i in range(args.queries):
+            q = QUERIES[i % len(QUERIES)]
+            t = time.perf_counter()
+            found = await kb.search(q, args.k)
+            lat.append((time.perf_counter() - t) * 1000)
+            assert found, q
+        await storage.close()
+
+    p50, p95, p99 = pct(lat, 50), pct(lat, 95), pct(lat, 99)
+    print(f"queries={args.queries} k={args.k}  p50={p50:.2f} ms  p95={p95:.2f} ms  p99={p99:.2f} ms")
+    ok = p95 < args.target_ms
+    print(("OK" if ok else "FAIL") + f": p95 {'<' if ok else '>='} {args.target_ms} ms")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--passages", type=int, default=30000)
+    ap.add_argument("--docs", type=int, default=60)
+    ap.add_argument("--vocab", type=int, default=20000)
+    ap.add_argument("--passage-chars", type=int, default=1200)
+    ap.add_argument("--queries", type=int, default=2000)
+    ap.add_argument("-k", type=int, default=4)
+    ap.add_argument("--target-ms", type=float, default=50.0)
+    ap.add_argument("--seed", type=int, default=1)
+    raise SystemExit(asyncio.run(main(ap.parse_args())))
@@ -0,0 +1,333 @@
+# Нагрузочный тест настоящих хендлеров dp против поддельных Telegram и OpenAI.
+# Симулируемые пользователи шлют апдейты (как вебхук: dp.feed_raw_update) и ждут
+# ответа, между запросами — пауза «на подумать». По каждому сценарию:
+# пропускная способность, p50/p95/p99 от апдейта до ответа, задержка event loop,
+# время потока БД. Результат — JSON, чтобы сравнивать между коммитами.
+#
+#   python -m bench.load_test --users 50 --requests 10 --out bench-$(git rev-parse --short HEAD).json
+#   python -m bench.load_test --scenarios chat --compare bench-old.json
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+from .fakes import SENTINEL, FakeOpenAI, FakeServers, FakeTelegram, make_docx, make_png
+
+SCENARIOS = ("chat", "document", "photo", "album", "list_chats", "mixed")
+USER_BASE = 100_000
+
+QUESTIONS = [
+    "Как перенести номер к другому оператору?",
+    "Какие документы нужны для замены сим-карты?",
+    "Сколько стоит роуминг в Турции?",
+    "Почему списали абонентскую плату дважды?",
+    "Как подключить eSIM на iPhone?",
+]
+
+
+def pct(values: list[float], p: int) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def summary(values: list[float]) -> dict:
+    return {"p50": round(pct(values, 50), 2), "p95": round(pct(values, 95), 2),
+            "p99": round(pct(values, 99), 2), "max": round(max(values, default=0.0), 2)}
+
+
+class LoopLag:
+    """
+    Насколько позже запланированного просыпается задача, спящая interval секунд.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append((loop.time() - t - self.interval) * 1000)
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> list[float]:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        return self.samples
+
+
+class Harness:
+    def __init__(self, app, telegram: FakeTelegram, args):
+        self.app = app
+        self.telegram = telegram
+        self.args = args
+        self.loop = asyncio.get_running_loop()
+        self.waiters: dict[object, asyncio.Future] = {}
+        self.update_ids = itertools.count(1)
+        self.msg_ids = itertools.count(1)
+        self.docs: list[str] = []
+        self.photos: list[str] = []
+        telegram.on_text = self._on_text
+        telegram.on_callback = self._on_callback
+
+    # ===== ответы бота (вызываются из потока поддельных серверов) =====
+
+    def _resolve(self, key, outcome: str):
+        def done():
+            fut = self.waiters.get(key)
+            if fut is not None and not fut.done():
+                fut.set_result(outcome)
+        self.loop.call_soon_threadsafe(done)
+
+    def _on_text(self, chat_id: int, text: str, parse_mode: str | None):
+        if text.startswith("❌"):
+            self._resolve(chat_id, "error")
+        elif text.startswith("⏳ Я"):
+            self._resolve(chat_id, "busy")
+        elif SENTINEL in text and parse_mode:
+            # финальная правка потокового ответа и обычный reply идут в Markdown
+            self._resolve(chat_id, "ok")
+
+    def _on_callback(self, query_id: str):
+        self._resolve(query_id, "ok")
+
+    # ===== апдейты =====
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "language_code": "ru"}
+
+    def _message(self, uid: int, **fields) -> dict:
+        msg = {"message_id": next(self.msg_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self._user(uid), **fields}
+        return {"update_id": next(self.update_ids), "message": msg}
+
+    def _photo(self, file_id: str) -> list[dict]:
+        size = len(self.telegram.files[file_id][1])
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1600, "height": 1200, "file_size": size}]
+
+    def build(self, kind: str, uid: int, n: int) -> tuple[list[dict], object]:
+        """
+        (апдейты, ключ ожидания ответа) для одного запроса пользователя.
+        """
+        if kind == "album":
+            # альбом — несколько апдейтов с общим media_group_id, ответ один
+            group = f"album-{uid}-{n}"
+            files = random.sample(self.photos, min(len(self.photos), random.randint(3, 6)))
+            return [self._message(uid, photo=self._photo(f), media_group_id=group) for f in files], uid
+        update, key = self._single(kind, uid, n)
+        return [update], key
+
+    def _single(self, kind: str, uid: int, n: int) -> tuple[dict, object]:
+        if kind == "chat":
+            return self._message(uid, text=f"{random.choice(QUESTIONS)} (#{n})"), uid
+        if kind == "document":
+            file_id = random.choice(self.docs)
+            doc = {"file_id": file_id, "file_unique_id": file_id, "file_name": f"{file_id}.docx",
+                   "mime_type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                   "file_size": len(self.telegram.files[file_id][1])}
+            return self._message(uid, document=doc, caption="Кратко перескажи"), uid
+        if kind == "photo":
+            return self._message(uid, photo=self._photo(random.choice(self.photos))), uid
+        if kind == "list_chats":
+            query_id = f"cb-{uid}-{n}"
+            msg = {"message_id": next(self.msg_ids), "date": int(time.time()),
+                   "chat": {"id": uid, "type": "private"}, "text": "меню"}
+            cq = {"id": query_id, "from": self._user(uid), "chat_instance": str(uid), "message": msg, "data": "list_chats"}
+            return {"update_id": next(self.update_ids), "callback_query": cq}, query_id
+        raise ValueError(kind)
+
+    def prepare_files(self):
+        rnd = random.Random(self.args.seed)
+        for i in range(self.args.files):
+            words = [f"Пункт {k}. " + " ".join(random.choice(QUESTIONS) for _ in range(3)) for k in range(40)]
+            self.docs.append(f"doc{i}")
+            self.telegram.add_file(f"doc{i}", f"doc{i}.docx", make_docx([f"Регламент {i}", *words]))
+            self.photos.append(f"photo{i}")
+            lines = [f"Заявление {i}"] + [rnd.choice(QUESTIONS) for _ in range(20)]
+            self.telegram.add_file(f"photo{i}", f"photo{i}.png", make_png(lines))
+
+    # ===== прогон =====
+
+    async def request(self, kind: str, uid: int, n: int) -> tuple[str, float]:
+        updates, key = self.build(kind, uid, n)
+        fut = self.loop.create_future()
+        self.waiters[key] = fut
+        t0 = time.perf_counter()
+        # как вебхук: апдейты обрабатываются в фоне, ответ бота ловим на поддельном Telegram
+        feed = asyncio.gather(*(asyncio.create_task(self.app.dp.feed_raw_update(self.app.bot, u)) for u in updates))
+        try:
+            outcome = await asyncio.wait_for(fut, self.args.timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        finally:
+            self.waiters.pop(key, None)
+        await feed
+        return outcome, (time.perf_counter() - t0) * 1000
+
+    async def user(self, scenario: str, uid: int, results: list):
+        kinds = ("chat", "chat", "chat", "list_chats", "document", "photo")
+        await asyncio.sleep(random.uniform(0, self.args.think))  # пользователи приходят не разом
+        for n in range(self.args.requests):
+            kind = random.choice(kinds) if scenario == "mixed" else scenario
+            outcome, ms = await self.request(kind, uid, n)
+            results.append((kind, outcome, ms))
+            await asyncio.sleep(random.expovariate(1 / self.args.think) if self.args.think else 0)
+
+    async def scenario(self, name: str) -> dict:
+        storage = self.app.storage
+        calls0, busy0 = storage.calls, storage.busy
+        lag = LoopLag()
+        lag.start()
+        results: list[tuple[str, str, float]] = []
+        t0 = time.perf_counter()
+        await asyncio.gather(*(self.user(name, USER_BASE + i, results) for i in range(self.args.users)))
+        elapsed = time.perf_counter() - t0
+        lag_ms = await lag.stop()
+
+        ok = [ms for _, outcome, ms in results if outcome == "ok"]
+        outcomes = {}
+        for _, outcome, _ in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        calls, busy = storage.calls - calls0, storage.busy - busy0
+        return {
+            "requests": len(results),
+            "outcomes": outcomes,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_rps": round(len(ok) / elapsed, 2),
+            "latency_ms": summary(ok),
+            "loop_lag_ms": summary(lag_ms),
+            "db": {
+                "transactions": calls,
+                "busy_ms": round(busy * 1000, 1),
+                "per_request_ms": round(busy * 1000 / max(1, len(results)), 3),
+                "utilization": round(busy / elapsed, 4),
+            },
+        }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, path: str):
+    with open(path, encoding="utf-8") as f:
+        old = json.load(f)
+    print(f"\nvs {path} ({old.get('commit')}):")
+    for name, cur in current["scenarios"].items():
+        prev = old.get("scenarios", {}).get(name)
+        if not prev:
+            continue
+        parts = []
+        for label, a, b in (("rps", prev["throughput_rps"], cur["throughput_rps"]),
+                            ("p95", prev["latency_ms"]["p95"], cur["latency_ms"]["p95"]),
+                            ("p99", prev["latency_ms"]["p99"], cur["latency_ms"]["p99"]),
+                            ("lag p99", prev["loop_lag_ms"]["p99"], cur["loop_lag_ms"]["p99"])):
+            change = f"{(b - a) / a:+.0%}" if a else "n/a"
+            parts.append(f"{label} {a}→{b} ({change})")
+        print(f"  {name:<11} " + ", ".join(parts))
+
+
+async def main(args):
+    telegram = FakeTelegram(latency=args.tg_latency)
+    openai = FakeOpenAI(ttft=args.ttft, tokens_per_sec=args.tps, tokens=args.tokens)
+    fakes = FakeServers(telegram, openai)
+    tg_url, oa_url = fakes.start()
+
+    tmp = tempfile.TemporaryDirectory()
+    env = {
+        "TELEGRAM_BOT_TOKEN": "1:bench",
+        "TELEGRAM_API_URL": tg_url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": oa_url,
+        "BOT_DB_PATH": os.path.join(tmp.name, "bot.sqlite"),
+        "FILES_DIR": os.path.join(tmp.name, "files"),
+        "ALLOWED_TG_IDS": "",
+        "USER_DAILY_TOKENS": str(10**9),
+        "OCR_ENGINE": "openai",
+        # словаря tiktoken может не быть на машине с бенчем — для фейков хватит оценки
+        "TOKEN_ESTIMATE_FALLBACK": "1",
+    }
+    for kv in args.env:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    os.environ.update(env)
+
+    # бот читает ENV при импорте — импортируем после подмены
+    from bot import bot as app
+
+    h = Harness(app, telegram, args)
+    h.prepare_files()
+    await app.startup()
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "scenarios": {},
+    }
+    try:
+        for name in args.scenarios:
+            res = await h.scenario(name)
+            report["scenarios"][name] = res
+            lat, lag = res["latency_ms"], res["loop_lag_ms"]
+            print(f"{name:<11} {res['requests']:5d} req  {res['throughput_rps']:7.2f} rps  "
+                  f"p50={lat['p50']:.0f} p95={lat['p95']:.0f} p99={lat['p99']:.0f} ms  "
+                  f"lag p99={lag['p99']:.1f} ms  db={res['db']['busy_ms']:.0f} ms  {res['outcomes']}")
+    finally:
+        await app.shutdown()
+        fakes.stop()
+        tmp.cleanup()
+    report["fake_calls"] = {"telegram": telegram.calls, "openai": openai.requests}
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"saved {args.out}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenarios", type=lambda s: s.split(","), default=list(SCENARIOS),
+                    help="через запятую: " + ",".join(SCENARIOS))
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--requests", type=int, default=5, help="запросов на пользователя в сценарии")
+    ap.add_argument("--think", type=float, default=1.0, help="средняя пауза между запросами пользователя, сек")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--files", type=int, default=10, help="разных документов/фото в пуле")
+    ap.add_argument("--ttft", type=float, default=0.4, help="задержка OpenAI до первого токена, сек")
+    ap.add_argument("--tps", type=float, default=80.0, help="токенов в секунду у поддельной модели")
+    ap.add_argument("--tokens", type=int, default=150, help="токенов в ответе")
+    ap.add_argument("--tg-latency", type=float, default=0.02, help="задержка поддельного Bot API, сек")
+    ap.add_argument("--env", action="append", default=[], help="KEY=VALUE для бота, можно несколько раз")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="куда сохранить JSON")
+    ap.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main(args))
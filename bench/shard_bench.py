@@ -0,0 +1,204 @@
+# Масштабирование многопроцессного режима целиком: настоящий фронт (python -m bot.shard)
+# с N воркерами bot.bot против поддельных Telegram и OpenAI. Пользователи шлют
+# сообщения POST-ом на вебхук фронта, как Telegram, и ждут ответа на поддельном
+# Telegram — меряется весь путь фронт → воркер → хендлер → ответ.
+# Поддельные серверы и фронт тоже едят CPU: прирост от воркеров виден, только
+# если ядер заметно больше N.
+#
+#   python -m bench.shard_bench --workers 1,2,4 --users 40 --turns 10
+import argparse
+import asyncio
+import itertools
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from .fakes import SENTINEL, FakeOpenAI, FakeServers, FakeTelegram
+
+USER_BASE = 200_000
+QUESTIONS = [
+    "Как перенести номер к другому оператору?",
+    "Какие документы нужны для замены сим-карты?",
+    "Сколько стоит роуминг в Турции?",
+    "Как отключить платные подписки?",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Front:
+    """
+    python -m bot.shard с n воркерами в своём каталоге: шарды БД, файлы, лог.
+    """
+
+    def __init__(self, n: int, tg_url: str, oa_url: str, tmp: str, extra: list[str]):
+        self.port = free_port()
+        self.log = os.path.join(tmp, "front.log")
+        self.env = dict(
+            os.environ,
+            SHARD_WORKERS=str(n),
+            SHARD_BASE_PORT=str(free_port()),  # воркеры слушают BASE..BASE+n-1
+            WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(self.port),
+            WEBHOOK_URL="",
+            WEBHOOK_SECRET="",
+            TELEGRAM_BOT_TOKEN="1:bench",
+            TELEGRAM_API_URL=tg_url,
+            OPENAI_API_KEY="bench",
+            OPENAI_BASE_URL=oa_url,
+            BOT_DB_PATH=os.path.join(tmp, "bot.sqlite"),
+            KB_DB_PATH=os.path.join(tmp, "kb.sqlite"),
+            FILES_DIR=os.path.join(tmp, "files"),
+            ARCHIVE_DIR=os.path.join(tmp, "archive"),
+            ALLOWED_TG_IDS="",
+            USER_DAILY_TOKENS=str(10**9),
+            METRICS_PORT="0",
+            TOKEN_ESTIMATE_FALLBACK="1",
+        )
+        for kv in extra:
+            k, _, v = kv.partition("=")
+            self.env[k] = v
+        self.proc: subprocess.Popen | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        with open(self.log, "ab") as log:
+            self.proc = subprocess.Popen([sys.executable, "-m", "bot.shard"], env=self.env,
+                                         stdout=log, stderr=subprocess.STDOUT)
+
+    async def ready(self, session: aiohttp.ClientSession, timeout: float) -> dict:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"front exited with {self.proc.returncode}, see {self.log}")
+            try:
+                async with session.get(self.url + "/healthz") as r:
+                    if r.status == 200 and (health := await r.json())["ok"]:
+                        return health
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"front not ready in {timeout:.0f}s, see {self.log}")
+
+    async def health(self, session: aiohttp.ClientSession) -> dict:
+        async with session.get(self.url + "/healthz") as r:
+            return await r.json()
+
+    def stop(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(60)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+async def drive(front: Front, telegram: FakeTelegram, args) -> dict:
+    """
+    users пользователей, у каждого turns сообщений подряд: следующее — после ответа на предыдущее.
+    """
+    loop = asyncio.get_running_loop()
+    waiters: dict[int, asyncio.Future] = {}
+    update_ids = itertools.count(1)
+
+    def resolve(chat_id: int, outcome: str):
+        fut = waiters.get(chat_id)
+        if fut is not None and not fut.done():
+            fut.set_result(outcome)
+
+    def on_text(chat_id: int, text: str, parse_mode: str | None):
+        if text.startswith("❌"):
+            loop.call_soon_threadsafe(resolve, chat_id, "error")
+        elif text.startswith("⏳ Я"):
+            loop.call_soon_threadsafe(resolve, chat_id, "busy")
+        elif SENTINEL in text and parse_mode:
+            loop.call_soon_threadsafe(resolve, chat_id, "ok")
+
+    telegram.on_text = on_text
+    outcomes: dict[str, int] = {}
+    latencies: list[float] = []
+
+    async def user(session: aiohttp.ClientSession, uid: int):
+        for i in range(args.turns):
+            msg = {"message_id": i + 1, "date": int(time.time()), "text": f"{QUESTIONS[i % len(QUESTIONS)]} (#{i})",
+                   "chat": {"id": uid, "type": "private"},
+                   "from": {"id": uid, "is_bot": False, "first_name": f"U{uid}", "language_code": "ru"}}
+            fut = waiters[uid] = loop.create_future()
+            t0 = time.perf_counter()
+            async with session.post(front.url + "/webhook", json={"update_id": next(update_ids), "message": msg}) as r:
+                accepted = r.status == 200
+            try:
+                outcome = await asyncio.wait_for(fut, args.timeout) if accepted else f"http {r.status}"
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome == "ok":
+                latencies.append((time.perf_counter() - t0) * 1000)
+
+    async with aiohttp.ClientSession() as session:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user(session, USER_BASE + u) for u in range(args.users)))
+        elapsed = time.perf_counter() - t0
+        health = await front.health(session)
+    q = statistics.quantiles(latencies, n=100) if len(latencies) >= 2 else [0.0] * 99
+    return {"rate": outcomes.get("ok", 0) / elapsed, "p50": q[49], "p95": q[94], "outcomes": outcomes,
+            "per_worker": [w["forwarded"] for w in health["workers"]]}
+
+
+async def run(n: int, tg_url: str, oa_url: str, telegram: FakeTelegram, args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        front = Front(n, tg_url, oa_url, tmp, args.env)
+        front.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                await front.ready(session, args.start_timeout)
+            return await drive(front, telegram, args)
+        finally:
+            await asyncio.to_thread(front.stop)
+
+
+def main(args):
+    telegram = FakeTelegram(latency=args.tg_latency)
+    fakes = FakeServers(telegram, FakeOpenAI(ttft=args.ttft, tokens_per_sec=args.tps, tokens=args.tokens, jitter=0))
+    tg_url, oa_url = fakes.start()
+    base = None
+    try:
+        for n in args.workers:
+            r = asyncio.run(run(n, tg_url, oa_url, telegram, args))
+            base = base or r["rate"] or 1.0
+            print(f"workers={n}  {r['rate']:7.1f} turns/s  x{r['rate'] / base:.2f}  "
+                  f"p50={r['p50']:.0f} p95={r['p95']:.0f} ms  {r['outcomes']}  per worker {r['per_worker']}")
+    finally:
+        fakes.stop()
+    print(f"cpu_count={os.cpu_count()}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=lambda s: [int(x) for x in s.split(",")], default=[1, 2, 4])
+    ap.add_argument("--users", type=int, default=40)
+    ap.add_argument("--turns", type=int, default=10, help="сообщений на пользователя")
+    ap.add_argument("--ttft", type=float, default=0.05, help="задержка поддельной модели до первого токена")
+    ap.add_argument("--tokens", type=int, default=60, help="длина ответа поддельной модели")
+    ap.add_argument("--tps", type=float, default=2000, help="скорость поддельной модели, токенов/с")
+    ap.add_argument("--tg-latency", type=float, default=0.005)
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--start-timeout", type=float, default=90.0)
+    ap.add_argument("--env", action="append", default=[], help="KEY=VALUE для фронта и воркеров")
+    main(ap.parse_args())
@@ -0,0 +1,131 @@
+# Холодный старт: запускаем `python -m bot.bot` в режиме polling против поддельного
+# Bot API, в очереди ждёт один /start. Меряем от запуска процесса до первого
+# getUpdates (бот готов принимать апдейты) и до ответа на /start (первый апдейт
+# обработан). --importtime дополнительно показывает самые дорогие импорты,
+# как `python -X importtime`.
+#
+#   python -m bench.startup_bench --runs 5 --importtime
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .fakes import FakeOpenAI, FakeServers, FakeTelegram
+
+USER = 1
+
+
+def start_update(update_id: int) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        "chat": {"id": USER, "type": "private"}, "from": {"id": USER, "is_bot": False, "first_name": "Bench"}}}
+
+
+def env_for(tg_url: str, oa_url: str, tmp: str, extra: list[str]) -> dict:
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN="1:bench",
+        TELEGRAM_API_URL=tg_url,
+        OPENAI_API_KEY="bench",
+        OPENAI_BASE_URL=oa_url,
+        BOT_MODE="polling",
+        BOT_DB_PATH=os.path.join(tmp, "bot.sqlite"),
+        FILES_DIR=os.path.join(tmp, "files"),
+        ARCHIVE_DIR=os.path.join(tmp, "archive"),
+        ALLOWED_TG_IDS="",
+        METRICS_PORT="0",
+        TOKEN_ESTIMATE_FALLBACK="1",
+    )
+    for kv in extra:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    return env
+
+
+def stop(proc: subprocess.Popen):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run_once(telegram: FakeTelegram, env: dict, update_id: int, timeout: float) -> tuple[float, float]:
+    replied = threading.Event()
+    at = {}
+
+    def on_text(chat_id, text, parse_mode):
+        if chat_id == USER and not replied.is_set():
+            at["reply"] = time.perf_counter()
+            replied.set()
+
+    telegram.on_text = on_text
+    telegram.first_call.clear()
+    telegram.updates[:] = [start_update(update_id)]
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "bot.bot"], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not replied.wait(timeout):
+            raise RuntimeError("no reply to /start within timeout")
+    finally:
+        stop(proc)
+    return telegram.first_call["getUpdates"] - t0, at["reply"] - t0
+
+
+def import_profile(env: dict, top: int):
+    """
+    Самые дорогие модули по собственному времени импорта bot.bot.
+    """
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot.bot"], env=env,
+                         capture_output=True, text=True).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|")
+        rows.append((int(self_us), int(cum_us), name.strip()))
+    total = next((cum for _, cum, name in rows if name == "bot.bot"), 0)
+    print(f"\nimport bot.bot: {total / 1000:.0f} ms; top {top} by self time:")
+    for self_us, cum_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {self_us / 1000:8.1f} ms  (cum {cum_us / 1000:8.1f})  {name}")
+
+
+def main(args):
+    telegram = FakeTelegram(latency=0)
+    fakes = FakeServers(telegram, FakeOpenAI())
+    tg_url, oa_url = fakes.start()
+    ready, first = [], []
+    try:
+        for i in range(args.runs):
+            # каждый запуск — с чистой базой: первый старт ещё и применяет миграции
+            with tempfile.TemporaryDirectory() as tmp:
+                env = env_for(tg_url, oa_url, tmp, args.env)
+                r, f = run_once(telegram, env, i + 1, args.timeout)
+                ready.append(r)
+                first.append(f)
+                print(f"run {i + 1}: ready {r * 1000:7.0f} ms  first update {f * 1000:7.0f} ms")
+        print(f"median: ready {statistics.median(ready) * 1000:.0f} ms, "
+              f"first update {statistics.median(first) * 1000:.0f} ms")
+        if args.importtime:
+            with tempfile.TemporaryDirectory() as tmp:
+                import_profile(env_for(tg_url, oa_url, tmp, args.env), args.top)
+    finally:
+        fakes.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--importtime", action="store_true", help="показать самые дорогие импорты")
+    ap.add_argument("--top", type=int, default=15)
+    ap.add_argument("--env", action="append", default=[], help="KEY=VALUE для бота, можно несколько раз")
+    main(ap.parse_args())
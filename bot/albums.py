@@ -0,0 +1,74 @@
+# Альбомы: Telegram присылает каждое фото из альбома отдельным апдейтом с общим
+# media_group_id. Собираем их за короткое окно и обрабатываем одним вызовом.
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+log = logging.getLogger(__name__)
+
+
+class AlbumCollector:
+    """
+    add(group_id, item, order) копит части альбома. Когда window секунд не было
+    новых частей (но не позже max_wait от первой) или набралось max_items,
+    альбом уходит в handler(items) одним вызовом, части — по возрастанию order.
+    """
+
+    def __init__(self, handler: Callable[[list[Any]], Awaitable[None]], window: float = 1.0,
+                 max_wait: float = 5.0, max_items: int = 10):
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self._groups: dict[str, list[tuple[int, Any]]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._deadline: dict[str, float] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.albums = 0
+        self.items = 0
+
+    def add(self, group_id: str, item: Any, order: int):
+        loop = asyncio.get_running_loop()
+        parts = self._groups.setdefault(group_id, [])
+        parts.append((order, item))
+        self.items += 1
+        if group_id not in self._deadline:
+            self._deadline[group_id] = loop.time() + self.max_wait
+        timer = self._timers.pop(group_id, None)
+        if timer:
+            timer.cancel()
+        if len(parts) >= self.max_items:
+            self._flush(group_id)
+            return
+        delay = min(self.window, max(0.0, self._deadline[group_id] - loop.time()))
+        self._timers[group_id] = loop.call_later(delay, self._flush, group_id)
+
+    def _flush(self, group_id: str):
+        self._timers.pop(group_id, None)
+        self._deadline.pop(group_id, None)
+        parts = self._groups.pop(group_id, None)
+        if not parts:
+            return
+        self.albums += 1
+        items = [item for _, item in sorted(parts, key=lambda p: p[0])]
+        task = asyncio.create_task(self._run(group_id, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, group_id: str, items: list):
+        try:
+            await self.handler(items)
+        except Exception:
+            log.exception("album %s failed", group_id)
+
+    async def stop(self, timeout: float = 0):
+        """
+        Отдаёт недособранные альбомы в обработку и ждёт до timeout секунд.
+        """
+        for group_id in list(self._groups):
+            timer = self._timers.get(group_id)
+            if timer:
+                timer.cancel()
+            self._flush(group_id)
+        if self._tasks and timeout > 0:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
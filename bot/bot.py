@@ -1,129 +1,119 @@
 # стандартная библиотека
 import asyncio
+import logging
 import os
-import sqlite3
 import time
-import re
 
 # сторонние библиотеки
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from openai import OpenAI
 
-def format_answer(text: str) -> str:
-    lines = text.splitlines()
-    in_code = False
-    out = []
-
-    header_re = re.compile(r"^(#{1,6})\s+(.+)$")  # # .. ## .. ###### ..
-
-    for line in lines:
-        stripped = line.strip()
-        # переключаемся, если встретили границу кода ``` (любой язык)
-        if stripped.startswith("```"):
-            in_code = not in_code
-            out.append(line)
-            continue
-
-        if not in_code:
-            m = header_re.match(line)
-            if m:
-                # берём текст заголовка и делаем жирным
-                title = m.group(2).strip()
-                out.append(f"**{title}**")
-                continue
-
-        out.append(line)
-
-    return "\n".join(out)
+from . import metrics
+from .context import ContextBuilder, Tokenizer
+from .formatting import AnswerFormatter, format_answer
+from .kb import KnowledgeBase, prepare_document
+from .llm import LLM
+from .quota import QuotaLedger, Reservation
+from .retention import Retention
+from .scheduler import Scheduler
+from .storage import Storage
+from .streaming import ProgressMessage, StreamingReply
+from .webhook import WebhookServer
 
 # ===== ENV =====
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 MODEL = os.getenv("OPENAI_MODEL_CHAT", "gpt-4o")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None             # совместимый endpoint (прокси, нагрузочные тесты)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")               # свой Bot API сервер; пусто — api.telegram.org
 DB_PATH = os.getenv("BOT_DB_PATH", "/data/bot.sqlite")
+KB_DB_PATH = os.getenv("KB_DB_PATH", DB_PATH)  # база знаний общая для всех шардов, см. shard.py
+BOT_SHARD = os.getenv("BOT_SHARD", "")         # "i/N" у воркера многопроцессного режима
 DAILY_LIMIT = int(os.getenv("USER_DAILY_TOKENS", "100000"))
 ALLOWED = {x.strip() for x in os.getenv("ALLOWED_TG_IDS", "").split(",") if x.strip()}
+ADMINS = {x.strip() for x in os.getenv("ADMIN_TG_IDS", "").split(",") if x.strip()}
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))  # запросов к OpenAI одновременно на процесс
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "90"))              # секунд на один вызов
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))          # повторов на 429/5xx/сетевых ошибках
+CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", "12000"))                # бюджет истории на один запрос
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "800"))  # длина конспекта старой части диалога
+TOKEN_ESTIMATE_FALLBACK = os.getenv("TOKEN_ESTIMATE_FALLBACK", "0") == "1"  # без словаря tiktoken считать len/4, а не падать
+QUOTA_ANSWER_RESERVE = int(os.getenv("QUOTA_ANSWER_RESERVE", "1000"))  # резерв токенов под ответ модели
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5"))    # как часто сбрасывать расход в БД, сек
+CHATS_PAGE_SIZE = int(os.getenv("CHATS_PAGE_SIZE", "10"))  # диалогов на странице "Мои диалоги"
+KB_TOP_K = int(os.getenv("KB_TOP_K", "4"))                        # фрагментов базы знаний в промпт
+KB_PASSAGE_CHARS = int(os.getenv("KB_PASSAGE_CHARS", "1200"))      # размер фрагмента при индексации
+SCHED_WINDOW = float(os.getenv("SCHED_WINDOW", "1.0"))          # сообщения за столько секунд склеиваются в один ход
+SCHED_CONCURRENCY = int(os.getenv("SCHED_CONCURRENCY", str(OPENAI_MAX_CONCURRENCY)))  # ходов диалога одновременно
+SCHED_USER_QUEUE = int(os.getenv("SCHED_USER_QUEUE", "5"))       # ждущих сообщений на пользователя
+SCHED_MAX_QUEUE = int(os.getenv("SCHED_MAX_QUEUE", "500"))       # ждущих сообщений всего
+BOT_MODE = os.getenv("BOT_MODE", "polling")                        # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                         # публичный https-адрес; пусто — не регистрировать
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                   # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_RECORD = os.getenv("WEBHOOK_RECORD", "")                   # дописывать апдейты в JSONL для replay
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")                    # архивы диалогов, <user_id>.jsonl.gz
+RETENTION_IDLE_DAYS = int(os.getenv("RETENTION_IDLE_DAYS", "60"))   # не открывавшиеся дольше диалоги — в архив; 0 — никогда
+RETENTION_QUOTA_DAYS = int(os.getenv("RETENTION_QUOTA_DAYS", "90")) # хранить суточные квоты столько дней; 0 — всегда
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600")) # период обслуживания базы, сек
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "200"))          # диалогов в архив за один проход
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))  # страниц incremental vacuum за проход
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))                  # /metrics для Prometheus; 0 — выключено
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") == "1"               # выдавать ответ по мере генерации
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # не чаще одной правки сообщения в N секунд
+WARMUP_DELAY = float(os.getenv("WARMUP_DELAY", "2"))  # через столько секунд после старта прогреть OCR/токенизатор; <0 — по первому запросу
 
 # ===== INIT =====
-client = OpenAI(api_key=OPENAI_API_KEY)
-bot = Bot(token=TELEGRAM_BOT_TOKEN, default=DefaultBotProperties(parse_mode="Markdown"))
+log = logging.getLogger(__name__)
+llm = LLM(
+    api_key=OPENAI_API_KEY,
+    model=MODEL,
+    max_concurrency=OPENAI_MAX_CONCURRENCY,
+    timeout=OPENAI_TIMEOUT,
+    max_retries=OPENAI_MAX_RETRIES,
+    base_url=OPENAI_BASE_URL,
+)
+bot: Bot | None = None  # создаётся в startup()
 dp = Dispatcher()
-
-# ===== DB =====
-def db():
-    c = sqlite3.connect(DB_PATH)
-    c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-        user_id INTEGER, chat_id INTEGER, updated_at INTEGER,
-        PRIMARY KEY(user_id, chat_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS messages(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER, chat_id INTEGER, role TEXT, content TEXT, created_at INTEGER
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS active_chat(
-        user_id INTEGER PRIMARY KEY, chat_id INTEGER
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS quotas(
-        user_id INTEGER, yyyymmdd TEXT, used_tokens INTEGER DEFAULT 0,
-        PRIMARY KEY(user_id, yyyymmdd)
-    )""")
-    return c
+storage = Storage(DB_PATH)
+kb_storage = storage if KB_DB_PATH == DB_PATH else Storage(KB_DB_PATH)
+kb = KnowledgeBase(kb_storage, KB_PASSAGE_CHARS)
+quota = QuotaLedger(storage, DAILY_LIMIT, flush_interval=QUOTA_FLUSH_INTERVAL)
+tokenizer = Tokenizer(MODEL, fallback=TOKEN_ESTIMATE_FALLBACK)
+context = ContextBuilder(storage, llm, tokenizer, budget=CONTEXT_TOKENS, summary_tokens=CONTEXT_SUMMARY_TOKENS)
+
+lag_monitor = metrics.LoopLagMonitor()
+metrics.register(metrics.Gauge("bot_db_transactions", "Транзакций SQLite с запуска", fn=lambda: storage.calls))
+metrics.register(metrics.Gauge("bot_db_busy_seconds", "Время потока SQLite в транзакциях", fn=lambda: storage.busy))
+metrics.register(metrics.Gauge("bot_chats_archived", "Диалогов выгружено в архив с запуска", fn=lambda: retention.archived))
+metrics.register(metrics.Gauge("bot_chats_restored", "Диалогов возвращено из архива с запуска", fn=lambda: retention.restored))
+
+@dp.update.outer_middleware()
+async def count_updates(handler, event, data):
+    metrics.UPDATES.inc(event.event_type)
+    return await handler(event, data)
+
+async def time_handler(handler, event, data):
+    # уже после фильтров: известно, какой хендлер сработал
+    with metrics.span("handler." + data["handler"].callback.__name__):
+        return await handler(event, data)
+
+dp.message.middleware(time_handler)
+dp.callback_query.middleware(time_handler)
 
 def access(uid: int) -> bool:
     return (not ALLOWED) or (str(uid) in ALLOWED)
 
-def set_active(c, uid, chat_id):
-    c.execute("INSERT OR REPLACE INTO active_chat(user_id, chat_id) VALUES(?,?)", (uid, chat_id))
-    c.commit()
-
-def ensure_active_chat(c, uid) -> int:
-    row = c.execute("SELECT chat_id FROM active_chat WHERE user_id=?", (uid,)).fetchone()
-    if row:
-        return row[0]
-    return new_chat(c, uid)
-
-def new_chat(c, uid) -> int:
-    new_id = c.execute("SELECT COALESCE(MAX(chat_id),0)+1 FROM sessions WHERE user_id=?", (uid,)).fetchone()[0]
-    now = int(time.time())
-    c.execute("INSERT OR REPLACE INTO sessions(user_id, chat_id, updated_at) VALUES(?,?,?)", (uid, new_id, now))
-    set_active(c, uid, new_id)
-    c.commit()
-    return new_id
-
-def list_chats(c, uid):
-    return c.execute("SELECT chat_id, updated_at FROM sessions WHERE user_id=? ORDER BY updated_at DESC", (uid,)).fetchall()
-
-def history(c, uid, chat_id, limit=None):
-    q = "SELECT role, content FROM messages WHERE user_id=? AND chat_id=? ORDER BY id"
-    if limit:
-        q += f" LIMIT {limit}"
-    rows = c.execute(q, (uid, chat_id)).fetchall()
-    return [{"role": r, "content": t} for r, t in rows]
-
-def add_msg(c, uid, chat_id, role, content):
-    now = int(time.time())
-    c.execute("INSERT INTO messages(user_id, chat_id, role, content, created_at) VALUES(?,?,?,?,?)",
-              (uid, chat_id, role, content, now))
-    c.execute("UPDATE sessions SET updated_at=? WHERE user_id=? AND chat_id=?", (now, uid, chat_id))
-    c.commit()
-
-def can_spend(c, uid, tokens):
-    key = time.strftime("%Y%m%d")
-    row = c.execute("SELECT used_tokens FROM quotas WHERE user_id=? AND yyyymmdd=?", (uid, key)).fetchone()
-    used = row[0] if row else 0
-    return used + tokens <= DAILY_LIMIT
-
-def add_tokens(c, uid, tokens):
-    key = time.strftime("%Y%m%d")
-    c.execute("""INSERT INTO quotas(user_id, yyyymmdd, used_tokens)
-        VALUES(?,?,COALESCE((SELECT used_tokens FROM quotas WHERE user_id=? AND yyyymmdd=?),0)+?)
-        ON CONFLICT(user_id, yyyymmdd) DO UPDATE SET used_tokens=used_tokens+?""",
-        (uid, key, uid, key, tokens, tokens))
-    c.commit()
+def is_admin(uid: int) -> bool:
+    return str(uid) in ADMINS
 
 # ===== UI =====
 def menu_main():
@@ -155,14 +145,49 @@ def reply_menu():
         ]
     ])
 
+def md_plain(text: str) -> str:
+    # превью показываем в Markdown-сообщении — убираем символы разметки
+    return text.translate(str.maketrans("", "", "*_`["))
+
+async def render_chats_page(uid: int, page: int):
+    """
+    Текст и клавиатура страницы "Мои диалоги". markup=None — диалогов нет.
+    """
+    chats, total, active = await storage.chats_page(uid, page, CHATS_PAGE_SIZE)
+    if not chats and total == 0 and page > 0:
+        page = 0
+        chats, total, active = await storage.chats_page(uid, page, CHATS_PAGE_SIZE)
+    if not chats:
+        return None, None
+    pages = (total + CHATS_PAGE_SIZE - 1) // CHATS_PAGE_SIZE
+    lines = [f"📜 *Ваши диалоги* ({total}):"]
+    buttons = []
+    for chat_id, upd, last, count, archived in chats:
+        preview = (md_plain(last[:40]) + "…") if last else "(пусто)"
+        date_str = time.strftime("%d.%m %H:%M", time.localtime(upd))
+        mark = "✅" if chat_id == active else "🗄" if archived else " "
+        lines.append(f"{mark} #{chat_id} — {date_str} — {preview}")
+        buttons.append(InlineKeyboardButton(text=f"{mark} #{chat_id} ({count})".strip(), callback_data=f"use_chat:{chat_id}"))
+    lines.append("\nПереключиться: кнопкой ниже или `/use <номер>`")
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"list_chats:{page - 1}"))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"))
+        if page + 1 < pages:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"list_chats:{page + 1}"))
+        rows.append(nav)
+    rows.append([InlineKeyboardButton(text="🆕 Новый диалог", callback_data="new_chat")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
 # ===== COMMANDS =====
 @dp.message(Command("start", "menu", "gpt"))
 async def cmd_start(m: Message):
     if not access(m.from_user.id):
         await m.reply("🚫 Доступ ограничен. Обратитесь к администратору.")
         return
-    c = db()
-    ensure_active_chat(c, m.from_user.id)
+    await storage.ensure_active_chat(m.from_user.id)
     await m.reply(
         "👋 Привет! Я *ChatGPT для красавчиков из Mos-GSM* в Telegram.\n"
         "Пиши вопрос или пользуйся меню ниже.",
@@ -172,29 +197,17 @@ async def cmd_start(m: Message):
 @dp.message(Command("new"))
 async def new_cmd(m: Message):
     if not access(m.from_user.id): return
-    c = db()
-    cid = new_chat(c, m.from_user.id)
+    cid = await storage.new_chat(m.from_user.id)
     await m.reply(f"🆕 Создан новый диалог *#{cid}*. Пиши сообщение.", reply_markup=reply_menu())
 
 @dp.message(Command("chats"))
 async def chats_cmd(m: Message):
     if not access(m.from_user.id): return
-    c = db()
-    chats = list_chats(c, m.from_user.id)
-    if not chats:
+    text, markup = await render_chats_page(m.from_user.id, 0)
+    if markup is None:
         await m.reply("Пока нет диалогов. Нажми *Новый диалог*.", reply_markup=menu_main())
         return
-    lines = ["📜 *Ваши диалоги:*"]
-    active = ensure_active_chat(c, m.from_user.id)
-    for chat_id, upd in chats:
-        last = c.execute("SELECT content FROM messages WHERE user_id=? AND chat_id=? ORDER BY id DESC LIMIT 1",
-                         (m.from_user.id, chat_id)).fetchone()
-        preview = (last[0][:40] + "…") if last else "(пусто)"
-        date_str = time.strftime("%d.%m %H:%M", time.localtime(upd))
-        mark = "✅" if chat_id == active else " "
-        lines.append(f"{mark} #{chat_id} — {date_str} — {preview}")
-    lines.append("\nПереключиться: `/use <номер>`")
-    await m.reply("\n".join(lines))
+    await m.reply(text, reply_markup=markup)
 
 @dp.message(Command("use"))
 async def use_cmd(m: Message):
@@ -204,19 +217,86 @@ async def use_cmd(m: Message):
         await m.reply("Использование: `/use <номер>`", reply_markup=menu_main())
         return
     chat_id = int(parts[1])
-    c = db()
-    exists = c.execute("SELECT 1 FROM sessions WHERE user_id=? AND chat_id=?", (m.from_user.id, chat_id)).fetchone()
-    if not exists:
+    if not await storage.chat_exists(m.from_user.id, chat_id):
         await m.reply("❌ Такого диалога нет.", reply_markup=menu_main())
         return
-    set_active(c, m.from_user.id, chat_id)
+    await retention.restore(m.from_user.id, chat_id)
+    await storage.set_active(m.from_user.id, chat_id)
     await m.reply(f"✅ Переключено на диалог *#{chat_id}*.", reply_markup=reply_menu())
 
+@dp.message(Command("cache"))
+async def cache_cmd(m: Message):
+    if not is_admin(m.from_user.id): return
+    st = await cache.stats()
+    fs = await file_store.stats()
+    await m.reply(
+        f"🗄 *Кэш извлечения*\n"
+        f"• Записей: *{st['entries']}* ({st['bytes'] / 1024 / 1024:.1f} из {CACHE_MAX_MB} МБ)\n"
+        f"• Попаданий: *{st['hits']}*, промахов: *{st['misses']}* ({st['hit_rate']:.0%})\n"
+        f"• Вытеснено: *{st['evicted']}*\n\n"
+        f"📁 *Файлы*: {fs['files']} шт., {fs['bytes'] / 1024 / 1024:.1f} из {FILES_MAX_MB} МБ, ссылок {fs['refs']}\n"
+        f"• Занято файлами живых диалогов (не вытесняются): {fs['pinned'] / 1024 / 1024:.1f} МБ\n"
+        f"• Без скачивания: *{fs['reused']}*, скачано: *{fs['downloaded']}*, вытеснено: *{fs['evicted']}*\n\n"
+        f"🖼 *Предобработка картинок*: {image_prep['images']} шт.\n"
+        f"• Объём: {image_prep['bytes_before'] / 1024:.0f} → {image_prep['bytes_after'] / 1024:.0f} КБ\n"
+        f"• Токены (оценка): {image_prep['tokens_before']} → {image_prep['tokens_after']}"
+    )
+
+def fmt_seconds(x: float) -> str:
+    return f"{x * 1000:.0f} мс" if x < 1 else f"{x:.1f} с"
+
+@dp.message(Command("stats"))
+async def stats_cmd(m: Message):
+    if not is_admin(m.from_user.id): return
+    up = int(time.time() - metrics.STARTED)
+    lines = [f"📊 *Статистика* (аптайм {up // 3600} ч {up % 3600 // 60} мин)", "", "*Этапы* — раз, p50 / p95:"]
+    stages = sorted(metrics.STAGE.series, key=lambda k: -metrics.STAGE.series[k][-1])
+    for key in stages[:15]:
+        h = metrics.STAGE
+        lines.append(f"• `{key[0]}` — {h.count(key)}, {fmt_seconds(h.quantile(0.5, key))} / {fmt_seconds(h.quantile(0.95, key))}")
+    tok = metrics.TOKENS.values
+    lines.append(f"\n*Токены*: вход {int(tok.get(('prompt',), 0))}, выход {int(tok.get(('completion',), 0))}")
+    hits = sum(v for (_, r), v in metrics.CACHE.values.items() if r == "hit")
+    total = sum(metrics.CACHE.values.values())
+    lines.append(f"*Кэш*: {int(hits)} из {int(total)} ({hits / total:.0%})" if total else "*Кэш*: обращений не было")
+    errors = sorted(metrics.ERRORS.values.items(), key=lambda kv: -kv[1])
+    if errors:
+        lines.append("*Ошибки*: " + ", ".join(f"`{t}` в `{st}` ×{int(n)}" for (st, t), n in errors[:5]))
+    lines.append(f"*Event loop*: задержка {metrics.LOOP_LAG.get() * 1000:.1f} мс, максимум {lag_monitor.max * 1000:.0f} мс")
+    lines.append(f"*Очередь ходов*: ждут {scheduler.queued}, идут {scheduler.running}, отказов {scheduler.rejected}")
+    lines.append(f"*SQLite*: {storage.calls} транзакций, {storage.busy:.1f} с")
+    await m.reply("\n".join(lines))
+
+@dp.message(Command("kb"))
+async def kb_cmd(m: Message):
+    if not is_admin(m.from_user.id): return
+    docs = await kb.docs()
+    if not docs:
+        await m.reply("📕 База знаний пуста. Пришлите документ с подписью `#kb`.")
+        return
+    lines = ["📕 *Документы базы знаний:*"]
+    for doc_id, name, passages, created in docs:
+        date_str = time.strftime("%d.%m.%Y", time.localtime(created))
+        lines.append(f"#{doc_id} — {md_plain(name)} — {passages} фрагм. — {date_str}")
+    lines.append("\nУдалить: `/kb_del <номер>`")
+    await m.reply("\n".join(lines))
+
+@dp.message(Command("kb_del"))
+async def kb_del_cmd(m: Message):
+    if not is_admin(m.from_user.id): return
+    parts = m.text.strip().split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        await m.reply("Использование: `/kb_del <номер>`")
+        return
+    if await kb.delete(int(parts[1])):
+        await m.reply(f"🗑 Документ #{parts[1]} удалён из базы знаний.")
+    else:
+        await m.reply("❌ Такого документа нет.")
+
 # ===== CALLBACKS =====
 @dp.callback_query(F.data.in_({"menu_main", "chat_mode"}))
 async def cb_main(q: CallbackQuery):
-    c = db()
-    ensure_active_chat(c, q.from_user.id)
+    await storage.ensure_active_chat(q.from_user.id)
     await q.message.edit_text(
         "👋 Привет! Я *ChatGPT для красавчиков из Mos-GSM* в Telegram.\n"
         "Пиши вопрос или пользуйся меню ниже.",
@@ -230,10 +310,7 @@ async def cb_manage(q: CallbackQuery):
 
 @dp.callback_query(F.data == "menu_profile")
 async def cb_profile(q: CallbackQuery):
-    c = db()
-    key = time.strftime("%Y%m%d")
-    row = c.execute("SELECT used_tokens FROM quotas WHERE user_id=? AND yyyymmdd=?", (q.from_user.id, key)).fetchone()
-    used = row[0] if row else 0
+    used = await quota.used(q.from_user.id)
     text = (f"👤 *Профиль*\n"
             f"• Модель: `{MODEL}`\n"
             f"• Лимит на сегодня: *{DAILY_LIMIT}* токенов\n"
@@ -243,85 +320,134 @@ async def cb_profile(q: CallbackQuery):
 
 @dp.callback_query(F.data == "menu_kb")
 async def cb_kb(q: CallbackQuery):
-    await q.message.edit_text(
-        "📕 База знаний пока не подключена.\n"
-        "Можно загрузить регламенты/FAQ и искать по ним — добавим позже.",
-        reply_markup=menu_manage()
-    )
+    docs = await kb.docs()
+    text = (f"📕 *База знаний*: {len(docs)} док., {sum(d[2] for d in docs)} фрагм.\n"
+            "Ответы в чате учитывают найденные в ней фрагменты.")
+    if is_admin(q.from_user.id):
+        text += "\n\nДобавить: пришлите PDF/DOCX с подписью `#kb`. Список: /kb"
+    await q.message.edit_text(text, reply_markup=menu_manage())
     await q.answer()
 
 @dp.callback_query(F.data == "new_chat")
 async def cb_new_chat(q: CallbackQuery):
-    c = db()
-    cid = new_chat(c, q.from_user.id)
+    cid = await storage.new_chat(q.from_user.id)
     await q.message.answer(f"🆕 Создан новый диалог *#{cid}*. Пишите сообщение.", reply_markup=reply_menu())
     await q.answer()
 
 @dp.callback_query(F.data == "list_chats")
 async def cb_list_chats(q: CallbackQuery):
-    c = db()
-    chats = list_chats(c, q.from_user.id)
-    if not chats:
+    text, markup = await render_chats_page(q.from_user.id, 0)
+    if markup is None:
         await q.message.answer("Пока нет диалогов. Нажмите *Новый диалог*.", reply_markup=menu_main())
         await q.answer()
         return
-    lines = ["📜 *Ваши диалоги:*"]
-    active = ensure_active_chat(c, q.from_user.id)
-    for chat_id, upd in chats:
-        last = c.execute("SELECT content FROM messages WHERE user_id=? AND chat_id=? ORDER BY id DESC LIMIT 1",
-                         (q.from_user.id, chat_id)).fetchone()
-        preview = (last[0][:40] + "…") if last else "(пусто)"
-        date_str = time.strftime("%d.%m %H:%M", time.localtime(upd))
-        mark = "✅" if chat_id == active else " "
-        lines.append(f"{mark} #{chat_id} — {date_str} — {preview}")
-    lines.append("\nПереключиться: `/use <номер>`")
-    await q.message.answer("\n".join(lines))
+    await q.message.answer(text, reply_markup=markup)
+    await q.answer()
+
+@dp.callback_query(F.data.startswith("list_chats:"))
+async def cb_chats_page(q: CallbackQuery):
+    page = int(q.data.split(":", 1)[1])
+    text, markup = await render_chats_page(q.from_user.id, page)
+    if markup is None:
+        await q.answer("Диалогов нет")
+        return
+    await q.message.edit_text(text, reply_markup=markup)
+    await q.answer()
+
+@dp.callback_query(F.data == "noop")
+async def cb_noop(q: CallbackQuery):
+    await q.answer()
+
+@dp.callback_query(F.data.startswith("use_chat:"))
+async def cb_use_chat(q: CallbackQuery):
+    chat_id = int(q.data.split(":", 1)[1])
+    if not await storage.chat_exists(q.from_user.id, chat_id):
+        await q.answer("❌ Такого диалога нет.")
+        return
+    await retention.restore(q.from_user.id, chat_id)
+    await storage.set_active(q.from_user.id, chat_id)
+    await q.message.answer(f"✅ Переключено на диалог *#{chat_id}*.", reply_markup=reply_menu())
     await q.answer()
 
 # ===== CHAT =====
+CHAT_SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "Ты умный ассистент компании MOS-GSM. Отвечай как ChatGPT Plus: "
+        "полно и по делу, сохраняй форматирование (Markdown), используй списки/заголовки, emoji, ссылки и блоки кода. "
+        "ВНИМАНИЕ: не используй #-заголовки. Все заголовки оформляй просто жирным (**Заголовок**)."
+    )
+}
+
+async def kb_context(question: str) -> dict | None:
+    """
+    Системное сообщение с найденными в базе знаний фрагментами (или None).
+    """
+    found = await kb.search(question, KB_TOP_K)
+    if not found:
+        return None
+    parts = [f"[{i}] {name}:\n{text}" for i, (name, text, _) in enumerate(found, 1)]
+    return {
+        "role": "system",
+        "content": (
+            "Фрагменты из базы знаний MOS-GSM (регламенты, FAQ). Если они относятся к вопросу — "
+            "опирайся на них и ссылайся на документ; если нет — игнорируй.\n\n" + "\n\n".join(parts)
+        ),
+    }
+
 @dp.message(F.text)
 async def chat(m: Message):
     if not access(m.from_user.id):
         await m.reply("🚫 Доступ ограничен.")
         return
 
-    c = db()
     uid = m.from_user.id
-    chat_id = ensure_active_chat(c, uid)
+    chat_id = await storage.ensure_active_chat(uid)
+    if not scheduler.submit((uid, chat_id), m):
+        await m.reply("⏳ Я ещё отвечаю на предыдущие сообщения — подождите немного и напишите снова.")
 
-    add_msg(c, uid, chat_id, "user", m.text)
+async def chat_turn(key: tuple[int, int], batch: list[Message]):
+    """
+    Один ход диалога: несколько сообщений, присланных подряд, идут модели одним вопросом.
+    """
+    uid, chat_id = key
+    m = batch[-1]
+    text = "\n\n".join(x.text for x in batch)
 
-    msgs = history(c, uid, chat_id)
-    est_in = sum(len(x['content']) // 4 for x in msgs)
-    if not can_spend(c, uid, est_in):
-        await m.reply("❌ Превышен лимит токенов на сегодня.")
-        return
+    await storage.add_msg(uid, chat_id, "user", text)
 
     try:
         await bot.send_chat_action(chat_id=m.chat.id, action="typing")
-    except:
-        pass
+    except Exception as e:
+        metrics.error("chat_action", e)
 
+    res = None
     try:
-        system_prompt = {
-            "role": "system",
-            "content": (
-                "Ты умный ассистент компании MOS-GSM. Отвечай как ChatGPT Plus: "
-                "полно и по делу, сохраняй форматирование (Markdown), используй списки/заголовки, emoji, ссылки и блоки кода. "
-                "ВНИМАНИЕ: не используй #-заголовки. Все заголовки оформляй просто жирным (**Заголовок**)."
-            )
-        }
+        system = [CHAT_SYSTEM_PROMPT]
+        with metrics.span("chat.kb"):
+            kb_msg = await kb_context(text)
+        if kb_msg:
+            system.append(kb_msg)
+        with metrics.span("chat.context"):
+            msgs, est_in, summary_used = await context.build(uid, chat_id, reserve=sum(tokenizer.message(x) for x in system))
+        await quota.charge(uid, summary_used)
+        # резервируем вход + запас на ответ, чтобы параллельные запросы не пробили лимит
+        res = await quota.reserve(uid, est_in + QUOTA_ANSWER_RESERVE)
+        if res is None:
+            await m.reply("❌ Превышен лимит токенов на сегодня.")
+            return
 
-        resp = client.chat.completions.create(
-            model=MODEL,
-            messages=[system_prompt] + msgs
-        )
+        if STREAM_ANSWERS:
+            await stream_answer(m, system + msgs, uid, chat_id, est_in, res)
+            return
+
+        resp = await llm.complete(system + msgs)
         answer = resp.choices[0].message.content
         answer = format_answer(answer)
         usage = resp.usage.total_tokens if resp.usage else est_in
 
-        add_msg(c, uid, chat_id, "assistant", answer)
-        add_tokens(c, uid, usage)
+        await storage.add_msg(uid, chat_id, "assistant", answer)
+        quota.settle(res, usage)
 
         await m.reply(
             answer,
@@ -330,76 +456,153 @@ async def chat(m: Message):
         )
 
     except Exception as e:
+        metrics.error("chat", e)
+        log.warning("chat turn failed for %s: %r", key, e)
         await m.reply(f"❌ Ошибка OpenAI: `{e}`", reply_markup=reply_menu())
+    finally:
+        if res is not None:
+            quota.release(res)
+
+scheduler = Scheduler(chat_turn, name="chat", concurrency=SCHED_CONCURRENCY, window=SCHED_WINDOW,
+                      max_pending=SCHED_USER_QUEUE, max_total=SCHED_MAX_QUEUE)
+
+async def stream_answer(m: Message, messages: list[dict], uid: int, chat_id: int, est_in: int, res: Reservation):
+    """
+    Ответ по мере генерации: плейсхолдер, затем правки не чаще STREAM_EDIT_INTERVAL.
+    """
+    reply = StreamingReply(m, STREAM_EDIT_INTERVAL)
+    fmt = AnswerFormatter()
+    usage = None
+    await reply.start()
+    try:
+        try:
+            async for chunk in llm.stream(messages):
+                if chunk.usage:
+                    usage = chunk.usage.total_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    fmt.feed(chunk.choices[0].delta.content)
+                    reply.update(fmt.text)
+        except Exception as e:
+            metrics.error("chat.stream", e)
+            await reply.fail(f"❌ Ошибка OpenAI: `{e}`", reply_markup=reply_menu())
+            return
+
+        answer = fmt.finish()
+        try:
+            await storage.add_msg(uid, chat_id, "assistant", answer)
+            quota.settle(res, usage or est_in)
+        finally:
+            # ответ уже сгенерирован — показываем его целиком, даже если не сохранился
+            await reply.finish(answer, reply_markup=reply_menu())
+    finally:
+        # отмена посреди стрима или ошибка в finish — цикл правок не должен пережить ответ
+        await reply.close()
 
 #Ниже то, что касается отрпавки и получения файлов
 
-import aiofiles
-from io import BytesIO
-from PIL import Image
-from PyPDF2 import PdfReader
-from docx import Document as DocxDocument
 import base64
+import hashlib
+import shutil
+import tempfile
+
+from .albums import AlbumCollector
+from .cache import ExtractionCache
+from .download import read_mapped
+from .extract import ExtractionError, ExtractionService, ExtractionTimeout
+from .filestore import FileStore
+from .summarize import DocumentSummarizer
 
 MAX_FILE_MB = int(os.getenv("MAX_FILE_MB", "50"))
 OCR_ENGINE = os.getenv("OCR_ENGINE", "openai").lower()
 OCR_LANG = os.getenv("OCR_LANG", "rus+eng")
+FILES_DIR = os.getenv("FILES_DIR", "files")
+FILES_MAX_MB = int(os.getenv("FILES_MAX_MB", "2048"))           # вложения на диске, дальше вытесняются давно не нужные
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))  # процессов под PDF/DOCX/Tesseract
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "120"))    # секунд на один документ
+EXTRACT_MAX_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", "500"))  # больше страниц — отказ
+VISION_LONG_SIDE = int(os.getenv("VISION_LONG_SIDE", "2048"))   # картинка для vision-OCR вписывается в этот квадрат
+VISION_SHORT_SIDE = int(os.getenv("VISION_SHORT_SIDE", "768"))  # и короткая сторона не больше — дальше модель всё равно ужимает
+DOC_CHUNK_TOKENS = int(os.getenv("DOC_CHUNK_TOKENS", "6000"))  # длиннее — обрабатываем документ по частям
+DOC_PARALLEL = int(os.getenv("DOC_PARALLEL", "4"))               # частей документа одновременно в модели
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "200"))            # кэш извлечённого текста
+CACHE_MAX_AGE_DAYS = int(os.getenv("CACHE_MAX_AGE_DAYS", "30"))  # не востребованное дольше — удаляется
+SCAN_MIN_CHARS = int(os.getenv("SCAN_MIN_CHARS", "20"))         # страница PDF с меньшим текстовым слоем — скан
+SCAN_MAX_PAGES = int(os.getenv("SCAN_MAX_PAGES", "30"))         # распознаём не больше стольких сканов в документе
+SCAN_TIME_BUDGET = float(os.getenv("SCAN_TIME_BUDGET", "180"))  # секунд на OCR сканов одного документа
+SCAN_PARALLEL = int(os.getenv("SCAN_PARALLEL", "4"))            # страниц одного документа в OCR одновременно
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))          # ждём следующее фото альбома столько секунд
+ALBUM_MAX_WAIT = float(os.getenv("ALBUM_MAX_WAIT", "5.0"))      # и не дольше этого от первого
+
+extractor = ExtractionService(EXTRACT_WORKERS, EXTRACT_TIMEOUT, EXTRACT_MAX_PAGES)
+cache = ExtractionCache(storage, CACHE_MAX_MB * 1024 * 1024, CACHE_MAX_AGE_DAYS)
+file_store = FileStore(kb_storage, FILES_DIR, FILES_MAX_MB * 1024 * 1024)
+retention = Retention(storage, ARCHIVE_DIR, RETENTION_IDLE_DAYS, RETENTION_QUOTA_DAYS,
+                      interval=RETENTION_INTERVAL, batch=RETENTION_BATCH, vacuum_pages=RETENTION_VACUUM_PAGES,
+                      files=file_store)
+summarizer = DocumentSummarizer(llm, tokenizer, cache, chunk_tokens=DOC_CHUNK_TOKENS, parallel=DOC_PARALLEL)
+# сколько сэкономила предобработка картинок для vision-OCR (с момента запуска)
+image_prep = {"images": 0, "bytes_before": 0, "bytes_after": 0, "tokens_before": 0, "tokens_after": 0}
+
+async def download_by_file_id(file, uid: int, chat_id: int, name: str, prefix: str = "file"):
+    """
+    Файл вложения (Document/PhotoSize) из хранилища FILES_DIR, при необходимости скачивает.
+    Возвращает Downloaded(path, size, sha256, ext).
+    """
+    with metrics.span("download." + prefix):
+        return await file_store.fetch(bot, file.file_id, file.file_unique_id, file.file_size,
+                                      MAX_FILE_MB * 1024 * 1024, uid, chat_id, name, prefix)
 
-async def download_by_file_id(file_id: str, prefix: str = "file") -> tuple[str, bytes, str]:
+IMAGE_MIME = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+
+async def vision_payload(path: str) -> tuple[str, str]:
     """
-    Скачивает файл по file_id. Возвращает: (имя_файла, bytes, ext)
+    Картинка для vision-запроса: (MIME, base64). Уменьшенная и перекодированная в воркере;
+    если Pillow её не открыл — как есть.
     """
-    f = await bot.get_file(file_id)
-    ext = os.path.splitext(f.file_path)[1] or ""
-    # aiogram v3: скачивание по file_path
-    bio = BytesIO()
-    await bot.download_file(f.file_path, destination=bio)
-    content = bio.getvalue()
-    if len(content) > MAX_FILE_MB * 1024 * 1024:
-        raise ValueError(f"Файл больше {MAX_FILE_MB} МБ")
-    filename = f"{prefix}_{int(time.time())}{ext}"
-    return filename, content, ext.lower()
-
-async def save_bytes_local(filename: str, content: bytes) -> str:
-    os.makedirs("files", exist_ok=True)
-    full = os.path.join("files", filename)
-    async with aiofiles.open(full, "wb") as f:
-        await f.write(content)
-    return full
-
-def extract_text_from_pdf_bytes(content: bytes) -> str:
-    reader = PdfReader(BytesIO(content))
-    out = []
-    for p in reader.pages:
-        out.append(p.extract_text() or "")
-    return "\n".join(out).strip()
-
-def extract_text_from_docx_bytes(content: bytes) -> str:
-    bio = BytesIO(content)
-    doc = DocxDocument(bio)
-    return "\n".join(p.text for p in doc.paragraphs).strip()
-
-def ocr_tesseract_image_bytes(content: bytes, lang: str = OCR_LANG) -> str:
-    img = Image.open(BytesIO(content))
-    import pytesseract
-    return pytesseract.image_to_string(img, lang=lang).strip()
-
-def ocr_openai_image_bytes(content: bytes) -> tuple[str, int]:
+    try:
+        with metrics.span("ocr.prepare"):
+            data, mime, st = await extractor.prepare_vision(path, VISION_LONG_SIDE, VISION_SHORT_SIDE)
+    except ExtractionError:
+        raise
+    except Exception as e:
+        log.warning("image preprocessing failed for %s: %s", path, e)
+        ext = os.path.splitext(path)[1].lower()
+        b64 = await asyncio.to_thread(read_mapped, path, lambda buf: base64.b64encode(buf).decode("ascii"))
+        return IMAGE_MIME.get(ext, "image/png"), b64
+    for k in ("bytes_before", "bytes_after", "tokens_before", "tokens_after"):
+        image_prep[k] += st[k]
+    image_prep["images"] += 1
+    log.info("vision image %s: %dx%d %d B -> %dx%d %d B, ~%d -> ~%d tokens", path,
+             *st["size_before"], st["bytes_before"], *st["size_after"], st["bytes_after"],
+             st["tokens_before"], st["tokens_after"])
+    return mime, base64.b64encode(data).decode("ascii")
+
+async def ocr_openai_image(path: str) -> tuple[str, int]:
     """
     Используем GPT-4o для OCR/рукописей. Возвращаем (text, used_tokens).
     """
-    b64 = base64.b64encode(content).decode("utf-8")
+    return await ocr_openai_images([path])
+
+async def ocr_openai_images(paths: list[str]) -> tuple[str, int]:
+    """
+    OCR нескольких картинок (страниц альбома) одним vision-запросом: текст страниц
+    по порядку, перед каждой — строка «--- N ---».
+    """
+    payloads = await asyncio.gather(*(vision_payload(p) for p in paths))
+    if len(paths) == 1:
+        instruction = "Извлеки весь текст с изображения. Сохрани строки и порядок. Без комментариев."
+    else:
+        instruction = (f"На {len(paths)} изображениях — страницы по порядку. Извлеки весь текст каждой, "
+                       "сохрани строки и порядок. Перед текстом страницы N пиши отдельную строку «--- N ---». "
+                       "Без комментариев.")
     # Chat Completions с изображением
-    resp = client.chat.completions.create(
-        model=MODEL,  # gpt-4o
-        messages=[{
+    resp = await llm.complete([{
             "role": "user",
-            "content": [
-                {"type": "text", "text": "Извлеки весь текст с изображения. Сохрани строки и порядок. Без комментариев."},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}}
+            "content": [{"type": "text", "text": instruction}] + [
+                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}}
+                for mime, b64 in payloads
             ]
-        }]
-    )
+        }])
     text = resp.choices[0].message.content or ""
     used = resp.usage.total_tokens if resp.usage else 0
     return text.strip(), used
@@ -412,6 +615,168 @@ def guess_mediatype(ext: str, mime: str | None = None) -> str:
     if ext in [".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff"]: return "image"
     return "bin"
 
+def cache_key(kind: str) -> tuple[str, str]:
+    """
+    (engine, variant) для кэша: всё, от чего зависит извлечённый текст.
+    """
+    if kind == "image":
+        return f"ocr:{OCR_ENGINE}", (MODEL if OCR_ENGINE == "openai" else OCR_LANG)
+    if kind == "pdf":
+        # страницы-сканы распознаются тем же OCR, что и фото
+        _, ocr_variant = cache_key("image")
+        return "pdf", f"scan:{OCR_ENGINE}:{ocr_variant}:{SCAN_MAX_PAGES}"
+    return kind, ""
+
+async def ocr_page(path: str) -> tuple[str, int]:
+    if OCR_ENGINE == "openai":
+        return await ocr_openai_image(path)
+    return await extractor.tesseract(path, OCR_LANG), 0
+
+async def ocr_scanned_pages(path: str, pages: list[str], m: Message | None = None) -> tuple[int, bool]:
+    """
+    Страницы PDF без текстового слоя: достаём картинки страниц (PDF разбирается один
+    раз на кусок страниц в пуле) и распознаём, до SCAN_PARALLEL страниц одновременно.
+    Результаты принимаются строго по порядку страниц (прогресс в чате растёт по мере
+    готовности начала документа). Текст пишется прямо в pages. Не больше SCAN_MAX_PAGES
+    страниц и SCAN_TIME_BUDGET секунд на документ — остальное помечается в тексте,
+    ещё не начатое отменяется. Возвращает (токены, распознано ли всё, что было
+    положено по лимиту страниц).
+    """
+    scans = [i for i, t in enumerate(pages) if len(t.strip()) < SCAN_MIN_CHARS]
+    if not scans:
+        return 0, True
+    todo, skipped = scans[:SCAN_MAX_PAGES], scans[SCAN_MAX_PAGES:]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SCAN_TIME_BUDGET
+    sem = asyncio.Semaphore(SCAN_PARALLEL)
+
+    async def one(i: int, img: str | None) -> tuple[str, int] | None:
+        if img is None:
+            return "", 0
+        async with sem:
+            try:
+                return await ocr_page(img)
+            except Exception as e:
+                # одна битая страница не роняет документ
+                metrics.error("extract.scan_page", e)
+                log.warning("page %d of %s: %r", i + 1, path, e)
+                return None
+
+    os.makedirs(file_store.tmp_dir, exist_ok=True)
+    # свой каталог на документ: опоздавший после таймаута воркер пишет в уже удалённый
+    workdir = tempfile.mkdtemp(prefix="scan_", dir=file_store.tmp_dir)
+    progress = ProgressMessage(m, f"Скан без текстового слоя, распознаю страницы ({len(todo)})") if m else None
+    if progress:
+        await progress.start()
+    tasks: list[asyncio.Task] = []
+    used, complete, recognized = 0, True, 0
+    try:
+        with metrics.span("extract.scan"):
+            try:
+                images = await extractor.pdf_page_images(path, todo, os.path.join(workdir, "page"),
+                                                         timeout=max(1.0, deadline - loop.time()))
+            except ExtractionError as e:
+                metrics.error("extract.scan_images", e)
+                log.warning("page images of %s: %r", path, e)
+                reason = "истекло время на документ" if isinstance(e, ExtractionTimeout) else "не удалось прочитать"
+                images = [None] * len(todo)
+                for i in todo:
+                    pages[i] = f"[стр. {i + 1}: не распознана — {reason}]"
+                complete = False
+            else:
+                tasks = [asyncio.create_task(one(i, img)) for i, img in zip(todo, images)]
+            for n, (i, task) in enumerate(zip(todo, tasks), 1):
+                try:
+                    res = await asyncio.wait_for(asyncio.shield(task), max(0.0, deadline - loop.time()))
+                    reason = "ошибка распознавания"
+                except asyncio.TimeoutError:
+                    # уже готовые страницы после просроченной всё равно берём
+                    res = task.result() if task.done() and not task.cancelled() else None
+                    reason = "истекло время на документ"
+                if res is None:
+                    complete = False
+                    pages[i] = f"[стр. {i + 1}: не распознана — {reason}]"
+                else:
+                    pages[i] = res[0] or pages[i]  # без картинки или пусто после OCR — что было в слое
+                    used += res[1]
+                    recognized += bool(res[0].strip())
+                if progress:
+                    await progress.update(n, len(todo))
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(shutil.rmtree, workdir, True)
+        if progress:
+            await progress.delete()
+    for j in skipped:
+        pages[j] = f"[стр. {j + 1}: скан не распознан — лимит {SCAN_MAX_PAGES} стр.]"
+    if not recognized and len(scans) == len(pages):
+        pages[:] = [""] * len(pages)  # одни пометки вместо текста — для пользователя это «текст не найден»
+    return used, complete
+
+async def extract_text(kind: str, path: str, sha256: str, m: Message | None = None) -> tuple[str, int]:
+    """
+    Текст файла и сколько токенов он стоил сейчас (из кэша — 0). m — куда
+    показывать прогресс долгого распознавания скана.
+    """
+    engine, variant = cache_key(kind)
+    hit = await cache.get(sha256, engine, variant)
+    if hit:
+        return hit[0], 0
+    used_tokens = 0
+    complete = True
+    with metrics.span("extract." + engine.replace("ocr:", "ocr.")):
+        if kind == "pdf":
+            pages = await extractor.pdf_pages(path)
+            used_tokens, complete = await ocr_scanned_pages(path, pages, m)
+            # страницы разделяем \f — по нему summarize.py режет длинные документы
+            extracted = "\n\f".join(pages).strip()
+        elif kind == "docx":
+            extracted = await extractor.docx(path)
+        elif OCR_ENGINE == "openai":
+            extracted, used_tokens = await ocr_openai_image(path)
+        else:
+            extracted = await extractor.tesseract(path, OCR_LANG)
+    # недораспознанное по времени не кэшируем — в другой раз может успеть
+    if extracted.strip() and complete:
+        await cache.put(sha256, engine, variant, extracted, used_tokens)
+    return extracted, used_tokens
+
+async def extract_album(dls: list) -> tuple[str, str, int]:
+    """
+    Текст всех фото альбома: (ключ альбома для кэша, текст, токены). Vision — один
+    запрос на все картинки, Tesseract — картинки параллельно в пуле (и каждая в кэше).
+    """
+    album_sha = hashlib.sha256("".join(d.sha256 for d in dls).encode()).hexdigest()
+    if OCR_ENGINE != "openai":
+        texts = await asyncio.gather(*(extract_text("image", d.path, d.sha256) for d in dls))
+        return album_sha, "\n\n".join(f"--- {i} ---\n{t}" for i, (t, _) in enumerate(texts, 1)), 0
+    engine, variant = cache_key("image")
+    hit = await cache.get(album_sha, engine, variant)
+    if hit:
+        return album_sha, hit[0], 0
+    with metrics.span("extract.ocr.openai_album"):
+        extracted, used = await ocr_openai_images([d.path for d in dls])
+    if extracted.strip():
+        await cache.put(album_sha, engine, variant, extracted, used)
+    return album_sha, extracted, used
+
+async def cached_answer(sha256: str, kind: str, system_prompt: dict, user_content: str) -> tuple[str, int]:
+    """
+    Ответ модели на распознанный текст. Тот же файл с тем же заданием — из кэша, 0 токенов.
+    """
+    variant = MODEL + ":" + hashlib.sha1((system_prompt["content"] + user_content).encode()).hexdigest()[:16]
+    hit = await cache.get(sha256, f"answer:{kind}", variant)
+    if hit:
+        return hit[0], 0
+    with metrics.span(f"answer.{kind}"):
+        resp = await llm.complete([system_prompt, {"role": "user", "content": user_content}])
+    answer = format_answer(resp.choices[0].message.content or "")
+    used = resp.usage.total_tokens if resp.usage else tokenizer.count(user_content)
+    await cache.put(sha256, f"answer:{kind}", variant, answer, used)
+    return answer, used
+
 # Ниже Хендлеры: документы и фото
 
 @dp.message(F.document)
@@ -423,48 +788,56 @@ async def on_document(m: Message):
     doc = m.document
     try:
         await bot.send_chat_action(m.chat.id, "upload_document")
-    except:
-        pass
+    except Exception as e:
+        metrics.error("chat_action", e)
 
+    res = None
+    uid = m.from_user.id
     try:
-        filename, content, ext = await download_by_file_id(doc.file_id, prefix="doc")
-        path = await save_bytes_local(filename, content)
-        kind = guess_mediatype(ext, doc.mime_type)
+        chat_id = await storage.ensure_active_chat(uid)
+        dl = await download_by_file_id(doc, uid, chat_id, doc.file_name or "", prefix="doc")
+        path, filename = dl.path, os.path.basename(dl.path)
+        kind = guess_mediatype(dl.ext, doc.mime_type)
 
         # Базовый ответ
         base_info = f"📥 Документ: *{doc.file_name or filename}*\nТип: `{kind}`\nСохранено: `{path}`"
 
-        # Извлечение текста по типу
-        extracted = ""
-        used_tokens = 0
-
-        if kind == "pdf":
-            extracted = extract_text_from_pdf_bytes(content)
-        elif kind == "docx":
-            extracted = extract_text_from_docx_bytes(content)
-        elif kind == "image":
-            if OCR_ENGINE == "openai":
-                extracted, used_tokens = ocr_openai_image_bytes(content)
-            else:
-                extracted = ocr_tesseract_image_bytes(content, OCR_LANG)
-        else:
+        if kind == "bin":
             await m.reply(base_info + "\n\nЭтот тип пока не обрабатываю. Отправь PDF/DOCX/изображение.")
             return
 
+        # Извлечение текста по типу (или из кэша по хэшу файла)
+        extracted, used_tokens = await extract_text(kind, path, dl.sha256, m)
+
         if not extracted.strip():
             await m.reply(base_info + "\n\nТекст не найден или не распознан.")
             return
 
-        # Сохраняем в историю и считаем квоту
-        c = db()
-        uid = m.from_user.id
-        chat_id = ensure_active_chat(c, uid)
+        name = doc.file_name or filename
+        task = (m.caption or "").strip()
 
-        prompt = f"Распознанный текст из файла {doc.file_name or filename}:\n\n{extracted[:8000]}"
-        add_msg(c, uid, chat_id, "user", prompt)
+        # админ с подписью #kb пополняет базу знаний вместо разбора документа
+        if task.lower().startswith("#kb") and is_admin(uid):
+            await quota.charge(uid, used_tokens)
+            with metrics.span("kb.index"):
+                items = await extractor.run(prepare_document, extracted, KB_PASSAGE_CHARS)
+                doc_id = await kb.add(name, dl.sha256, uid, items)
+            await m.reply(f"📕 Добавлено в базу знаний: *{md_plain(name)}* (#{doc_id}, {len(items)} фрагм.)")
+            return
+
+        # длинный документ — map-reduce по частям вместо обрезки
+        # считаем токены один раз и вне цикла событий: документ может быть большим
+        doc_tokens = await asyncio.to_thread(tokenizer.count, extracted)
+        long_doc = doc_tokens > DOC_CHUNK_TOKENS
+        if long_doc:
+            parts, estimate = summarizer.estimate(doc_tokens)
+        else:
+            estimate = doc_tokens + QUOTA_ANSWER_RESERVE
 
-        est_in = len(prompt) // 4
-        if not can_spend(c, uid, est_in + used_tokens):
+        # OCR уже потрачен — списываем сразу, резервируем только обработку текста
+        await quota.charge(uid, used_tokens)
+        res = await quota.reserve(uid, estimate)
+        if res is None:
             await m.reply("❌ Превышен лимит токенов на сегодня.")
             return
 
@@ -478,60 +851,97 @@ async def on_document(m: Message):
                 "Не используй #-заголовки, заголовки делай жирным (**Заголовок**)."
             )
         }
-        resp = client.chat.completions.create(
-            model=MODEL,
-            messages=[system_prompt, {"role":"user","content":extracted[:15000]}]
-        )
-        answer = format_answer(resp.choices[0].message.content or "")
-        add_msg(c, uid, chat_id, "assistant", answer)
-        add_tokens(c, uid, (resp.usage.total_tokens if resp.usage else est_in) + used_tokens)
+        if long_doc:
+            progress = ProgressMessage(m, f"Документ большой, обрабатываю по частям ({parts})")
+            await progress.start()
+            try:
+                with metrics.span("doc.summarize"):
+                    answer, partials, used = await summarizer.run(
+                        extracted, system_prompt, task or "Структурируй документ.", progress.update)
+            finally:
+                await progress.delete()
+            # в историю — конспект частей: по нему можно задавать вопросы дальше
+            notes = tokenizer.truncate("\n\n".join(partials), DOC_CHUNK_TOKENS)
+            prompt = f"Документ {name} (конспект по частям):\n\n{notes}"
+        else:
+            content = f"{task}\n\n{extracted}" if task else extracted
+            answer, used = await cached_answer(dl.sha256, kind, system_prompt, content)
+            prompt = f"Распознанный текст из файла {name}:\n\n{extracted}"
+
+        await storage.add_msg(uid, chat_id, "user", prompt)
+        await storage.add_msg(uid, chat_id, "assistant", answer)
+        quota.settle(res, used)
 
         await m.reply(base_info + "\n\n" + answer, reply_markup=reply_menu())
 
+    except ExtractionError as e:
+        metrics.error("document", e)
+        await m.reply(f"❌ Не удалось извлечь текст: {e}")
     except Exception as e:
+        metrics.error("document", e)
+        log.warning("document failed: %r", e)
         await m.reply(f"❌ Ошибка при обработке файла: `{e}`")
+    finally:
+        if res is not None:
+            quota.release(res)
 
 @dp.message(F.photo)
 async def on_photo(m: Message):
     if not access(m.from_user.id):
         await m.reply("🚫 Доступ ограничен.")
         return
+    if m.media_group_id:
+        # фото из альбома: ждём остальные части, дальше process_photos() на весь альбом
+        albums.add(m.media_group_id, m, m.message_id)
+        return
+    await process_photos([m])
 
+async def process_photos(ms: list[Message]):
+    """
+    Одно фото или альбом: параллельное скачивание, распознавание, один ответ на всё.
+    """
+    m = ms[0]
     try:
         await bot.send_chat_action(m.chat.id, "upload_photo")
-    except:
-        pass
+    except Exception as e:
+        metrics.error("chat_action", e)
 
+    res = None
+    uid = m.from_user.id
     try:
-        ph = m.photo[-1]  # максимальное качество
-        filename, content, ext = await download_by_file_id(ph.file_id, prefix="photo")
-        path = await save_bytes_local(filename, content)
+        chat_id = await storage.ensure_active_chat(uid)
+        # максимальное качество каждого фото
+        dls = await asyncio.gather(*(download_by_file_id(x.photo[-1], uid, chat_id, "photo", prefix="photo")
+                                     for x in ms))
 
         # OCR
-        if OCR_ENGINE == "openai":
-            extracted, used_tokens = ocr_openai_image_bytes(content)
+        if len(dls) == 1:
+            sha = dls[0].sha256
+            extracted, used_tokens = await extract_text("image", dls[0].path, sha)
+            base_info = f"🖼 Фото сохранено: `{dls[0].path}`"
         else:
-            extracted = ocr_tesseract_image_bytes(content, OCR_LANG)
-            used_tokens = 0
-
-        base_info = f"🖼 Фото сохранено: `{path}`"
+            sha, extracted, used_tokens = await extract_album(dls)
+            base_info = f"🖼 Альбом: {len(dls)} фото"
 
         if not extracted.strip():
             await m.reply(base_info + "\n\nТекст не найден/не распознан. Попробуй сделать фото чётче.")
             return
 
-        # Сохраняем и отправляем структурированный результат
-        c = db()
-        uid = m.from_user.id
-        chat_id = ensure_active_chat(c, uid)
-
-        user_note = (m.caption or "").strip()
+        # Сохраняем и отправляем структурированный результат; подпись у альбома — на одном из фото
+        user_note = next((x.caption.strip() for x in ms if x.caption and x.caption.strip()), "")
         task = user_note if user_note else "Переведи текст с фото в печатный вид и оформи структурно."
-        prompt = f"{task}\n\nТекст с фото:\n{extracted[:8000]}"
-        add_msg(c, uid, chat_id, "user", prompt)
-
-        est_in = len(prompt) // 4
-        if not can_spend(c, uid, est_in + used_tokens):
+        if len(dls) == 1:
+            prompt = f"{task}\n\nТекст с фото:\n{extracted[:8000]}"
+        else:
+            text = tokenizer.truncate(extracted, DOC_CHUNK_TOKENS)
+            prompt = f"{task}\n\nТекст с {len(dls)} фото (страницы по порядку):\n{text}"
+        await storage.add_msg(uid, chat_id, "user", prompt)
+
+        est_in = tokenizer.count(prompt)
+        # OCR уже потрачен — списываем сразу, резервируем только саму суммаризацию
+        await quota.charge(uid, used_tokens)
+        res = await quota.reserve(uid, est_in + QUOTA_ANSWER_RESERVE)
+        if res is None:
             await m.reply("❌ Превышен лимит токенов на сегодня.")
             return
 
@@ -541,33 +951,116 @@ async def on_photo(m: Message):
             "content": "Ты ассистент MOS-GSM. Преобразуй текст в читабельный вид: сохрани абзацы, списки. Markdown."
             "Не используй #-заголовки, заголовки делай жирным (**Заголовок**)."
         }
-        resp = client.chat.completions.create(
-            model=MODEL,
-            messages=[system_prompt, {"role":"user","content":prompt}]
-        )
-        answer = format_answer(resp.choices[0].message.content or "")
-        add_msg(c, uid, chat_id, "assistant", answer)
-        add_tokens(c, uid, (resp.usage.total_tokens if resp.usage else est_in) + used_tokens)
+        answer, used = await cached_answer(sha, "photo" if len(dls) == 1 else "album", system_prompt, prompt)
+        await storage.add_msg(uid, chat_id, "assistant", answer)
+        quota.settle(res, used)
 
         await m.reply(base_info + "\n\n" + answer, reply_markup=reply_menu())
 
+    except ExtractionError as e:
+        metrics.error("photo", e)
+        await m.reply(f"❌ Не удалось извлечь текст: {e}")
     except Exception as e:
+        metrics.error("photo", e)
+        log.warning("photo failed (%d in batch): %r", len(ms), e)
         await m.reply(f"❌ Ошибка при обработке фото: `{e}`")
+    finally:
+        if res is not None:
+            quota.release(res)
+
+albums = AlbumCollector(process_photos, window=ALBUM_WINDOW, max_wait=ALBUM_MAX_WAIT)
 
 # Чтобы бот мог вернуть файл
 
 @dp.message(Command("send_example"))
 async def send_example(m: Message):
-    path = os.path.join("files", "example.txt")
-    os.makedirs("files", exist_ok=True)
+    import aiofiles
+    path = os.path.join(FILES_DIR, "example.txt")
+    os.makedirs(FILES_DIR, exist_ok=True)
     async with aiofiles.open(path, "w", encoding="utf-8") as f:
         await f.write("Пример файла от бота MOS-GSM.")
     async with aiofiles.open(path, "rb") as f:
         await m.answer_document(f, caption="Вот пример файла 📄")
 
 # ===== RUN =====
+metrics_runner = None
+warmup_task = None
+
+async def warm_up():
+    """
+    То, без чего можно принять первый апдейт: пул извлечения с PyPDF2/docx/PIL,
+    чистка кэшей и обслуживание базы. Делаем в фоне после старта.
+    """
+    await asyncio.sleep(WARMUP_DELAY)
+    with metrics.span("startup.warmup"):
+        await cache.evict()
+        await file_store.evict()
+        retention.start()
+        try:
+            await extractor.warm()
+        except Exception as e:
+            metrics.error("startup.warmup", e)
+            log.warning("extraction pool warm-up failed: %r", e)
+
+async def startup():
+    global bot, metrics_runner, warmup_task
+    # словарь tiktoken грузится в потоке, пока открываются базы, и до приёма апдейтов
+    tokenizer_load = asyncio.create_task(asyncio.to_thread(tokenizer.load))
+    bot = Bot(
+        token=TELEGRAM_BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+        default=DefaultBotProperties(parse_mode="Markdown"),
+    )
+    await storage.open()
+    if kb_storage is not storage:
+        await kb_storage.open()
+    quota.start()
+    extractor.start()
+    scheduler.start()
+    lag_monitor.start()
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    with metrics.span("startup.tokenizer"):
+        await tokenizer_load
+    if WARMUP_DELAY >= 0:
+        warmup_task = asyncio.create_task(warm_up())
+    else:
+        retention.start()
+
+async def shutdown():
+    if warmup_task is not None:
+        warmup_task.cancel()
+        await asyncio.gather(warmup_task, return_exceptions=True)
+    await albums.stop(timeout=OPENAI_TIMEOUT)
+    await scheduler.stop(timeout=OPENAI_TIMEOUT)
+    await retention.stop()
+    await lag_monitor.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await llm.close()
+    await quota.stop()
+    await extractor.stop()
+    await storage.close()
+    if kb_storage is not storage:
+        await kb_storage.close()
+    await bot.session.close()
+
 async def main():
-    await dp.start_polling(bot)
+    await startup()
+    try:
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_SECRET:
+                log.warning("WEBHOOK_SECRET is empty: webhook requests are not authenticated")
+            server = WebhookServer(dp, bot, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_RECORD)
+            await server.serve(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_URL, drain_timeout=OPENAI_TIMEOUT)
+        else:
+            # getUpdates не работает, пока установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
+    shard = f"[{BOT_SHARD}] " if BOT_SHARD else ""
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s %(levelname)s {shard}%(name)s: %(message)s")
     asyncio.run(main())
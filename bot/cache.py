@@ -0,0 +1,81 @@
+# Кэш результатов извлечения/OCR по хэшу содержимого: повторно присланный файл
+# не гоняем ни через Tesseract/PyPDF2, ни через платный vision-запрос.
+import time
+
+from . import metrics
+from .storage import Storage
+
+
+def cache_get(c, sha256, engine, variant):
+    row = c.execute("SELECT text, tokens FROM extract_cache WHERE sha256=? AND engine=? AND variant=?",
+                    (sha256, engine, variant)).fetchone()
+    if row:
+        c.execute("""UPDATE extract_cache SET last_hit=?, hits=hits+1
+            WHERE sha256=? AND engine=? AND variant=?""", (int(time.time()), sha256, engine, variant))
+    return row
+
+def cache_put(c, sha256, engine, variant, text, tokens):
+    now = int(time.time())
+    c.execute("""INSERT OR REPLACE INTO extract_cache(sha256, engine, variant, text, tokens, size, created_at, last_hit)
+        VALUES(?,?,?,?,?,?,?,?)""", (sha256, engine, variant, text, tokens, len(text.encode()), now, now))
+
+def cache_evict(c, max_bytes, min_last_hit) -> int:
+    n = c.execute("DELETE FROM extract_cache WHERE last_hit < ?", (min_last_hit,)).rowcount
+    # всё, что не влезает в max_bytes, начиная с давно не востребованного
+    n += c.execute("""DELETE FROM extract_cache WHERE rowid IN (
+        SELECT rowid FROM (SELECT rowid, SUM(size) OVER (ORDER BY last_hit DESC, rowid DESC) AS acc
+            FROM extract_cache) WHERE acc > ?)""", (max_bytes,)).rowcount
+    return n
+
+def cache_stats(c) -> tuple[int, int]:
+    return c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extract_cache").fetchone()
+
+
+class ExtractionCache:
+    """
+    Ключ — (sha256 файла, движок, вариант): вариант включает всё, от чего зависит
+    результат (язык OCR, модель, текст задания). Хранит текст и сколько токенов
+    стоило его получить. Вытеснение — по возрасту последнего обращения и по
+    суммарному размеру (LRU), проверяется раз в evict_every записей.
+    """
+
+    def __init__(self, storage: Storage, max_bytes: int, max_age_days: int, evict_every: int = 50):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._puts = 0
+
+    async def get(self, sha256: str, engine: str, variant: str = "") -> tuple[str, int] | None:
+        row = await self.storage.run(cache_get, sha256, engine, variant)
+        if row is None:
+            self.misses += 1
+            metrics.CACHE.inc(engine, "miss")
+            return None
+        self.hits += 1
+        metrics.CACHE.inc(engine, "hit")
+        return row[0], row[1]
+
+    async def put(self, sha256: str, engine: str, variant: str, text: str, tokens: int):
+        await self.storage.run(cache_put, sha256, engine, variant, text, tokens)
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            await self.evict()
+
+    async def evict(self):
+        self.evicted += await self.storage.run(cache_evict, self.max_bytes, int(time.time()) - self.max_age)
+
+    async def stats(self) -> dict:
+        entries, size = await self.storage.run(cache_stats)
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,173 @@
+# Контекст для модели: свежие реплики в пределах бюджета токенов + сжатое содержание
+# всего, что старше. Содержание хранится в summaries и дописывается инкрементально.
+import logging
+import os
+import threading
+
+from .llm import LLM
+from .storage import Storage
+
+log = logging.getLogger(__name__)
+
+MSG_OVERHEAD = 4  # служебные токены на сообщение в chat-формате
+# словарь tiktoken едет вместе с кодом: кладётся сюда при сборке (tools/fetch_tiktoken.py)
+TIKTOKEN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tiktoken_cache")
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткий конспект диалога пользователя с ассистентом MOS-GSM. "
+    "Обнови конспект с учётом новых реплик: сохрани факты, договорённости, числа, имена, "
+    "открытые вопросы. Пиши сжато, списком, без вступлений. Не длиннее {limit} токенов."
+)
+
+
+class Tokenizer:
+    """
+    Подсчёт токенов через tiktoken, словарь — из TIKTOKEN_CACHE_DIR (по умолчанию
+    TIKTOKEN_DIR). Если его не загрузить, load() падает: оценка len/4 вместо
+    настоящего подсчёта — только при явном fallback=True (бенчмарки, разработка).
+    """
+
+    def __init__(self, model: str, fallback: bool = False):
+        # словарь грузит load() — в потоке, при старте. Пока он не загружен,
+        # подсчёт идёт оценкой и не ждёт загрузку (блокировка — только внутри load)
+        self.model = model
+        self.fallback = fallback
+        self._enc = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_DIR)
+            try:
+                import tiktoken
+                try:
+                    self._enc = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    self._enc = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                if not self.fallback:
+                    raise RuntimeError(
+                        f"tiktoken encoding for {self.model} is not available in {os.environ['TIKTOKEN_CACHE_DIR']} "
+                        f"({e!r}); run `python -m tools.fetch_tiktoken` at build time "
+                        f"or set TOKEN_ESTIMATE_FALLBACK=1 to count by len/4") from e
+                log.warning("tiktoken unavailable, falling back to len/4: %s", e)
+            self._loaded = True
+
+    @property
+    def enc(self):
+        return self._enc
+
+    def count(self, text: str) -> int:
+        if self.enc is None:
+            return len(text) // 4
+        return len(self.enc.encode(text, disallowed_special=()))
+
+    def message(self, msg: dict) -> int:
+        return self.count(msg["content"]) + MSG_OVERHEAD
+
+    def truncate(self, text: str, limit: int) -> str:
+        if self.enc is None:
+            return text[:limit * 4]
+        ids = self.enc.encode(text, disallowed_special=())
+        return text if len(ids) <= limit else self.enc.decode(ids[:limit])
+
+    def split(self, text: str, limit: int) -> list[str]:
+        """
+        Режет текст на куски не длиннее limit токенов (без оглядки на смысл).
+        """
+        if self.enc is None:
+            return [text[i:i + limit * 4] for i in range(0, len(text), limit * 4)]
+        ids = self.enc.encode(text, disallowed_special=())
+        return [self.enc.decode(ids[i:i + limit]) for i in range(0, len(ids), limit)]
+
+
+class ContextBuilder:
+    """
+    Собирает историю для запроса, читая только нужные строки:
+    сначала свежие реплики пачками от новых к старым, пока влезают в budget.
+    Если за окном остались реплики, ещё не попавшие в конспект, — дописываем их
+    в конспект. При переполнении окно ужимается до keep_ratio бюджета, чтобы
+    конспект обновлялся раз в несколько ходов, а не на каждом сообщении.
+    """
+
+    def __init__(self, storage: Storage, llm: LLM, tokenizer: Tokenizer, budget: int,
+                 summary_tokens: int = 800, keep_ratio: float = 0.5, page: int = 40):
+        self.storage = storage
+        self.llm = llm
+        self.tok = tokenizer
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.keep_ratio = keep_ratio
+        self.page = page
+
+    async def _window(self, uid, chat_id, after_id, budget) -> tuple[list[tuple], int, bool]:
+        """
+        Свежие реплики (id, role, content), влезающие в budget, в хронологическом порядке.
+        Третье значение — остались ли за окном более старые реплики после after_id.
+        """
+        rows, used = [], 0
+        before = 2**63 - 1
+        while True:
+            batch = await self.storage.recent_messages(uid, chat_id, after_id, before, self.page)
+            for row in batch:
+                cost = self.tok.count(row[2]) + MSG_OVERHEAD
+                # самое новое сообщение берём всегда, даже если оно одно больше бюджета
+                if rows and used + cost > budget:
+                    return rows[::-1], used, True
+                rows.append(row)
+                used += cost
+            if len(batch) < self.page:
+                return rows[::-1], used, False
+            before = batch[-1][0]
+
+    async def _fold(self, uid, chat_id, upto_id, summary, before_id) -> tuple[int, str, int]:
+        """
+        Дописывает в конспект реплики с upto_id < id < before_id. Возвращает
+        (новый upto_id, конспект, потраченные токены).
+        """
+        spent = 0
+        chunk_budget = max(self.budget, 2000)
+        while True:
+            rows = await self.storage.messages_range(uid, chat_id, upto_id, before_id, self.page)
+            if not rows:
+                return upto_id, summary, spent
+            lines, used = [], 0
+            for id_, role, content in rows:
+                cost = self.tok.count(content) + MSG_OVERHEAD
+                if lines and used + cost > chunk_budget:
+                    break
+                lines.append(f"{role}: {self.tok.truncate(content, chunk_budget)}")
+                used += cost
+                upto_id = id_
+            resp = await self.llm.complete([
+                {"role": "system", "content": SUMMARY_PROMPT.format(limit=self.summary_tokens)},
+                {"role": "user", "content": f"Текущий конспект:\n{summary or '(пусто)'}\n\nНовые реплики:\n" + "\n\n".join(lines)},
+            ], max_tokens=self.summary_tokens)
+            summary = (resp.choices[0].message.content or "").strip()
+            spent += resp.usage.total_tokens if resp.usage else used
+            await self.storage.set_summary(uid, chat_id, upto_id, summary)
+
+    async def build(self, uid, chat_id, reserve: int = 0) -> tuple[list[dict], int, int]:
+        """
+        Возвращает (messages, токенов в них, токенов потрачено на конспект).
+        reserve — сколько бюджета уже занято (системный промпт и т.п.).
+        """
+        upto_id, summary = await self.storage.get_summary(uid, chat_id)
+        summary_cost = self.tok.count(summary) + MSG_OVERHEAD if summary else 0
+        budget = self.budget - reserve - summary_cost
+        rows, used, overflow = await self._window(uid, chat_id, upto_id, budget)
+        spent = 0
+
+        if overflow:
+            keep = int((self.budget - reserve - self.summary_tokens) * self.keep_ratio)
+            rows, used, _ = await self._window(uid, chat_id, upto_id, keep)
+            upto_id, summary, spent = await self._fold(uid, chat_id, upto_id, summary, rows[0][0])
+            summary_cost = self.tok.count(summary) + MSG_OVERHEAD if summary else 0
+
+        msgs = [{"role": r, "content": t} for _, r, t in rows]
+        if summary:
+            msgs.insert(0, {"role": "system", "content": f"Краткое содержание предыдущей части диалога:\n{summary}"})
+        return msgs, used + summary_cost, spent
@@ -0,0 +1,93 @@
+# Скачивание вложений потоком прямо на диск: размер проверяется до начала передачи
+# (по file_size от Telegram) и по ходу, sha256 считается на лету.
+import asyncio
+import hashlib
+import mmap
+import os
+import tempfile
+from dataclasses import dataclass
+
+from aiogram import Bot
+
+CHUNK_SIZE = 256 * 1024
+
+
+class FileTooLarge(ValueError):
+    pass
+
+
+@dataclass
+class Downloaded:
+    path: str
+    size: int
+    sha256: str
+    ext: str
+
+
+def _copy_local(src: str, dst: str, max_bytes: int) -> tuple[int, str]:
+    # режим локального Bot API сервера: file_path — путь на диске
+    h = hashlib.sha256()
+    size = 0
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        while chunk := fin.read(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise FileTooLarge
+            h.update(chunk)
+            fout.write(chunk)
+    return size, h.hexdigest()
+
+
+async def download(bot: Bot, file_id: str, file_size: int | None, directory: str,
+                   prefix: str, max_bytes: int, timeout: int = 120) -> Downloaded:
+    """
+    Скачивает файл в directory под уникальным временным именем (*.part) и отдаёт
+    Downloaded(path, size, sha256, ext); перенести файл на место — забота вызывающего.
+    FileTooLarge — если размер больше max_bytes (по метаданным или по факту).
+    """
+    limit_mb = max_bytes // (1024 * 1024)
+    if file_size and file_size > max_bytes:
+        raise FileTooLarge(f"Файл больше {limit_mb} МБ")
+    f = await bot.get_file(file_id)
+    if f.file_size and f.file_size > max_bytes:
+        raise FileTooLarge(f"Файл больше {limit_mb} МБ")
+    ext = os.path.splitext(f.file_path)[1].lower()
+
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"{prefix}_", suffix=".part")
+    os.close(fd)
+    try:
+        if bot.session.api.is_local:
+            size, digest = await asyncio.to_thread(_copy_local, f.file_path, tmp, max_bytes)
+        else:
+            import aiofiles
+            h = hashlib.sha256()
+            size = 0
+            url = bot.session.api.file_url(bot.token, f.file_path)
+            async with aiofiles.open(tmp, "wb") as out:
+                async for chunk in bot.session.stream_content(url=url, timeout=timeout, chunk_size=CHUNK_SIZE,
+                                                              raise_for_status=True):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise FileTooLarge
+                    h.update(chunk)
+                    await out.write(chunk)
+            digest = h.hexdigest()
+    except FileTooLarge:
+        os.unlink(tmp)
+        raise FileTooLarge(f"Файл больше {limit_mb} МБ") from None
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return Downloaded(tmp, size, digest, ext)
+
+
+def read_mapped(path: str, fn):
+    """
+    Отдаёт fn содержимое файла через mmap, не копируя его целиком в память процесса.
+    """
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return fn(b"")
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return fn(mm)
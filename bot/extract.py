@@ -0,0 +1,198 @@
+# Извлечение текста (PyPDF2, python-docx, Tesseract) и подготовка картинок в пуле процессов: тяжёлый разбор
+# не держит event loop и GIL основного процесса. Воркеры получают путь к файлу, а не байты.
+# Сами библиотеки импортируются только в воркерах — основной процесс на старте за них не платит.
+import asyncio
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# грузятся в forkserver один раз, дальше воркеры получают их готовыми
+WORKER_MODULES = ("PIL.Image", "PyPDF2", "docx", f"{__package__}.imaging")
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class ExtractionTooLarge(ExtractionError):
+    pass
+
+
+class ExtractionTimeout(ExtractionError):
+    pass
+
+
+# ===== функции воркеров (выполняются в дочерних процессах) =====
+
+def pdf_page_count(path: str) -> int:
+    from PyPDF2 import PdfReader
+    return len(PdfReader(path).pages)
+
+def pdf_pages_text(path: str, start: int, stop: int) -> list[str]:
+    from PyPDF2 import PdfReader
+    reader = PdfReader(path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, stop)]
+
+def pdf_page_images(path: str, indexes: list[int], out_base: str) -> list[str | None]:
+    """
+    Картинки страниц-сканов indexes в файлы out_base_p<номер>.<ext>; PDF разбирается
+    один раз на весь список. None — на странице нет картинки, которую можно достать.
+    """
+    from PyPDF2 import PdfReader
+    reader = PdfReader(path)
+    return [_page_image(reader.pages[i], f"{out_base}_p{i + 1}") for i in indexes]
+
+def _page_image(page, out_base: str) -> str | None:
+    """
+    Самое крупное изображение на странице, как есть (JPEG/PNG) или перекодированное
+    в PNG. Страницу не растрируем: у сканов весь лист — одно встроенное изображение.
+    """
+    try:
+        images = list(page.images)
+    except Exception:
+        return None  # фильтр, который PyPDF2 не умеет декодировать
+    if not images:
+        return None
+    img = max(images, key=lambda im: len(im.data))
+    ext = os.path.splitext(img.name)[1].lower()
+    if ext in (".jpg", ".jpeg", ".png"):
+        with open(out_base + ext, "wb") as f:
+            f.write(img.data)
+        return out_base + ext
+    import io
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(img.data)) as im:
+            im.save(out_base + ".png")
+    except (OSError, ValueError):
+        return None  # формат, который PIL не открывает, — одна страница не роняет кусок
+    return out_base + ".png"
+
+def docx_text(path: str) -> str:
+    from docx import Document as DocxDocument
+    doc = DocxDocument(path)
+    return "\n".join(p.text for p in doc.paragraphs).strip()
+
+def tesseract_text(path: str, lang: str) -> str:
+    import pytesseract
+    from PIL import Image
+    from .imaging import prepare_ocr
+    with Image.open(path) as img:
+        return pytesseract.image_to_string(prepare_ocr(img), lang=lang).strip()
+
+def vision_image(path: str, long_side: int, short_side: int) -> tuple[bytes, str, dict]:
+    from .imaging import prepare_vision
+    return prepare_vision(path, long_side, short_side)
+
+def warm_up() -> int:
+    return os.getpid()
+
+
+class ExtractionService:
+    """
+    Пул процессов под извлечение текста. Каждая операция ограничена timeout
+    секундами; многостраничный PDF режется на диапазоны страниц и разбирается
+    параллельно. Уже запущенную в воркере задачу прервать нельзя — по таймауту
+    отменяем всё, что ещё стоит в очереди, и отдаём ExtractionTimeout.
+    """
+
+    def __init__(self, workers: int, timeout: float, max_pages: int, min_pages_per_job: int = 8):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pages = max_pages
+        self.min_pages_per_job = min_pages_per_job
+        self._pool: ProcessPoolExecutor | None = None
+
+    def start(self):
+        # forkserver: воркеры не наследуют потоки и соединения основного процесса,
+        # а PyPDF2/docx/PIL импортируются один раз в сервере и дальше копируются форком
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__, *WORKER_MODULES])
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+
+    async def stop(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, True, cancel_futures=True)
+
+    def _submit(self, fn, *args) -> Future:
+        if self._pool is None:
+            raise ExtractionError("Сервис извлечения текста не запущен")
+        return self._pool.submit(fn, *args)
+
+    async def _gather(self, futures: list[Future], timeout: float | None = None) -> list:
+        try:
+            return await asyncio.wait_for(
+                asyncio.gather(*(asyncio.wrap_future(f) for f in futures)),
+                timeout or self.timeout,
+            )
+        except asyncio.TimeoutError:
+            raise ExtractionTimeout(f"Обработка не уложилась в {int(self.timeout)} с") from None
+        except BrokenProcessPool:
+            # воркер умер (OOM, segfault в парсере) — пул после этого непригоден, поднимаем новый
+            old, self._pool = self._pool, None
+            if old is not None:
+                old.shutdown(wait=False, cancel_futures=True)
+            self.start()
+            raise ExtractionError("Процесс обработки аварийно завершился") from None
+        finally:
+            # по таймауту, отмене хендлера или ошибке в соседнем куске — снимаем то, что не начато
+            for f in futures:
+                f.cancel()
+
+    async def run(self, fn, *args):
+        """
+        Выполняет fn(*args) в пуле с общим таймаутом. fn — функция верхнего уровня модуля.
+        """
+        return (await self._gather([self._submit(fn, *args)]))[0]
+
+    async def pdf(self, path: str) -> str:
+        return "\n\f".join(await self.pdf_pages(path)).strip()
+
+    async def pdf_pages(self, path: str) -> list[str]:
+        """
+        Текстовый слой PDF постранично; у страниц-сканов — пустая строка.
+        """
+        started = time.monotonic()
+        pages = await self.run(pdf_page_count, path)
+        if pages > self.max_pages:
+            raise ExtractionTooLarge(f"Слишком много страниц: {pages} (максимум {self.max_pages})")
+        if not pages:
+            return []
+        step = max(self.min_pages_per_job, math.ceil(pages / self.workers))
+        futures = [self._submit(pdf_pages_text, path, i, min(i + step, pages)) for i in range(0, pages, step)]
+        chunks = await self._gather(futures, max(1.0, self.timeout - (time.monotonic() - started)))
+        # в pdf() страницы разделяем \f — по нему summarize.py режет длинные документы
+        return [t for chunk in chunks for t in chunk]
+
+    async def pdf_page_images(self, path: str, indexes: list[int], out_base: str,
+                              timeout: float | None = None) -> list[str | None]:
+        """
+        Картинки страниц indexes (см. pdf_page_images), по порядку indexes. Страницы
+        делятся между воркерами кусками, каждый кусок открывает PDF один раз.
+        """
+        if not indexes:
+            return []
+        step = max(self.min_pages_per_job, math.ceil(len(indexes) / self.workers))
+        futures = [self._submit(pdf_page_images, path, indexes[i:i + step], out_base)
+                   for i in range(0, len(indexes), step)]
+        chunks = await self._gather(futures, timeout)
+        return [img for chunk in chunks for img in chunk]
+
+    async def docx(self, path: str) -> str:
+        return await self.run(docx_text, path)
+
+    async def tesseract(self, path: str, lang: str) -> str:
+        return await self.run(tesseract_text, path, lang)
+
+    async def prepare_vision(self, path: str, long_side: int, short_side: int) -> tuple[bytes, str, dict]:
+        return await self.run(vision_image, path, long_side, short_side)
+
+    async def warm(self):
+        """
+        Поднимает forkserver и все воркеры заранее, чтобы первый документ не ждал их запуска.
+        """
+        await self._gather([self._submit(warm_up) for _ in range(self.workers)])
@@ -0,0 +1,179 @@
+# Хранилище вложений по хэшу содержимого: FILES_DIR/ab/<sha256><ext>. Один и тот же
+# файл лежит на диске один раз, кто и в каком диалоге его присылал — в file_refs.
+# Повторно присланный файл узнаётся по file_unique_id от Telegram и не скачивается.
+# Таблицы живут в общей базе (KB_DB_PATH): FILES_DIR у шардов общий.
+import asyncio
+import glob
+import logging
+import os
+import time
+
+from aiogram import Bot
+
+from .download import Downloaded, download
+from .storage import Storage
+
+log = logging.getLogger(__name__)
+
+
+def file_lookup(c, unique_id, now) -> tuple[str, str, int] | None:
+    row = c.execute("""SELECT f.sha256, f.ext, f.size FROM file_ids i JOIN files f ON f.sha256=i.sha256
+        WHERE i.file_unique_id=?""", (unique_id,)).fetchone()
+    if row:
+        c.execute("UPDATE files SET last_used=? WHERE sha256=?", (now, row[0]))
+    return row
+
+def file_add(c, sha256, ext, size, unique_id, uid, chat_id, name, now) -> str:
+    """
+    Регистрирует файл и ссылку на него из диалога. Возвращает расширение, под
+    которым файл уже лежит на диске (если тот же контент приходил с другим).
+    """
+    c.execute("""INSERT INTO files(sha256, ext, size, created_at, last_used) VALUES(?,?,?,?,?)
+        ON CONFLICT(sha256) DO UPDATE SET last_used=excluded.last_used""", (sha256, ext, size, now, now))
+    if unique_id:
+        c.execute("INSERT OR REPLACE INTO file_ids(file_unique_id, sha256) VALUES(?,?)", (unique_id, sha256))
+    return link(c, sha256, uid, chat_id, name, now)
+
+def link(c, sha256, uid, chat_id, name, now) -> str:
+    if c.execute("INSERT OR IGNORE INTO file_refs(sha256, user_id, chat_id, name, created_at) VALUES(?,?,?,?,?)",
+                 (sha256, uid, chat_id, name, now)).rowcount:
+        c.execute("UPDATE files SET refs=refs+1 WHERE sha256=?", (sha256,))
+    return c.execute("SELECT ext FROM files WHERE sha256=?", (sha256,)).fetchone()[0]
+
+def chat_files(c, uid, chat_id) -> list[list]:
+    return [list(r) for r in c.execute("SELECT sha256, name, created_at FROM file_refs WHERE user_id=? AND chat_id=?",
+                                       (uid, chat_id))]
+
+def unlink_chat(c, uid, chat_id) -> int:
+    """
+    Снимает ссылки диалога на файлы (диалог ушёл в архив). Возвращает, сколько снято.
+    """
+    c.execute("""UPDATE files SET refs=refs-1 WHERE sha256 IN
+        (SELECT sha256 FROM file_refs WHERE user_id=? AND chat_id=?)""", (uid, chat_id))
+    return c.execute("DELETE FROM file_refs WHERE user_id=? AND chat_id=?", (uid, chat_id)).rowcount
+
+def relink_chat(c, uid, chat_id, refs) -> int:
+    """
+    Возвращает ссылки восстановленного диалога на те файлы, что ещё в хранилище.
+    """
+    n = 0
+    for sha256, name, created_at in refs:
+        if c.execute("""INSERT OR IGNORE INTO file_refs(sha256, user_id, chat_id, name, created_at)
+                SELECT ?,?,?,?,? WHERE EXISTS (SELECT 1 FROM files WHERE sha256=?)""",
+                     (sha256, uid, chat_id, name, created_at, sha256)).rowcount:
+            c.execute("UPDATE files SET refs=refs+1 WHERE sha256=?", (sha256,))
+            n += 1
+    return n
+
+def file_evict(c, max_bytes, min_last_used) -> list[tuple[str, str]]:
+    """
+    Всё, что не влезает в max_bytes, начиная с давно не использованного. Файлы, на
+    которые ссылаются живые диалоги (refs > 0), не вытесняются и занимают бюджет
+    первыми. Файлы, тронутые после min_last_used, не трогаем — их может сейчас
+    читать обработчик.
+    """
+    rows = c.execute("""SELECT sha256, ext FROM (SELECT sha256, ext, last_used, refs,
+            SUM(size) OVER (ORDER BY refs > 0 DESC, last_used DESC, sha256) AS acc FROM files)
+        WHERE refs = 0 AND acc > ? AND last_used < ?""", (max_bytes, min_last_used)).fetchall()
+    for table in ("files", "file_ids", "file_refs"):
+        c.executemany(f"DELETE FROM {table} WHERE sha256=?", ((sha,) for sha, _ in rows))
+    return rows
+
+def file_forget(c, sha256):
+    for table in ("files", "file_ids", "file_refs"):
+        c.execute(f"DELETE FROM {table} WHERE sha256=?", (sha256,))
+
+def file_stats(c) -> tuple[int, int, int, int]:
+    return c.execute("""SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs), 0),
+        COALESCE(SUM(CASE WHEN refs > 0 THEN size END), 0) FROM files""").fetchone()
+
+
+class FileStore:
+    """
+    fetch() отдаёт Downloaded(path, size, sha256, ext) для вложения: из хранилища, если
+    такой file_unique_id уже видели, иначе скачивает во временный файл и атомарно
+    переименовывает в путь по хэшу. Размер хранилища ограничен max_bytes: вытесняются
+    давно не использованные (LRU) файлы без ссылок из живых диалогов, проверка — раз
+    в evict_every новых файлов. Ссылки архивных диалогов снимаются (unlink_chat) и
+    возвращаются при восстановлении (relink_chat).
+    """
+
+    def __init__(self, storage: Storage, directory: str, max_bytes: int,
+                 evict_every: int = 20, grace: int = 3600):
+        self.storage = storage
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.grace = grace
+        self.tmp_dir = os.path.join(directory, "tmp")
+        self.reused = 0
+        self.downloaded = 0
+        self.evicted = 0
+        self._added = 0
+
+    def path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256 + ext)
+
+    async def fetch(self, bot: Bot, file_id: str, unique_id: str | None, file_size: int | None,
+                    max_bytes: int, uid: int, chat_id: int, name: str, prefix: str = "file") -> Downloaded:
+        now = int(time.time())
+        row = await self.storage.run(file_lookup, unique_id, now) if unique_id else None
+        if row:
+            sha, ext, size = row
+            path = self.path(sha, ext)
+            if os.path.exists(path):
+                await self.storage.run(link, sha, uid, chat_id, name, now)
+                self.reused += 1
+                return Downloaded(path, size, sha, ext)
+            # файл удалили мимо базы (или вытеснил другой процесс) — забываем и качаем заново
+            await self.storage.run(file_forget, sha)
+
+        dl = await download(bot, file_id, file_size, self.tmp_dir, prefix, max_bytes)
+        self.downloaded += 1
+        try:
+            ext = await self.storage.run(file_add, dl.sha256, dl.ext, dl.size, unique_id, uid, chat_id, name, now)
+            path = self.path(dl.sha256, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # rename в пределах одного диска атомарен: читатель видит либо старый файл, либо новый целиком
+            os.replace(dl.path, path)
+        except BaseException:
+            if os.path.exists(dl.path):
+                os.unlink(dl.path)
+            raise
+        self._added += 1
+        if self._added % self.evict_every == 0:
+            await self.evict()
+        return Downloaded(path, dl.size, dl.sha256, ext)
+
+    def _remove(self, rows: list[tuple[str, str]]):
+        for sha, ext in rows:
+            try:
+                os.unlink(self.path(sha, ext))
+            except FileNotFoundError:
+                pass
+        # недокачанное после падения процесса
+        for tmp in glob.glob(os.path.join(self.tmp_dir, "*.part")):
+            try:
+                if os.path.getmtime(tmp) < time.time() - self.grace:
+                    os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+
+    async def chat_files(self, uid: int, chat_id: int) -> list[list]:
+        return await self.storage.run(chat_files, uid, chat_id)
+
+    async def unlink_chat(self, uid: int, chat_id: int) -> int:
+        return await self.storage.run(unlink_chat, uid, chat_id)
+
+    async def relink_chat(self, uid: int, chat_id: int, refs: list) -> int:
+        return await self.storage.run(relink_chat, uid, chat_id, refs) if refs else 0
+
+    async def evict(self):
+        rows = await self.storage.run(file_evict, self.max_bytes, int(time.time()) - self.grace)
+        await asyncio.to_thread(self._remove, rows)
+        self.evicted += len(rows)
+
+    async def stats(self) -> dict:
+        files, size, refs, pinned = await self.storage.run(file_stats)
+        return {"files": files, "bytes": size, "refs": refs, "pinned": pinned,
+                "reused": self.reused, "downloaded": self.downloaded, "evicted": self.evicted}
@@ -0,0 +1,67 @@
+import re
+
+HEADER_RE = re.compile(r"^(#{1,6})\s+(.+)$")  # # .. ## .. ###### ..
+
+
+def _format_line(line: str, in_code: bool) -> tuple[str, bool]:
+    """
+    Форматирует одну строку. Возвращает (строка, in_code после неё).
+    """
+    stripped = line.strip()
+    # переключаемся, если встретили границу кода ``` (любой язык)
+    if stripped.startswith("```"):
+        return line, not in_code
+
+    if not in_code:
+        m = HEADER_RE.match(line)
+        if m:
+            # берём текст заголовка и делаем жирным
+            title = m.group(2).strip()
+            return f"**{title}**", in_code
+
+    return line, in_code
+
+
+def format_answer(text: str) -> str:
+    out = []
+    in_code = False
+    for line in text.splitlines():
+        line, in_code = _format_line(line, in_code)
+        out.append(line)
+    return "\n".join(out)
+
+
+class AnswerFormatter:
+    """
+    Инкрементальный format_answer для потоковых ответов: куски приходят как угодно
+    порезанными, поэтому строку форматируем только когда она закончилась,
+    а состояние ``` (внутри кода или нет) переносим между кусками.
+    """
+
+    def __init__(self):
+        self.in_code = False
+        self._done: list[str] = []
+        self._tail = ""
+
+    def feed(self, chunk: str):
+        self._tail += chunk
+        *lines, self._tail = self._tail.split("\n")
+        for line in lines:
+            line, self.in_code = _format_line(line, self.in_code)
+            self._done.append(line)
+
+    @property
+    def text(self) -> str:
+        """
+        Текущий вид ответа: готовые строки + недописанная строка как есть.
+        """
+        if not self._tail:
+            return "\n".join(self._done)
+        return "\n".join(self._done + [self._tail])
+
+    def finish(self) -> str:
+        if self._tail:
+            line, self.in_code = _format_line(self._tail, self.in_code)
+            self._done.append(line)
+            self._tail = ""
+        return "\n".join(self._done)
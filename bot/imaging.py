@@ -0,0 +1,84 @@
+# Предобработка изображений перед OCR: поворот по EXIF, оттенки серого, уменьшение
+# до разрешения, которое модель реально использует, и компактная перекодировка.
+# Функции выполняются в воркерах ExtractionService, не в event loop.
+import io
+import math
+import os
+
+from PIL import Image, ImageOps
+
+TILE = 512
+VISION_BASE_TOKENS = 85    # high detail у gpt-4o: 85 + 170 за каждый тайл 512x512
+VISION_TILE_TOKENS = 170
+
+
+def _fit(w: int, h: int, long_side: int, short_side: int) -> tuple[int, int]:
+    # сначала в квадрат long_side, потом короткая сторона не больше short_side
+    s = min(1.0, long_side / max(w, h))
+    s *= min(1.0, short_side / (min(w, h) * s))
+    return max(1, round(w * s)), max(1, round(h * s))
+
+def vision_tokens(w: int, h: int, long_side: int = 2048, short_side: int = 768) -> int:
+    """
+    Оценка стоимости картинки в токенах: так же, как её масштабирует сам OpenAI.
+    """
+    w, h = _fit(w, h, long_side, short_side)
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * math.ceil(w / TILE) * math.ceil(h / TILE)
+
+def _snap_to_tiles(w: int, h: int, slack: float = 0.15) -> tuple[int, int]:
+    """
+    Если сторона чуть вылезает за кратное 512, ради лишнего ряда тайлов
+    уменьшаем картинку ещё немного (не больше чем на slack).
+    """
+    best = (w, h)
+    best_tiles = math.ceil(w / TILE) * math.ceil(h / TILE)
+    for side in (w, h):
+        rem = side % TILE
+        if side > TILE and rem and rem <= side * slack:
+            s = (side - rem) / side
+            cw, ch = max(1, int(w * s)), max(1, int(h * s))
+            tiles = math.ceil(cw / TILE) * math.ceil(ch / TILE)
+            if tiles < best_tiles:
+                best, best_tiles = (cw, ch), tiles
+    return best
+
+def _encode(im: Image.Image, fmt: str, **kw) -> bytes:
+    buf = io.BytesIO()
+    im.save(buf, fmt, **kw)
+    return buf.getvalue()
+
+def prepare_vision(path: str, long_side: int = 2048, short_side: int = 768) -> tuple[bytes, str, dict]:
+    """
+    Готовит картинку для vision-запроса. Возвращает (данные, MIME, статистика).
+    Из JPEG и PNG берём что меньше: фото лучше жмёт JPEG, скриншоты — PNG.
+    """
+    bytes_before = os.path.getsize(path)
+    with Image.open(path) as src:
+        w0, h0 = src.size
+        im = ImageOps.exif_transpose(src).convert("L")
+    w, h = _snap_to_tiles(*_fit(*im.size, long_side, short_side))
+    if (w, h) != im.size:
+        im = im.resize((w, h), Image.LANCZOS)
+    jpeg = _encode(im, "JPEG", quality=85, optimize=True)
+    png = _encode(im, "PNG", optimize=True)
+    data, mime = (jpeg, "image/jpeg") if len(jpeg) <= len(png) else (png, "image/png")
+    stats = {
+        "bytes_before": bytes_before,
+        "bytes_after": len(data),
+        "size_before": (w0, h0),
+        "size_after": (w, h),
+        "tokens_before": vision_tokens(w0, h0, long_side, short_side),
+        "tokens_after": vision_tokens(w, h, long_side, short_side),
+    }
+    return data, mime, stats
+
+def prepare_ocr(im: Image.Image, max_side: int = 3500) -> Image.Image:
+    """
+    Для Tesseract: поворот и серый без потерь; слишком большие сканы уменьшаем —
+    выше ~300 dpi точность не растёт, а время растёт квадратично.
+    """
+    im = ImageOps.exif_transpose(im).convert("L")
+    if max(im.size) > max_side:
+        s = max_side / max(im.size)
+        im = im.resize((round(im.width * s), round(im.height * s)), Image.LANCZOS)
+    return im
@@ -0,0 +1,157 @@
+# База знаний: регламенты/FAQ режутся на фрагменты и индексируются в SQLite FTS5
+# по основам слов (Snowball, русский + английский), поиск — BM25 (ранжирование FTS5).
+import re
+import time
+
+from .storage import Storage
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+CYRILLIC_RE = re.compile(r"[а-я]")
+
+# частые слова, которые только раздувают запрос OR-ами и ничего не ранжируют
+STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне
+было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до
+вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя
+их чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого
+какой совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда
+можно при наконец два об другой хоть после над больше тот через эти нас про всего них какая
+много разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им
+более всегда конечно всю между это как какие каких the a an of to in on for and or is are
+""".split())
+
+_stemmers = {}
+_stem_cache: dict[str, str] = {}
+STEM_CACHE_SIZE = 200_000
+
+MAX_TERMS = 32
+COMMON_DF = 0.3  # терм в большей доле фрагментов почти не влияет на BM25, а матчит всё подряд
+
+
+def _stemmer(lang: str):
+    if lang not in _stemmers:
+        import snowballstemmer
+        _stemmers[lang] = snowballstemmer.stemmer(lang)
+    return _stemmers[lang]
+
+def _stem(word: str) -> str:
+    # словарь текста невелик, а Snowball на чистом Python медленный — запоминаем основы
+    s = _stem_cache.get(word)
+    if s is None:
+        s = _stemmer("russian" if CYRILLIC_RE.search(word) else "english").stemWord(word)
+        if len(_stem_cache) < STEM_CACHE_SIZE:
+            _stem_cache[word] = s
+    return s
+
+def stems(text: str) -> list[str]:
+    """
+    Основы слов текста: нижний регистр, ё→е, стоп-слова выброшены.
+    """
+    return [_stem(w) for w in WORD_RE.findall(text.lower().replace("ё", "е")) if w not in STOPWORDS]
+
+def passages(text: str, max_chars: int) -> list[str]:
+    """
+    Фрагменты до max_chars по границам страниц/абзацев/строк, соседние мелкие склеиваются.
+    """
+    units: list[str] = []
+
+    def cut(part: str, seps: tuple[str, ...]):
+        part = part.strip()
+        if len(part) <= max_chars:
+            if part:
+                units.append(part)
+        elif seps:
+            for p in part.split(seps[0]):
+                cut(p, seps[1:])
+        else:
+            units.extend(part[i:i + max_chars] for i in range(0, len(part), max_chars))
+
+    cut(text, ("\f", "\n\n", "\n"))
+    out, cur = [], ""
+    for u in units:
+        if cur and len(cur) + len(u) + 1 > max_chars:
+            out.append(cur)
+            cur = ""
+        cur = f"{cur}\n{u}" if cur else u
+    if cur:
+        out.append(cur)
+    return out
+
+def prepare_document(text: str, max_chars: int) -> list[tuple[str, str]]:
+    """
+    [(фрагмент, его основы через пробел)]. Выполняется в пуле процессов — на
+    больших регламентах стемминг заметно грузит CPU.
+    """
+    return [(p, " ".join(stems(p))) for p in passages(text, max_chars)]
+
+def query_terms(text: str) -> list[str]:
+    return list(dict.fromkeys(stems(text)))[:MAX_TERMS]
+
+def match_query(terms: list[str]) -> str:
+    # каждое слово в кавычках — иначе FTS5 споткнётся о ключевые слова вроде OR/NOT
+    return " OR ".join(f'"{t}"' for t in terms)
+
+
+# ===== запросы (поток хранилища) =====
+
+def kb_add(c, name, sha256, uid, items) -> int:
+    old = c.execute("SELECT id FROM kb_docs WHERE sha256=?", (sha256,)).fetchone()
+    if old:
+        kb_delete(c, old[0])
+    doc_id = c.execute("INSERT INTO kb_docs(name, sha256, added_by, passages, created_at) VALUES(?,?,?,?,?)",
+                       (name, sha256, uid, len(items), int(time.time()))).lastrowid
+    for i, (text, stemmed) in enumerate(items):
+        pid = c.execute("INSERT INTO kb_passages(doc_id, ord, text) VALUES(?,?,?)", (doc_id, i, text)).lastrowid
+        c.execute("INSERT INTO kb_fts(rowid, stems) VALUES(?,?)", (pid, stemmed))
+    return doc_id
+
+def kb_delete(c, doc_id) -> bool:
+    c.execute("DELETE FROM kb_fts WHERE rowid IN (SELECT id FROM kb_passages WHERE doc_id=?)", (doc_id,))
+    c.execute("DELETE FROM kb_passages WHERE doc_id=?", (doc_id,))
+    return c.execute("DELETE FROM kb_docs WHERE id=?", (doc_id,)).rowcount > 0
+
+def kb_search(c, terms, k):
+    # редкие термы вперёд; слишком частые выбрасываем, если осталось что-то ещё
+    total = c.execute("SELECT COALESCE(SUM(passages), 0) FROM kb_docs").fetchone()[0]
+    df = dict(c.execute(f"SELECT term, doc FROM kb_vocab WHERE term IN ({','.join('?' * len(terms))})", terms))
+    found = sorted((t for t in terms if t in df), key=df.get)
+    if not found:
+        return []
+    rare = [t for t in found if df[t] <= total * COMMON_DF] or found[:1]
+    return c.execute("""SELECT d.name, p.text, f.rank FROM
+            (SELECT rowid, rank FROM kb_fts WHERE kb_fts MATCH ? ORDER BY rank LIMIT ?) f
+        JOIN kb_passages p ON p.id = f.rowid
+        JOIN kb_docs d ON d.id = p.doc_id
+        ORDER BY f.rank""", (match_query(rare), k)).fetchall()
+
+def kb_docs(c):
+    return c.execute("SELECT id, name, passages, created_at FROM kb_docs ORDER BY id").fetchall()
+
+
+class KnowledgeBase:
+    """
+    Индекс обновляется инкрементально: документ добавляется/удаляется целиком
+    вместе со своими фрагментами; повторная загрузка того же файла заменяет старую.
+    """
+
+    def __init__(self, storage: Storage, passage_chars: int = 1200):
+        self.storage = storage
+        self.passage_chars = passage_chars
+
+    async def add(self, name: str, sha256: str, uid: int, items: list[tuple[str, str]]) -> int:
+        return await self.storage.run(kb_add, name, sha256, uid, items)
+
+    async def delete(self, doc_id: int) -> bool:
+        return await self.storage.run(kb_delete, doc_id)
+
+    async def docs(self):
+        return await self.storage.run(kb_docs)
+
+    async def search(self, text: str, k: int) -> list[tuple[str, str, float]]:
+        """
+        Топ-k фрагментов под вопрос: [(имя документа, текст, bm25)] — меньше значит ближе.
+        """
+        terms = query_terms(text)
+        if not terms:
+            return []
+        return await self.storage.run(kb_search, terms, k)
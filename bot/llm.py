@@ -0,0 +1,129 @@
+# Асинхронный слой над OpenAI: общий лимит одновременных запросов,
+# таймауты на вызов и повторы с backoff на 429/5xx/сетевых ошибках.
+# Пакет openai тяжёлый на импорт — клиент создаётся при первом запросе.
+import asyncio
+import random
+import time
+
+from . import metrics
+
+
+def _retryable(e: Exception) -> bool:
+    from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+    if isinstance(e, (RateLimitError, APITimeoutError, APIConnectionError)):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
+
+
+def _retry_after(e: Exception) -> float | None:
+    resp = getattr(e, "response", None)
+    if resp is None:
+        return None
+    try:
+        return float(resp.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLM:
+    """
+    Обёртка над AsyncOpenAI. Семафор ограничивает число запросов "в полёте"
+    на весь процесс; пауза между повторами слот не занимает.
+    """
+
+    def __init__(self, api_key: str | None, model: str, max_concurrency: int = 8,
+                 timeout: float = 60.0, max_retries: int = 3, backoff_base: float = 1.0,
+                 base_url: str | None = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
+        self.model = model
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.sem = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import AsyncOpenAI
+            # встроенные ретраи клиента выключены — повторяем сами, см. complete()
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                       timeout=self.timeout, max_retries=0)
+        return self._client
+
+    def _backoff(self, attempt: int, e: Exception) -> float:
+        hint = _retry_after(e)
+        if hint is not None:
+            return min(hint, 60.0)
+        # экспоненциально с джиттером: 1, 2, 4... секунды * [0.5; 1.5)
+        return self.backoff_base * (2 ** attempt) * (0.5 + random.random())
+
+    async def complete(self, messages: list[dict], model: str | None = None,
+                       timeout: float | None = None, **kwargs):
+        """
+        chat.completions.create с лимитом параллельности, таймаутом и повторами.
+        """
+        attempt = 0
+        while True:
+            try:
+                async with self.sem:
+                    with metrics.span("openai.complete"):
+                        resp = await self.client.chat.completions.create(
+                            model=model or self.model,
+                            messages=messages,
+                            timeout=timeout or self.timeout,
+                            **kwargs,
+                        )
+                metrics.usage(resp.usage)
+                return resp
+            except Exception as e:
+                if attempt >= self.max_retries or not _retryable(e):
+                    raise
+                metrics.OPENAI_RETRIES.inc(type(e).__name__)
+                await asyncio.sleep(self._backoff(attempt, e))
+                attempt += 1
+
+    async def stream(self, messages: list[dict], model: str | None = None,
+                     timeout: float | None = None, **kwargs):
+        """
+        Потоковый вариант complete(): отдаёт ChatCompletionChunk по мере генерации.
+        Последний чанк (с пустым choices) несёт usage. Повторяем только если
+        упали до первого чанка — дальше пользователь уже видит часть ответа.
+        """
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async with self.sem:
+                    t0 = time.perf_counter()
+                    resp = await self.client.chat.completions.create(
+                        model=model or self.model,
+                        messages=messages,
+                        timeout=timeout or self.timeout,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        **kwargs,
+                    )
+                    async for chunk in resp:
+                        if not started:
+                            metrics.STAGE.observe(time.perf_counter() - t0, "openai.ttft")
+                        started = True
+                        if chunk.usage:
+                            metrics.usage(chunk.usage)
+                        yield chunk
+                metrics.STAGE.observe(time.perf_counter() - t0, "openai.stream")
+                return
+            except Exception as e:
+                if started or attempt >= self.max_retries or not _retryable(e):
+                    metrics.error("openai.stream", e)
+                    raise
+                metrics.OPENAI_RETRIES.inc(type(e).__name__)
+                await asyncio.sleep(self._backoff(attempt, e))
+                attempt += 1
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
@@ -0,0 +1,206 @@
+# Метрики без внешних зависимостей: счётчики, гистограммы длительностей по этапам
+# и задержка event loop. Отдаются в формате Prometheus (serve) и сводкой для /stats.
+# Всё пишется из потока event loop: span() — пара perf_counter и bisect, можно
+# держать включённым в проде.
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+        return out
+
+
+class Gauge:
+    """
+    Значение задаётся set() или считается при выдаче функцией fn.
+    """
+
+    def __init__(self, name: str, help: str, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.fn() if self.fn else self.value
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.get()}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labels
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}  # метки -> [счётчики по корзинам..., +Inf, сумма]
+
+    def observe(self, value: float, *labels):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def count(self, labels: tuple) -> int:
+        return sum(self.series[labels][:-1])
+
+    def quantile(self, q: float, labels: tuple) -> float:
+        """
+        Оценка квантиля по корзинам (линейно внутри корзины), как histogram_quantile.
+        """
+        s = self.series[labels]
+        rank = q * self.count(labels)
+        acc = 0
+        for i, n in enumerate(s[:-1]):
+            if acc + n >= rank and n:
+                lo = self.buckets[i - 1] if i else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - acc) / n
+            acc += n
+        return 0.0
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for labels, s in self.series.items():
+            acc = 0
+            for b, n in zip(self.buckets + ("+Inf",), s[:-1]):
+                acc += n
+                out.append(f"{self.name}_bucket{_labels(names, labels + (b,))} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {s[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {acc}")
+        return out
+
+
+# ===== метрики бота =====
+
+STAGE = Histogram("bot_stage_seconds", "Длительность этапов обработки", ("stage",))
+ERRORS = Counter("bot_errors_total", "Ошибки по этапам и типам", ("stage", "type"))
+TOKENS = Counter("bot_tokens_total", "Токены OpenAI по usage", ("kind",))
+OPENAI_RETRIES = Counter("bot_openai_retries_total", "Повторы запросов к OpenAI", ("type",))
+CACHE = Counter("bot_cache_requests_total", "Обращения к кэшу извлечения", ("engine", "result"))
+UPDATES = Counter("bot_updates_total", "Входящие апдейты по типу", ("kind",))
+LOOP_LAG = Gauge("bot_event_loop_lag_seconds", "Последняя измеренная задержка event loop")
+LOOP_LAG_HIST = Histogram("bot_event_loop_lag_hist_seconds", "Распределение задержки event loop",
+                          buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+STARTED = time.time()
+UPTIME = Gauge("bot_uptime_seconds", "Время с запуска процесса", fn=lambda: time.time() - STARTED)
+
+REGISTRY: list = [STAGE, ERRORS, TOKENS, OPENAI_RETRIES, CACHE, UPDATES, LOOP_LAG, LOOP_LAG_HIST, UPTIME]
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def error(stage: str, e: BaseException):
+    ERRORS.inc(stage, type(e).__name__)
+
+
+@contextmanager
+def span(stage: str):
+    """
+    with span("doc.download"): ... — длительность в bot_stage_seconds{stage},
+    исключение — в bot_errors_total{stage, type} (и летит дальше).
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if not isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+            error(stage, e)
+        raise
+    finally:
+        STAGE.observe(time.perf_counter() - t0, stage)
+
+
+def usage(resp_usage):
+    if resp_usage:
+        TOKENS.inc("prompt", n=resp_usage.prompt_tokens)
+        TOKENS.inc("completion", n=resp_usage.completion_tokens)
+
+
+def render() -> str:
+    lines = []
+    for m in REGISTRY:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+
+class LoopLagMonitor:
+    """
+    Раз в interval секунд засыпает и смотрит, насколько позже проснулась.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.max = 0.0
+        self._task: asyncio.Task | None = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - t - self.interval)
+            LOOP_LAG.set(lag)
+            LOOP_LAG_HIST.observe(lag)
+            self.max = max(self.max, lag)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def handle(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("metrics on %s:%d/metrics", host, port)
+    return runner
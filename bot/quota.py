@@ -0,0 +1,148 @@
+# Суточные квоты токенов в памяти: can_spend/reserve не ходят в БД,
+# приращения копятся и сбрасываются в quotas пачкой (по таймеру, по объёму и при остановке).
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+from . import metrics
+from .storage import Storage
+
+log = logging.getLogger(__name__)
+
+
+def today() -> str:
+    return time.strftime("%Y%m%d")
+
+
+@dataclass
+class Reservation:
+    uid: int
+    day: str
+    amount: int
+    settled: bool = False
+
+
+class QuotaLedger:
+    """
+    Счётчики used/reserved на (user_id, день). Перед запросом к модели резервируем
+    оценку, после — settle() с фактическим расходом. Параллельные запросы одного
+    пользователя видят резервы друг друга, поэтому вместе не пробьют лимит.
+    """
+
+    def __init__(self, storage: Storage, daily_limit: int,
+                 flush_interval: float = 5.0, flush_threshold: int = 200):
+        # flush_threshold — сколько пользователей с несброшенным расходом копим до внеочередного сброса
+        self.storage = storage
+        self.daily_limit = daily_limit
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._used: dict[tuple[int, str], int] = {}      # из БД + ещё не сброшенное
+        self._reserved: dict[tuple[int, str], int] = {}
+        self._pending: dict[tuple[int, str], int] = {}   # ещё не записано в quotas
+        self._load_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def _load(self, key: tuple[int, str]) -> int:
+        if key not in self._used:
+            async with self._load_lock:
+                if key not in self._used:
+                    self._used[key] = await self.storage.used_tokens(*key)
+        return self._used[key]
+
+    async def used(self, uid: int) -> int:
+        return await self._load((uid, today()))
+
+    async def can_spend(self, uid: int, tokens: int) -> bool:
+        key = (uid, today())
+        return await self._load(key) + self._reserved.get(key, 0) + tokens <= self.daily_limit
+
+    async def reserve(self, uid: int, tokens: int) -> Reservation | None:
+        """
+        Резервирует tokens из лимита. None — лимит исчерпан.
+        """
+        key = (uid, today())
+        if await self._load(key) + self._reserved.get(key, 0) + tokens > self.daily_limit:
+            return None
+        self._reserved[key] = self._reserved.get(key, 0) + tokens
+        return Reservation(uid, key[1], tokens)
+
+    def settle(self, res: Reservation, actual: int):
+        """
+        Снимает резерв и списывает фактический расход. Повторный вызов ничего не делает.
+        """
+        if res.settled:
+            return
+        res.settled = True
+        key = (res.uid, res.day)
+        left = self._reserved.get(key, 0) - res.amount
+        if left > 0:
+            self._reserved[key] = left
+        else:
+            self._reserved.pop(key, None)
+        self._charge(key, actual)
+
+    def release(self, res: Reservation):
+        self.settle(res, 0)
+
+    async def charge(self, uid: int, tokens: int):
+        """
+        Списание без резерва (например, конспект истории уже потрачен).
+        """
+        key = (uid, today())
+        await self._load(key)
+        self._charge(key, tokens)
+
+    def _charge(self, key: tuple[int, str], tokens: int):
+        if tokens <= 0:
+            return
+        # ключ загружен заранее: в reserve() или charge()
+        self._used[key] = self._used.get(key, 0) + tokens
+        self._pending[key] = self._pending.get(key, 0) + tokens
+        if len(self._pending) >= self.flush_threshold:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await self.storage.add_tokens_batch([(uid, day, n) for (uid, day), n in batch.items()])
+            except Exception:
+                # вернём обратно, попробуем в следующий раз
+                for key, n in batch.items():
+                    self._pending[key] = self._pending.get(key, 0) + n
+                raise
+            # вчерашние счётчики больше не нужны
+            day = today()
+            for key in [k for k in self._used if k[1] != day and k not in self._reserved]:
+                del self._used[key]
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                metrics.error("quota.flush", e)
+                log.exception("quota flush failed")
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
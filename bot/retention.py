@@ -0,0 +1,243 @@
+# Обслуживание базы: давно не открывавшиеся диалоги уезжают в сжатый архив
+# пользователя (gzip JSONL, по строке на диалог), старые суточные квоты удаляются,
+# освободившиеся страницы возвращаются incremental vacuum'ом. Архивный диалог
+# восстанавливается обратно в messages при /use.
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+import weakref
+
+from . import metrics
+from .filestore import FileStore
+from .storage import Storage
+
+log = logging.getLogger(__name__)
+
+
+def idle_chats(c, before, limit) -> list[tuple[int, int, int]]:
+    """
+    [(user_id, chat_id, updated_at)] неактивных диалогов, к которым не обращались с before.
+    """
+    return c.execute("""SELECT s.user_id, s.chat_id, s.updated_at FROM sessions s
+        WHERE s.archived=0 AND s.updated_at < ? AND s.message_count > 0
+          AND s.chat_id IS NOT (SELECT chat_id FROM active_chat a WHERE a.user_id=s.user_id)
+        ORDER BY s.updated_at LIMIT ?""", (before, limit)).fetchall()
+
+def dump_chat(c, uid, chat_id) -> dict:
+    row = c.execute("SELECT upto_id, content, updated_at FROM summaries WHERE user_id=? AND chat_id=?",
+                    (uid, chat_id)).fetchone()
+    msgs = c.execute("SELECT id, role, content, created_at FROM messages WHERE user_id=? AND chat_id=? ORDER BY id",
+                     (uid, chat_id)).fetchall()
+    return {"chat_id": chat_id, "summary": list(row) if row else None, "messages": [list(m) for m in msgs]}
+
+def drop_chat(c, uid, chat_id, updated_at) -> bool:
+    """
+    Удаляет сообщения выгруженного диалога, если за время выгрузки в него ничего
+    не написали и его не сделали активным. Иначе диалог остаётся как был.
+    """
+    ok = c.execute("""UPDATE sessions SET archived=1 WHERE user_id=? AND chat_id=? AND updated_at=? AND archived=0
+        AND chat_id IS NOT (SELECT chat_id FROM active_chat WHERE user_id=?)""",
+        (uid, chat_id, updated_at, uid)).rowcount
+    if ok:
+        c.execute("DELETE FROM messages WHERE user_id=? AND chat_id=?", (uid, chat_id))
+        c.execute("DELETE FROM summaries WHERE user_id=? AND chat_id=?", (uid, chat_id))
+    return bool(ok)
+
+def is_archived(c, uid, chat_id) -> bool:
+    row = c.execute("SELECT archived FROM sessions WHERE user_id=? AND chat_id=?", (uid, chat_id)).fetchone()
+    return bool(row and row[0])
+
+def load_chat(c, uid, record) -> bool:
+    """
+    Возвращает диалог из архивной записи. id сообщений выдаются заново (после
+    перераскладки шардов старые могут быть заняты), upto_id конспекта — по ним же.
+    """
+    chat_id = record["chat_id"]
+    if not is_archived(c, uid, chat_id):
+        return False
+    new_ids = []
+    for old_id, role, content, created_at in record["messages"]:
+        cur = c.execute("INSERT INTO messages(user_id, chat_id, role, content, created_at) VALUES(?,?,?,?,?)",
+                        (uid, chat_id, role, content, created_at))
+        new_ids.append((old_id, cur.lastrowid))
+    if record["summary"]:
+        upto, content, updated_at = record["summary"]
+        upto_new = max((new for old, new in new_ids if old <= upto), default=0)
+        c.execute("INSERT OR REPLACE INTO summaries(user_id, chat_id, upto_id, content, updated_at) VALUES(?,?,?,?,?)",
+                  (uid, chat_id, upto_new, content, updated_at))
+    c.execute("UPDATE sessions SET archived=0 WHERE user_id=? AND chat_id=?", (uid, chat_id))
+    return True
+
+def prune_quotas(c, before_day) -> int:
+    return c.execute("DELETE FROM quotas WHERE yyyymmdd < ?", (before_day,)).rowcount
+
+def incremental_mode(c) -> bool:
+    return c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+def incremental_vacuum(c, pages) -> int:
+    """
+    Отдаёт системе до pages свободных страниц. На базе без auto_vacuum=INCREMENTAL ничего не делает.
+    """
+    if not incremental_mode(c):
+        return 0
+    # модуль sqlite3 делает один шаг прагмы, а шаг освобождает одну страницу — поэтому цикл
+    before = c.execute("PRAGMA freelist_count").fetchone()[0]
+    for _ in range(min(pages, before)):
+        c.execute("PRAGMA incremental_vacuum(1)")
+    return before - c.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+class Retention:
+    """
+    Фоновая задача раз в interval секунд. Архив пользователя — archive_dir/<user_id>.jsonl.gz:
+    каждая выгрузка дописывается отдельным gzip-членом, при повторе записи одного
+    диалога верна последняя. Файл пишется до удаления из базы, поэтому сбой
+    посередине оставляет лишнюю запись в архиве, но не теряет сообщений.
+    files — хранилище вложений: ссылки диалога на файлы уезжают в ту же запись
+    архива и снимаются, чтобы файлы архивных диалогов могли вытесняться.
+    """
+
+    def __init__(self, storage: Storage, archive_dir: str, idle_days: int, quota_days: int,
+                 interval: float = 3600, batch: int = 200, vacuum_pages: int = 2000,
+                 files: FileStore | None = None):
+        self.storage = storage
+        self.files = files
+        self.archive_dir = archive_dir
+        self.idle_days = idle_days        # 0 — диалоги не архивируются
+        self.quota_days = quota_days      # 0 — квоты не чистятся
+        self.interval = interval
+        self.batch = batch
+        self.vacuum_pages = vacuum_pages
+        self.archived = 0
+        self.restored = 0
+        self.pruned = 0
+        self.vacuumed = 0
+        # выгрузка и восстановление диалогов одного пользователя не пересекаются
+        self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        self._task: asyncio.Task | None = None
+        self._warned = False
+
+    def path(self, uid: int) -> str:
+        return os.path.join(self.archive_dir, f"{uid}.jsonl.gz")
+
+    def _lock(self, uid: int) -> asyncio.Lock:
+        lock = self._locks.get(uid)
+        if lock is None:
+            lock = self._locks[uid] = asyncio.Lock()
+        return lock
+
+    def _append(self, uid: int, record: dict):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        data = gzip.compress((json.dumps(record, ensure_ascii=False) + "\n").encode(), compresslevel=6)
+        with open(self.path(uid), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _take(self, uid: int, chat_id: int) -> dict | None:
+        """
+        Последняя запись диалога из архива (None — нет такой).
+        """
+        path = self.path(uid)
+        if not os.path.exists(path):
+            return None
+        found = None
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec["chat_id"] == chat_id:
+                    found = rec
+        return found
+
+    def _forget(self, uid: int, chat_id: int):
+        """
+        Переписывает архив без записей диалога (через временный файл и rename).
+        """
+        path = self.path(uid)
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            keep = [line for line in f if json.loads(line)["chat_id"] != chat_id]
+        if not keep:
+            os.remove(path)
+            return
+        tmp = path + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.writelines(keep)
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    async def archive(self, uid: int, chat_id: int, updated_at: int) -> bool:
+        async with self._lock(uid):
+            record = await self.storage.run(dump_chat, uid, chat_id)
+            record["archived_at"] = int(time.time())
+            if self.files:
+                record["files"] = await self.files.chat_files(uid, chat_id)
+            await asyncio.to_thread(self._append, uid, record)
+            if not await self.storage.run(drop_chat, uid, chat_id, updated_at):
+                return False  # диалог ожил — запись в архиве останется лишней, при восстановлении не нужна
+            if self.files:
+                await self.files.unlink_chat(uid, chat_id)
+        self.archived += 1
+        return True
+
+    async def restore(self, uid: int, chat_id: int) -> bool:
+        """
+        Если диалог в архиве — возвращает его в базу. True, если что-то восстановили.
+        """
+        if not await self.storage.run(is_archived, uid, chat_id):
+            return False
+        async with self._lock(uid):
+            with metrics.span("retention.restore"):
+                record = await asyncio.to_thread(self._take, uid, chat_id)
+                if record is None:
+                    log.error("chat %s/%s is marked archived but missing in %s", uid, chat_id, self.path(uid))
+                    record = {"chat_id": chat_id, "summary": None, "messages": []}
+                if not await self.storage.run(load_chat, uid, record):
+                    return False
+                if self.files:
+                    await self.files.relink_chat(uid, chat_id, record.get("files", []))
+                if record["messages"]:
+                    await asyncio.to_thread(self._forget, uid, chat_id)
+        self.restored += 1
+        return True
+
+    async def run_once(self):
+        now = int(time.time())
+        if self.idle_days:
+            with metrics.span("retention.archive"):
+                for uid, chat_id, updated_at in await self.storage.run(
+                        idle_chats, now - self.idle_days * 86400, self.batch):
+                    await self.archive(uid, chat_id, updated_at)
+        if self.quota_days:
+            day = time.strftime("%Y%m%d", time.localtime(now - self.quota_days * 86400))
+            self.pruned += await self.storage.run(prune_quotas, day)
+        if self.vacuum_pages:
+            with metrics.span("retention.vacuum"):
+                freed = await self.storage.run(incremental_vacuum, self.vacuum_pages)
+            self.vacuumed += freed
+            if not freed and not self._warned and not await self.storage.run(incremental_mode):
+                self._warned = True
+                log.warning("%s was created without auto_vacuum=INCREMENTAL; to convert it run once "
+                            "with the bot stopped: sqlite3 %s 'PRAGMA auto_vacuum=INCREMENTAL; VACUUM;'",
+                            self.storage.path, self.storage.path)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                metrics.error("retention", e)
+                log.exception("retention pass failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,128 @@
+# Планировщик ходов диалога между хендлерами aiogram и моделью: сообщения одного
+# пользователя обрабатываются строго по очереди, пачка сообщений за короткое окно
+# склеивается в один ход, пользователи обслуживаются по кругу под общим лимитом.
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+Key = tuple[int, Hashable]  # (user_id, chat_id)
+
+
+class Scheduler:
+    """
+    submit() кладёт сообщение в очередь пользователя и сразу возвращается.
+    Первое сообщение взводит таймер на window секунд — всё, что пришло за это
+    время (и пока идёт предыдущий ход), уходит в handler(key, items) одним ходом.
+    Пользователь стоит в общей очереди не больше одного раза, поэтому у каждого
+    не больше одного хода одновременно, а после хода он встаёт в конец — честная
+    очередь по кругу. Одновременно идёт не больше concurrency ходов.
+    Очередь ограничена: max_pending на пользователя и max_total на всех,
+    сверх этого submit() возвращает False — вызывающий отвечает «занят».
+    """
+
+    def __init__(self, handler: Callable[[Key, list[Any]], Awaitable[None]], concurrency: int = 8,
+                 window: float = 1.0, max_pending: int = 5, max_total: int = 500, name: str = "turn"):
+        self.handler = handler
+        self.name = name  # префикс этапов в метриках: <name>.wait, <name>.turn
+        self.concurrency = concurrency
+        self.window = window
+        self.max_pending = max_pending
+        self.max_total = max_total
+        self._pending: dict[int, dict[Key, list]] = {}  # uid -> {(uid, chat_id): [сообщения]}
+        self._since: dict[Key, float] = {}             # когда пришло первое ещё не взятое сообщение
+        self._active: set[int] = set()                  # ждут окна, стоят в очереди или выполняются
+        self._ready: asyncio.Queue[int] = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers: list[asyncio.Task] = []
+        self.queued = 0
+        self.running = 0
+        self.turns = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    def submit(self, key: Key, item: Any) -> bool:
+        uid = key[0]
+        # словарь пользователя не трогаем при отказе: идущий ход может держать его у себя
+        user = self._pending.get(uid, {})
+        if sum(map(len, user.values())) >= self.max_pending or self.queued >= self.max_total:
+            self.rejected += 1
+            return False
+        user = self._pending.setdefault(uid, user)
+        if key not in user:
+            user[key] = []
+            self._since[key] = time.perf_counter()
+        user[key].append(item)
+        self.queued += 1
+        self._idle.clear()
+        if uid not in self._active:
+            self._active.add(uid)
+            asyncio.get_running_loop().call_later(self.window, self._ready.put_nowait, uid)
+        return True
+
+    async def _worker(self):
+        while True:
+            uid = await self._ready.get()
+            try:
+                await self._turn(uid)
+            except Exception as e:
+                # сбой в учёте не должен убить воркер — иначе concurrency тихо уменьшается,
+                # а пользователь навсегда остаётся «активным»
+                metrics.error(self.name + ".worker", e)
+                log.exception("scheduler bookkeeping failed for user %s", uid)
+                self._release(uid, drop=True)
+
+    def _release(self, uid: int, drop: bool = False):
+        user = self._pending.pop(uid, None) or {}
+        if drop:
+            for key, items in user.items():
+                self.queued -= len(items)
+                self._since.pop(key, None)
+        self._active.discard(uid)
+        if not self._active:
+            self._idle.set()
+
+    async def _turn(self, uid: int):
+        user = self._pending[uid]
+        # диалоги пользователя тоже по кругу: взятый ключ уходит из начала словаря
+        key = next(iter(user))
+        items = user.pop(key)
+        metrics.STAGE.observe(time.perf_counter() - self._since.pop(key), self.name + ".wait")
+        self.queued -= len(items)
+        self.running += 1
+        self.turns += 1
+        self.coalesced += len(items) - 1
+        try:
+            with metrics.span(self.name + ".turn"):
+                await self.handler(key, items)
+        except Exception:
+            log.exception("turn failed for %s", key)
+        finally:
+            self.running -= 1
+        if user:
+            # пришедшее за время хода уже склеено, окно ждать не нужно
+            self._ready.put_nowait(uid)
+        else:
+            self._release(uid)
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout: float = 0):
+        """
+        Ждёт до timeout секунд, пока очередь разберётся, затем останавливает воркеры.
+        """
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                log.warning("scheduler stopped with %d queued, %d running", self.queued, self.running)
+        for t in self._workers:
+            t.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
@@ -0,0 +1,304 @@
+# Многопроцессный режим: фронт принимает вебхук Telegram и раскладывает апдейты
+# по N воркерам (обычный bot.bot в режиме webhook) по консистентному хэшу user_id.
+# Всё состояние пользователя — история, квоты, очередь ходов — живёт в одном
+# воркере и в его шарде БД; база знаний общая (KB_DB_PATH).
+#
+#   SHARD_WORKERS=4 WEBHOOK_URL=https://... WEBHOOK_SECRET=... python -m bot.shard
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+
+import aiohttp
+from aiohttp import web
+
+from .webhook import SECRET_HEADER
+
+log = logging.getLogger(__name__)
+
+# ===== ENV =====
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+DB_PATH = os.getenv("BOT_DB_PATH", "/data/bot.sqlite")
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1)))
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8100"))       # воркер i слушает 127.0.0.1:BASE+i
+SHARD_QUEUE = int(os.getenv("SHARD_QUEUE", "1000"))               # апдейтов в очереди на воркер
+SHARD_STOP_TIMEOUT = float(os.getenv("SHARD_STOP_TIMEOUT", "120"))
+SHARD_MAX_RETRIES = int(os.getenv("SHARD_MAX_RETRIES", "5"))      # воркер ответил не 200 столько раз — апдейт выбрасываем
+SHARD_RETRY_TIMEOUT = float(os.getenv("SHARD_RETRY_TIMEOUT", "120"))  # и недоступен дольше этого (не поднялся после падения)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))                # воркер i отдаёт /metrics на METRICS_PORT+i
+
+
+def _hash(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Консистентный хэш с виртуальными узлами: при переходе с N на N+1 шардов
+    переезжает примерно 1/(N+1) пользователей, остальные остаются на месте.
+    """
+
+    def __init__(self, shards: int, vnodes: int = 128):
+        points = sorted((_hash(f"shard-{i}-{v}"), i) for i in range(shards) for v in range(vnodes))
+        self._keys = [p for p, _ in points]
+        self._shards = [s for _, s in points]
+
+    def shard(self, user_id: int) -> int:
+        i = bisect.bisect(self._keys, _hash(str(user_id)))
+        return self._shards[i % len(self._keys)]
+
+
+def shard_path(path: str, shard: int) -> str:
+    """
+    /data/bot.sqlite -> /data/bot.shard2.sqlite
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+
+def update_user(update: dict) -> int:
+    """
+    Кто прислал апдейт: from/user объекта апдейта, иначе чат; 0 — неизвестно.
+    """
+    for key, obj in update.items():
+        if key == "update_id" or not isinstance(obj, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            if isinstance(obj.get(field), dict) and "id" in obj[field]:
+                return obj[field]["id"]
+    return 0
+
+
+class Worker:
+    """
+    Процесс python -m bot.bot со своим шардом БД и портом. Апдейты уходят ему
+    строго по одному и по порядку; если процесс упал — перезапускаем, а
+    очередь ждёт. Апдейт, который воркер не принял за max_retries ответов или
+    за retry_timeout секунд недоступности, выбрасывается, чтобы не встала вся очередь.
+    """
+
+    def __init__(self, index: int, shards: int, secret: str, queue_size: int):
+        self.index = index
+        self.port = SHARD_BASE_PORT + index
+        self.url = f"http://127.0.0.1:{self.port}/webhook"
+        self.secret = secret
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(queue_size)
+        self.proc: asyncio.subprocess.Process | None = None
+        self.max_retries = SHARD_MAX_RETRIES
+        self.retry_timeout = SHARD_RETRY_TIMEOUT
+        self.forwarder: asyncio.Task | None = None
+        self.forwarded = 0
+        self.dropped = 0
+        self.restarts = 0
+        self.env = dict(
+            os.environ,
+            BOT_MODE="webhook",
+            BOT_SHARD=f"{index}/{shards}",
+            BOT_DB_PATH=shard_path(DB_PATH, index),
+            KB_DB_PATH=os.getenv("KB_DB_PATH", DB_PATH),
+            WEBHOOK_URL="",  # регистрирует фронт
+            WEBHOOK_PATH="/webhook",
+            WEBHOOK_SECRET=secret,
+            WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(self.port),
+            WEBHOOK_RECORD="",
+            # у каждого воркера свои метрики: METRICS_PORT+i
+            METRICS_PORT=str(METRICS_PORT + index if METRICS_PORT else 0),
+            # процессы извлечения делим между воркерами, если не задано явно
+            EXTRACT_WORKERS=os.getenv("EXTRACT_WORKERS", str(max(1, (os.cpu_count() or 1) // shards))),
+        )
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "bot.bot", env=self.env,
+            start_new_session=True,  # Ctrl+C в терминале получает только фронт, воркеров он гасит сам
+        )
+        log.info("worker %d started, pid %d, port %d", self.index, self.proc.pid, self.port)
+
+    async def supervise(self, stopping: asyncio.Event):
+        while True:
+            code = await self.proc.wait()
+            if stopping.is_set():
+                return
+            log.error("worker %d exited with %s, restarting", self.index, code)
+            self.restarts += 1
+            await asyncio.sleep(1)
+            await self.start()
+
+    async def ready(self, session: aiohttp.ClientSession, stopping: asyncio.Event, timeout: float = 60):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not stopping.is_set():
+            try:
+                async with session.get(f"http://127.0.0.1:{self.port}/healthz") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if loop.time() > deadline:
+                raise RuntimeError(f"worker {self.index} did not start in {timeout:.0f}s")
+            await asyncio.sleep(0.2)
+
+    async def deliver(self, session: aiohttp.ClientSession, body: bytes) -> bool:
+        """
+        Отдаёт апдейт воркеру, повторяя при отказе. False — так и не принял, выброшен.
+        """
+        headers = {SECRET_HEADER: self.secret, "Content-Type": "application/json"}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.retry_timeout
+        failed = 0
+        while True:
+            try:
+                async with session.post(self.url, data=body, headers=headers) as r:
+                    if r.status == 200:
+                        return True
+                    failed += 1
+                    log.warning("worker %d answered %d (%d/%d)", self.index, r.status, failed, self.max_retries)
+            except asyncio.TimeoutError:
+                # ClientTimeout сессии — не ClientError; воркер завис на приёме, считаем как отказ
+                failed += 1
+                log.warning("worker %d timed out (%d/%d)", self.index, failed, self.max_retries)
+            except aiohttp.ClientError as e:
+                log.warning("worker %d unreachable: %s", self.index, e)
+            if failed >= self.max_retries or loop.time() > deadline:
+                return False
+            # воркер перезапускается — держим порядок и повторяем тот же апдейт
+            await asyncio.sleep(0.5)
+
+    async def forward(self, session: aiohttp.ClientSession):
+        while True:
+            body = await self.queue.get()
+            try:
+                if await self.deliver(session, body):
+                    self.forwarded += 1
+                else:
+                    self.dropped += 1
+                    log.error("worker %d did not accept update, dropped: %s", self.index, body[:200])
+            except Exception:
+                # неожиданная ошибка не должна останавливать пересылку всему шарду
+                self.dropped += 1
+                log.exception("worker %d forwarding failed, dropped: %s", self.index, body[:200])
+            finally:
+                self.queue.task_done()
+
+    async def stop(self, timeout: float):
+        if self.proc is None or self.proc.returncode is not None:
+            return
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("worker %d did not stop in %.0fs, killing", self.index, timeout)
+            self.proc.kill()
+            await self.proc.wait()
+
+
+class ShardFront:
+    def __init__(self, shards: int, path: str = "/webhook", secret: str = "", queue_size: int = 1000):
+        self.ring = HashRing(shards)
+        self.path = path
+        self.secret = secret
+        inner = secrets.token_urlsafe(32)  # между фронтом и воркерами свой секрет
+        self.workers = [Worker(i, shards, inner, queue_size) for i in range(shards)]
+        self.rejected = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401, text="Unauthorized")
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400, text="Bad JSON")
+        worker = self.workers[self.ring.shard(update_user(update))]
+        try:
+            worker.queue.put_nowait(body)
+        except asyncio.QueueFull:
+            # не 200 — Telegram повторит доставку позже
+            self.rejected += 1
+            return web.Response(status=503, text="Busy")
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "ok": all(w.proc and w.proc.returncode is None and not (w.forwarder and w.forwarder.done())
+                      for w in self.workers),
+            "workers": [{"queued": w.queue.qsize(), "forwarded": w.forwarded, "dropped": w.dropped,
+                         "restarts": w.restarts, "forwarding": bool(w.forwarder and not w.forwarder.done())}
+                        for w in self.workers],
+            "rejected": self.rejected,
+        })
+
+    async def serve(self, host: str, port: int, url: str = "", stop_timeout: float = 120):
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        tasks = []
+        runner = web.AppRunner(self._app())
+        try:
+            for w in self.workers:
+                await w.start()
+            tasks += [asyncio.create_task(w.supervise(stopping)) for w in self.workers]
+            await asyncio.gather(*(w.ready(session, stopping) for w in self.workers))
+            if stopping.is_set():
+                return
+            for w in self.workers:
+                w.forwarder = asyncio.create_task(w.forward(session))
+                tasks.append(w.forwarder)
+
+            await runner.setup()
+            await web.TCPSite(runner, host, port).start()
+            log.info("front listening on %s:%d%s, %d workers", host, port, self.path, len(self.workers))
+            if url:
+                await self._set_webhook(session, url)
+            await stopping.wait()
+        finally:
+            stopping.set()
+            log.info("front stopping")
+            await runner.cleanup()
+            # досылаем принятое, потом воркеры сами дорабатывают свои очереди
+            try:
+                await asyncio.wait_for(asyncio.gather(*(w.queue.join() for w in self.workers)), stop_timeout)
+            except asyncio.TimeoutError:
+                log.warning("front stopped with %d undelivered updates", sum(w.queue.qsize() for w in self.workers))
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*(w.stop(stop_timeout) for w in self.workers))
+            await session.close()
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get("/healthz", self.health)
+        return app
+
+    async def _set_webhook(self, session: aiohttp.ClientSession, url: str):
+        # фронту не нужен весь aiogram — один вызов Bot API напрямую
+        data = {"url": url}
+        if self.secret:
+            data["secret_token"] = self.secret
+        async with session.post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook", data=data) as r:
+            res = await r.json()
+        if not res.get("ok"):
+            raise RuntimeError(f"setWebhook failed: {res}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    front = ShardFront(SHARD_WORKERS, WEBHOOK_PATH, WEBHOOK_SECRET, SHARD_QUEUE)
+    asyncio.run(front.serve(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_URL, SHARD_STOP_TIMEOUT))
@@ -0,0 +1,311 @@
+# Хранилище: одно долгоживущее соединение SQLite (WAL) и выделенный поток под запросы,
+# чтобы работа с БД не блокировала event loop.
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+# Миграции схемы: номер версии хранится в PRAGMA user_version, при старте применяются
+# все недостающие по порядку. Первая совпадает со старым db() и на существующей базе
+# ничего не ломает; новые изменения — только новыми элементами в конце списка.
+MIGRATIONS = (
+    (
+        """CREATE TABLE IF NOT EXISTS sessions(
+            user_id INTEGER, chat_id INTEGER, updated_at INTEGER,
+            PRIMARY KEY(user_id, chat_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS messages(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER, chat_id INTEGER, role TEXT, content TEXT, created_at INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS active_chat(
+            user_id INTEGER PRIMARY KEY, chat_id INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS quotas(
+            user_id INTEGER, yyyymmdd TEXT, used_tokens INTEGER DEFAULT 0,
+            PRIMARY KEY(user_id, yyyymmdd)
+        )""",
+        # сжатое содержание старой части диалога: всё до upto_id включительно
+        """CREATE TABLE IF NOT EXISTS summaries(
+            user_id INTEGER, chat_id INTEGER, upto_id INTEGER, content TEXT, updated_at INTEGER,
+            PRIMARY KEY(user_id, chat_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(user_id, chat_id, id)",
+    ),
+    (
+        # превью последнего сообщения и счётчик прямо в sessions — список диалогов одним запросом
+        "ALTER TABLE sessions ADD COLUMN last_preview TEXT",
+        "ALTER TABLE sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0",
+        """UPDATE sessions SET
+            message_count=(SELECT COUNT(*) FROM messages m
+                WHERE m.user_id=sessions.user_id AND m.chat_id=sessions.chat_id),
+            last_preview=(SELECT replace(substr(content, 1, 100), char(10), ' ') FROM messages m
+                WHERE m.user_id=sessions.user_id AND m.chat_id=sessions.chat_id ORDER BY id DESC LIMIT 1)""",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(user_id, updated_at DESC)",
+    ),
+    (
+        # кэш извлечения текста по хэшу файла, см. cache.py
+        """CREATE TABLE IF NOT EXISTS extract_cache(
+            sha256 TEXT, engine TEXT, variant TEXT, text TEXT, tokens INTEGER, size INTEGER,
+            created_at INTEGER, last_hit INTEGER, hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(sha256, engine, variant)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_extract_cache_hit ON extract_cache(last_hit)",
+    ),
+    (
+        # база знаний, см. kb.py: в kb_fts лежат основы слов фрагмента, rowid = kb_passages.id
+        """CREATE TABLE IF NOT EXISTS kb_docs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT, sha256 TEXT UNIQUE, added_by INTEGER, passages INTEGER, created_at INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS kb_passages(
+            id INTEGER PRIMARY KEY AUTOINCREMENT, doc_id INTEGER, ord INTEGER, text TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_kb_passages_doc ON kb_passages(doc_id)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS kb_fts USING fts5(stems, tokenize='unicode61 remove_diacritics 0')",
+        # частоты термов по фрагментам — чтобы выкидывать из запроса слова, которые есть почти везде
+        "CREATE VIRTUAL TABLE IF NOT EXISTS kb_vocab USING fts5vocab(kb_fts, 'row')",
+    ),
+    (
+        # диалог выгружен в архив пользователя (retention.py): строка в sessions остаётся
+        # для списка диалогов, сообщения и конспект — в файле до /use
+        "ALTER TABLE sessions ADD COLUMN archived INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_idle ON sessions(updated_at) WHERE archived=0",
+        "CREATE INDEX IF NOT EXISTS idx_quotas_day ON quotas(yyyymmdd)",
+    ),
+    (
+        # хранилище вложений по хэшу, см. filestore.py; refs — сколько диалогов ссылается на файл
+        """CREATE TABLE IF NOT EXISTS files(
+            sha256 TEXT PRIMARY KEY, ext TEXT, size INTEGER, refs INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER, last_used INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_files_used ON files(last_used)",
+        """CREATE TABLE IF NOT EXISTS file_refs(
+            sha256 TEXT, user_id INTEGER, chat_id INTEGER, name TEXT, created_at INTEGER,
+            PRIMARY KEY(sha256, user_id, chat_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_file_refs_chat ON file_refs(user_id, chat_id)",
+        "CREATE TABLE IF NOT EXISTS file_ids(file_unique_id TEXT PRIMARY KEY, sha256 TEXT)",
+        "CREATE INDEX IF NOT EXISTS idx_file_ids_sha ON file_ids(sha256)",
+    ),
+)
+
+# таблицы с данными пользователя (колонка user_id) — переезжают между шардами целиком,
+# см. tools/rebalance_shards.py; новые такие таблицы нужно дописывать сюда.
+# file_refs сюда не входит: она в общей базе вместе с files, как и сами файлы
+USER_TABLES = ("sessions", "messages", "active_chat", "quotas", "summaries")
+
+PREVIEW_LEN = 100
+
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",  # действует только на новой базе, см. retention.py
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",    # в WAL fsync только на чекпоинтах
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",     # ~20 МБ страничного кэша
+)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    # соединение живёт в одном потоке-исполнителе, но создаётся из другого
+    c = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    for p in PRAGMAS:
+        c.execute(p)
+    migrate(c)
+    return c
+
+
+def migrate(c: sqlite3.Connection):
+    # версию читаем под BEGIN IMMEDIATE: общую базу (KB_DB_PATH) одновременно
+    # открывают несколько процессов-шардов, и миграцию должен применить один
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                c.execute("COMMIT")
+                return
+            for sql in MIGRATIONS[version]:
+                c.execute(sql)
+            c.execute(f"PRAGMA user_version={version + 1}")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+
+
+# Синхронные операции. Выполняются только в потоке хранилища, внутри транзакции из Storage.run.
+
+def set_active(c, uid, chat_id):
+    c.execute("INSERT OR REPLACE INTO active_chat(user_id, chat_id) VALUES(?,?)", (uid, chat_id))
+
+def new_chat(c, uid) -> int:
+    new_id = c.execute("SELECT COALESCE(MAX(chat_id),0)+1 FROM sessions WHERE user_id=?", (uid,)).fetchone()[0]
+    now = int(time.time())
+    c.execute("INSERT OR REPLACE INTO sessions(user_id, chat_id, updated_at) VALUES(?,?,?)", (uid, new_id, now))
+    set_active(c, uid, new_id)
+    return new_id
+
+def ensure_active_chat(c, uid) -> int:
+    row = c.execute("SELECT chat_id FROM active_chat WHERE user_id=?", (uid,)).fetchone()
+    if row:
+        return row[0]
+    return new_chat(c, uid)
+
+def chat_exists(c, uid, chat_id) -> bool:
+    return c.execute("SELECT 1 FROM sessions WHERE user_id=? AND chat_id=?", (uid, chat_id)).fetchone() is not None
+
+def chats_page(c, uid, offset, limit) -> tuple[list[tuple], int, int]:
+    """
+    Страница списка диалогов: ([(chat_id, updated_at, last_preview, message_count, archived)], всего, активный).
+    Пустая страница за концом списка отдаёт total=0 — вызывающий листает на начало..
+    """
+    rows = c.execute("""SELECT chat_id, updated_at, last_preview, message_count, archived, COUNT(*) OVER (),
+            (SELECT chat_id FROM active_chat WHERE user_id=?)
+        FROM sessions WHERE user_id=? ORDER BY updated_at DESC LIMIT ? OFFSET ?""",
+        (uid, uid, limit, offset)).fetchall()
+    if not rows:
+        return [], 0, None
+    return [r[:5] for r in rows], rows[0][5], rows[0][6]
+
+def history(c, uid, chat_id, limit=None):
+    q = "SELECT role, content FROM messages WHERE user_id=? AND chat_id=? ORDER BY id"
+    args = (uid, chat_id)
+    if limit:
+        q += " LIMIT ?"
+        args += (limit,)
+    rows = c.execute(q, args).fetchall()
+    return [{"role": r, "content": t} for r, t in rows]
+
+def recent_messages(c, uid, chat_id, after_id, before_id, limit):
+    """
+    Самые новые сообщения с after_id < id < before_id, от новых к старым.
+    """
+    return c.execute("""SELECT id, role, content FROM messages
+        WHERE user_id=? AND chat_id=? AND id>? AND id<? ORDER BY id DESC LIMIT ?""",
+        (uid, chat_id, after_id, before_id, limit)).fetchall()
+
+def messages_range(c, uid, chat_id, after_id, before_id, limit):
+    """
+    Сообщения с after_id < id < before_id в хронологическом порядке.
+    """
+    return c.execute("""SELECT id, role, content FROM messages
+        WHERE user_id=? AND chat_id=? AND id>? AND id<? ORDER BY id LIMIT ?""",
+        (uid, chat_id, after_id, before_id, limit)).fetchall()
+
+def get_summary(c, uid, chat_id) -> tuple[int, str]:
+    row = c.execute("SELECT upto_id, content FROM summaries WHERE user_id=? AND chat_id=?", (uid, chat_id)).fetchone()
+    return (row[0], row[1]) if row else (0, "")
+
+def set_summary(c, uid, chat_id, upto_id, content):
+    c.execute("INSERT OR REPLACE INTO summaries(user_id, chat_id, upto_id, content, updated_at) VALUES(?,?,?,?,?)",
+              (uid, chat_id, upto_id, content, int(time.time())))
+
+def add_msg(c, uid, chat_id, role, content):
+    now = int(time.time())
+    c.execute("INSERT INTO messages(user_id, chat_id, role, content, created_at) VALUES(?,?,?,?,?)",
+              (uid, chat_id, role, content, now))
+    preview = " ".join(content[:PREVIEW_LEN * 2].split())[:PREVIEW_LEN]
+    c.execute("""UPDATE sessions SET updated_at=?, last_preview=?, message_count=message_count+1
+        WHERE user_id=? AND chat_id=?""", (now, preview, uid, chat_id))
+
+def used_tokens(c, uid, day) -> int:
+    row = c.execute("SELECT used_tokens FROM quotas WHERE user_id=? AND yyyymmdd=?", (uid, day)).fetchone()
+    return row[0] if row else 0
+
+def add_tokens_batch(c, items):
+    """
+    items: [(user_id, yyyymmdd, tokens)] — приращения, накопленные QuotaLedger.
+    """
+    c.executemany("""INSERT INTO quotas(user_id, yyyymmdd, used_tokens) VALUES(?,?,?)
+        ON CONFLICT(user_id, yyyymmdd) DO UPDATE SET used_tokens=used_tokens+excluded.used_tokens""", items)
+
+
+class Storage:
+    """
+    Асинхронный доступ к БД. Схема создаётся один раз в open(), дальше все запросы
+    идут через одно соединение в выделенном потоке; каждая операция — одна транзакция.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: sqlite3.Connection | None = None
+        # сколько транзакций выполнено и сколько секунд поток БД был ими занят
+        self.calls = 0
+        self.busy = 0.0
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self._conn = await loop.run_in_executor(self._executor, connect, self.path)
+
+    async def close(self):
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    def _tx(self, fn, *args):
+        c = self._conn
+        t0 = time.perf_counter()
+        try:
+            c.execute("BEGIN")
+            try:
+                res = fn(c, *args)
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+            return res
+        finally:
+            self.calls += 1
+            self.busy += time.perf_counter() - t0
+
+    async def run(self, fn, *args):
+        """
+        Выполняет fn(conn, *args) в потоке хранилища внутри транзакции.
+        """
+        with metrics.span("db." + fn.__name__):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._tx, fn, *args)
+
+    async def set_active(self, uid, chat_id):
+        await self.run(set_active, uid, chat_id)
+
+    async def new_chat(self, uid) -> int:
+        return await self.run(new_chat, uid)
+
+    async def ensure_active_chat(self, uid) -> int:
+        return await self.run(ensure_active_chat, uid)
+
+    async def chat_exists(self, uid, chat_id) -> bool:
+        return await self.run(chat_exists, uid, chat_id)
+
+    async def chats_page(self, uid, page: int, per_page: int):
+        return await self.run(chats_page, uid, page * per_page, per_page)
+
+    async def history(self, uid, chat_id, limit=None):
+        return await self.run(history, uid, chat_id, limit)
+
+    async def recent_messages(self, uid, chat_id, after_id=0, before_id=2**63 - 1, limit=50):
+        return await self.run(recent_messages, uid, chat_id, after_id, before_id, limit)
+
+    async def messages_range(self, uid, chat_id, after_id, before_id, limit):
+        return await self.run(messages_range, uid, chat_id, after_id, before_id, limit)
+
+    async def get_summary(self, uid, chat_id) -> tuple[int, str]:
+        return await self.run(get_summary, uid, chat_id)
+
+    async def set_summary(self, uid, chat_id, upto_id, content):
+        await self.run(set_summary, uid, chat_id, upto_id, content)
+
+    async def add_msg(self, uid, chat_id, role, content):
+        await self.run(add_msg, uid, chat_id, role, content)
+
+    async def used_tokens(self, uid, day) -> int:
+        return await self.run(used_tokens, uid, day)
+
+    async def add_tokens_batch(self, items):
+        await self.run(add_tokens_batch, items)
@@ -0,0 +1,166 @@
+# Потоковая выдача ответа: плейсхолдер + редактирование сообщения по мере генерации.
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+TG_TEXT_LIMIT = 4000  # у Telegram 4096, оставляем запас под разметку
+
+
+def _split_point(text: str, limit: int) -> int:
+    """
+    Где резать слишком длинный текст: по последнему переводу строки до лимита.
+    """
+    cut = text.rfind("\n", 0, limit)
+    return cut if cut > limit // 2 else limit
+
+
+class StreamingReply:
+    """
+    Отправляет плейсхолдер и редактирует его по мере поступления текста.
+    Правки схлопываются: не чаще одной в interval секунд, промежуточные
+    состояния просто перезаписываются. Пока ответ не дописан, шлём без
+    разметки (незакрытые ** и ``` ломают Markdown), финальная правка — в Markdown.
+    """
+
+    def __init__(self, m: Message, interval: float = 1.0, placeholder: str = "⏳ …"):
+        self.m = m
+        self.interval = interval
+        self.placeholder = placeholder
+        self.msg: Message | None = None
+        self._offset = 0          # с какого символа полного текста начинается текущее сообщение
+        self._text = ""
+        self._shown = ""
+        self._dirty = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.first_edit_at: float | None = None
+
+    async def start(self):
+        self.msg = await self.m.reply(self.placeholder, parse_mode=None)
+        self._task = asyncio.create_task(self._loop())
+
+    def update(self, text: str):
+        self._text = text
+        self._dirty.set()
+
+    async def _edit(self, text: str, parse_mode: str | None = None, reply_markup=None) -> bool:
+        try:
+            await self.msg.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+            return True
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            return False
+        except TelegramBadRequest as e:
+            # "message is not modified" — не ошибка; плохую разметку решает вызывающий
+            return "not modified" in str(e)
+
+    async def _rollover(self, full: str) -> str:
+        """
+        Если текущее сообщение переполнено — закрываем его и начинаем новое.
+        Возвращает кусок текста, который должен быть в текущем сообщении.
+        """
+        part = full[self._offset:]
+        while len(part) > TG_TEXT_LIMIT:
+            cut = _split_point(part, TG_TEXT_LIMIT)
+            head = part[:cut]
+            if not await self._edit(head, parse_mode="Markdown"):
+                await self._edit(head)
+            self._offset += cut
+            part = full[self._offset:].lstrip("\n")
+            self._offset = len(full) - len(part)
+            self.msg = await self.m.answer(part[:TG_TEXT_LIMIT] or self.placeholder, parse_mode=None)
+            self._shown = part[:TG_TEXT_LIMIT]
+        return part
+
+    async def _loop(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            try:
+                part = await self._rollover(self._text)
+                if part and part != self._shown:
+                    await self._edit(part)
+                    self._shown = part
+                    if self.first_edit_at is None:
+                        self.first_edit_at = time.monotonic()
+            except TelegramAPIError as e:
+                # промежуточные правки — по возможности: сеть моргнула — догоним следующей
+                metrics.error("stream.edit", e)
+                log.warning("intermediate edit failed: %r", e)
+            await asyncio.sleep(self.interval)
+
+    async def _stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                # что бы ни уронило цикл правок, финальная правка должна состояться
+                metrics.error("stream.edit", e)
+                log.warning("edit loop failed: %r", e)
+            self._task = None
+
+    async def close(self):
+        """
+        Останавливает правки, если они ещё идут (отмена, ошибка после стрима). Повторный вызов безвреден.
+        """
+        await self._stop()
+
+    async def finish(self, text: str, reply_markup=None):
+        """
+        Финальная правка: полный текст в Markdown (или без разметки, если не парсится).
+        """
+        await self._stop()
+        part = await self._rollover(text) or "…"
+        if not await self._edit(part, parse_mode="Markdown", reply_markup=reply_markup):
+            await self._edit(part, reply_markup=reply_markup)
+
+    async def fail(self, text: str, reply_markup=None):
+        await self._stop()
+        if self.msg is None:
+            await self.m.reply(text, reply_markup=reply_markup)
+            return
+        if not await self._edit(text, parse_mode="Markdown", reply_markup=reply_markup):
+            await self._edit(text, reply_markup=reply_markup)
+
+
+class ProgressMessage:
+    """
+    Сообщение-индикатор для долгих операций: "⏳ заголовок: 3/12", правки не чаще interval.
+    """
+
+    def __init__(self, m: Message, title: str, interval: float = 2.0):
+        self.m = m
+        self.title = title
+        self.interval = interval
+        self.msg: Message | None = None
+        self._last = 0.0
+
+    async def start(self):
+        self.msg = await self.m.reply(f"⏳ {self.title}…", parse_mode=None)
+
+    async def update(self, done: int, total: int):
+        now = time.monotonic()
+        if self.msg is None or (done < total and now - self._last < self.interval):
+            return
+        self._last = now
+        try:
+            await self.msg.edit_text(f"⏳ {self.title}: {done}/{total}", parse_mode=None)
+        except (TelegramBadRequest, TelegramRetryAfter):
+            pass
+
+    async def delete(self):
+        if self.msg is not None:
+            try:
+                await self.msg.delete()
+            except TelegramBadRequest:
+                pass
+            self.msg = None
@@ -0,0 +1,147 @@
+# Map-reduce для длинных документов: текст режется по страницам/абзацам в пределах
+# бюджета токенов, части конспектируются параллельно, конспекты сводятся в ответ.
+import asyncio
+import hashlib
+
+from .cache import ExtractionCache
+from .context import Tokenizer
+from .formatting import format_answer
+from .llm import LLM
+
+MAP_PROMPT = (
+    "Ты ассистент MOS-GSM. Перед тобой часть документа. Выпиши сжато всё существенное: "
+    "факты, числа, даты, имена, требования, пункты и разделы. Без вступлений и выводов. "
+    "Markdown, без #-заголовков."
+)
+
+REDUCE_PROMPT = (
+    "Ты ассистент MOS-GSM. Ниже конспекты нескольких последовательных частей документа. "
+    "Объедини их в один конспект, сохранив порядок и всё существенное. Без вступлений. "
+    "Markdown, без #-заголовков."
+)
+
+SEPARATORS = ("\f", "\n\n", "\n")  # страница, абзац, строка
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(p.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class DocumentSummarizer:
+    """
+    Конспекты частей кэшируются по хэшу текста части, модели и промпта, поэтому
+    повторный вопрос по тому же документу (с другой подписью-заданием)
+    переделывает только финальную свёртку.
+    """
+
+    def __init__(self, llm: LLM, tokenizer: Tokenizer, cache: ExtractionCache,
+                 chunk_tokens: int = 6000, parallel: int = 4, map_tokens: int = 700):
+        self.llm = llm
+        self.tok = tokenizer
+        self.cache = cache
+        self.chunk_tokens = chunk_tokens
+        self.parallel = parallel
+        self.map_tokens = map_tokens
+
+    # ===== разбиение =====
+
+    def _units(self, text: str, seps: tuple[str, ...], out: list[tuple[str, int]]):
+        n = self.tok.count(text)
+        if n <= self.chunk_tokens:
+            if text.strip():
+                out.append((text.strip(), n))
+            return
+        if not seps:
+            out.extend((p, self.tok.count(p)) for p in self.tok.split(text, self.chunk_tokens))
+            return
+        for part in text.split(seps[0]):
+            self._units(part, seps[1:], out)
+
+    def split(self, text: str) -> list[str]:
+        """
+        Куски не длиннее chunk_tokens: режем по самой крупной границе, что помогает
+        уложиться (страница → абзац → строка → токены), и жадно склеиваем соседние.
+        """
+        units: list[tuple[str, int]] = []
+        self._units(text, SEPARATORS, units)
+        chunks, cur, cur_n = [], [], 0
+        for part, n in units:
+            if cur and cur_n + n > self.chunk_tokens:
+                chunks.append("\n\n".join(cur))
+                cur, cur_n = [], 0
+            cur.append(part)
+            cur_n += n
+        if cur:
+            chunks.append("\n\n".join(cur))
+        return chunks
+
+    def estimate(self, n_in: int) -> tuple[int, int]:
+        """
+        (число частей, оценка токенов на всё) по уже посчитанным токенам документа —
+        для резерва квоты до запуска.
+        """
+        parts = max(1, -(-n_in // self.chunk_tokens))
+        return parts, n_in + parts * self.map_tokens * 2
+
+    # ===== map / reduce =====
+
+    async def _map_one(self, chunk: str, prompt: str) -> tuple[str, int]:
+        sha = _digest(chunk)
+        variant = self.llm.model + ":" + _digest(prompt)[:16]
+        hit = await self.cache.get(sha, "map", variant)
+        if hit:
+            return hit[0], 0
+        resp = await self.llm.complete([
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": chunk},
+        ], max_tokens=self.map_tokens)
+        text = (resp.choices[0].message.content or "").strip()
+        used = resp.usage.total_tokens if resp.usage else self.tok.count(chunk) + self.map_tokens
+        await self.cache.put(sha, "map", variant, text, used)
+        return text, used
+
+    async def _map(self, chunks: list[str], prompt: str, progress=None) -> tuple[list[str], int]:
+        sem = asyncio.Semaphore(self.parallel)
+        done = 0
+
+        async def one(chunk: str):
+            nonlocal done
+            async with sem:
+                res = await self._map_one(chunk, prompt)
+            done += 1
+            if progress:
+                await progress(done, len(chunks))
+            return res
+
+        results = await asyncio.gather(*(one(c) for c in chunks))
+        return [t for t, _ in results], sum(u for _, u in results)
+
+    async def run(self, text: str, system_prompt: dict, task: str, progress=None) -> tuple[str, list[str], int]:
+        """
+        Возвращает (ответ, конспекты частей, потрачено токенов).
+        progress(done, total) вызывается по мере готовности частей.
+        """
+        chunks = await asyncio.to_thread(self.split, text)
+        partials, used = await self._map(chunks, MAP_PROMPT, progress)
+
+        # конспекты не влезают в один запрос — сворачиваем их тем же map, пока не влезут
+        notes = partials
+        while len(notes) > 1 and self.tok.count("\n\n".join(notes)) > self.chunk_tokens:
+            groups = self.split("\f".join(notes))
+            if len(groups) >= len(notes):
+                break
+            notes, u = await self._map(groups, REDUCE_PROMPT)
+            used += u
+
+        body = "\n\n".join(f"Часть {i}/{len(notes)}:\n{n}" for i, n in enumerate(notes, 1))
+        resp = await self.llm.complete([
+            system_prompt,
+            {"role": "user", "content": f"{task}\n\nКонспект документа по частям:\n\n{body}"},
+        ])
+        answer = format_answer(resp.choices[0].message.content or "")
+        used += resp.usage.total_tokens if resp.usage else self.tok.count(body)
+        return answer, partials, used
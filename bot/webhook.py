@@ -0,0 +1,113 @@
+# Режим вебхука: Telegram сам присылает апдейты POST-ом на aiohttp-сервер.
+# Отвечаем 200 сразу, апдейт обрабатывается фоновой задачей; при остановке
+# новые запросы не принимаются, а начатые задачи дорабатывают до таймаута.
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    path — куда Telegram шлёт апдейты, secret — токен из setWebhook(secret_token=...),
+    record — файл JSONL, куда дописываются сырые апдейты (для повторной отправки
+    через tools/replay_updates.py).
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str = "/webhook",
+                 secret: str = "", record: str = ""):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.record = record
+        self._tasks: set[asyncio.Task] = set()
+        self.received = 0
+        self.rejected = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=401, text="Unauthorized")
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="Bad JSON")
+        self.received += 1
+        if self.record:
+            with open(self.record, "a", encoding="utf-8") as f:
+                f.write(json.dumps(update, ensure_ascii=False) + "\n")
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"ok": True, "in_flight": len(self._tasks), "received": self.received})
+
+    async def _feed(self, update: dict):
+        try:
+            result = await self.dp.feed_raw_update(self.bot, update)
+            # хендлер может вернуть метод API вместо вызова — в фоне его надо выполнить самим
+            if isinstance(result, TelegramMethod):
+                await self.dp.silent_call_request(self.bot, result)
+        except Exception as e:
+            metrics.error("webhook", e)
+            log.exception("update %s failed", update.get("update_id"))
+
+    async def drain(self, timeout: float):
+        if not self._tasks:
+            return
+        log.info("draining %d in-flight updates", len(self._tasks))
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            log.warning("%d updates still running after %.0fs, cancelling", len(pending), timeout)
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get("/healthz", self.health)
+        return app
+
+    async def serve(self, host: str, port: int, url: str = "", drain_timeout: float = 60):
+        """
+        Работает до SIGINT/SIGTERM. Если задан url — регистрирует вебхук в Telegram.
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        log.info("webhook listening on %s:%d%s", host, port, self.path)
+
+        await self.dp.emit_startup(bot=self.bot)
+        if url:
+            await self.bot.set_webhook(url, secret_token=self.secret or None,
+                                       allowed_updates=self.dp.resolve_used_update_types())
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        try:
+            await stop.wait()
+        finally:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            log.info("webhook stopping")
+            # сначала перестаём принимать, потом ждём начатое
+            await runner.cleanup()
+            await self.drain(drain_timeout)
+            await self.dp.emit_shutdown(bot=self.bot)
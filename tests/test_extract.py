@@ -0,0 +1,27 @@
+import os
+
+import PyPDF2
+from PIL import Image
+
+from bot.extract import pdf_page_images
+
+
+def test_page_images_parse_pdf_once(tmp_path, monkeypatch):
+    pages = [Image.new("RGB", (64, 48), (i * 40, 0, 0)) for i in range(5)]
+    pdf = str(tmp_path / "scan.pdf")
+    pages[0].save(pdf, save_all=True, append_images=pages[1:])
+
+    opened = []
+    real = PyPDF2.PdfReader
+
+    def counting(*args, **kwargs):
+        opened.append(args)
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(PyPDF2, "PdfReader", counting)
+    images = pdf_page_images(pdf, [0, 2, 4], str(tmp_path / "page"))
+
+    assert len(opened) == 1
+    assert [os.path.basename(p).split(".")[0] for p in images] == ["page_p1", "page_p3", "page_p5"]
+    with Image.open(images[1]) as im:
+        assert im.size == (64, 48)
@@ -0,0 +1,47 @@
+from bot.filestore import chat_files, file_add, file_evict, file_stats, relink_chat, unlink_chat
+from bot.storage import connect, migrate
+
+
+def db(tmp_path):
+    c = connect(str(tmp_path / "kb.sqlite"))
+    migrate(c)
+    return c
+
+
+def refs(c, sha):
+    return c.execute("SELECT refs FROM files WHERE sha256=?", (sha,)).fetchone()[0]
+
+
+def test_refs_follow_archive_and_restore(tmp_path):
+    c = db(tmp_path)
+    file_add(c, "a" * 64, ".pdf", 100, "u1", 1, 1, "a.pdf", 10)
+    file_add(c, "a" * 64, ".pdf", 100, "u1", 1, 2, "a.pdf", 11)
+    file_add(c, "a" * 64, ".pdf", 100, "u1", 1, 2, "a.pdf", 12)  # повтор в том же диалоге — одна ссылка
+    assert refs(c, "a" * 64) == 2
+
+    saved = chat_files(c, 1, 2)
+    assert unlink_chat(c, 1, 2) == 1
+    assert refs(c, "a" * 64) == 1
+    assert relink_chat(c, 1, 2, saved) == 1
+    assert refs(c, "a" * 64) == 2
+    assert file_stats(c)[2] == 2
+
+
+def test_evict_keeps_referenced_files(tmp_path):
+    c = db(tmp_path)
+    file_add(c, "a" * 64, ".pdf", 100, None, 1, 1, "old-but-used.pdf", 1)
+    file_add(c, "b" * 64, ".pdf", 100, None, 1, 2, "unused.pdf", 2)
+    file_add(c, "c" * 64, ".pdf", 100, None, 1, 3, "newest.pdf", 3)
+    unlink_chat(c, 1, 2)
+    unlink_chat(c, 1, 3)
+
+    # в 150 байт влезает только файл с живой ссылкой, хоть он и самый старый
+    evicted = file_evict(c, 150, 100)
+    assert sorted(sha for sha, _ in evicted) == ["b" * 64, "c" * 64]
+    assert [r[0] for r in c.execute("SELECT sha256 FROM files")] == ["a" * 64]
+
+    # ссылку сняли — теперь и его можно вытеснить
+    unlink_chat(c, 1, 1)
+    assert file_evict(c, 0, 100) == [("a" * 64, ".pdf")]
+    # отдавший ссылку диалог при восстановлении на вытесненный файл не ссылается
+    assert relink_chat(c, 1, 1, [["a" * 64, "old-but-used.pdf", 1]]) == 0
@@ -0,0 +1,32 @@
+import asyncio
+
+from bot.scheduler import Scheduler
+
+
+def test_global_cap_rejection_keeps_running_turn_intact():
+    async def run():
+        done = []
+        release = asyncio.Event()
+
+        async def handler(key, items):
+            if key[0] == 1 and not done:
+                await release.wait()
+            done.append((key, items))
+
+        sched = Scheduler(handler, concurrency=1, window=0.01, max_pending=5, max_total=1)
+        sched.start()
+        assert sched.submit((1, 1), "a")
+        await asyncio.sleep(0.05)           # ход пользователя 1 идёт, его очередь пуста
+        assert sched.submit((2, 1), "b")    # занимает единственное место в общей очереди
+        assert not sched.submit((1, 1), "c")  # отказ по max_total, пока ход 1 выполняется
+        release.set()
+        await asyncio.sleep(0.1)
+
+        # воркер жив: ход 1 завершился, пользователь 2 обслужен, 1 снова принимается
+        assert [k for k, _ in done] == [(1, 1), (2, 1)]
+        assert sched.submit((1, 1), "d")
+        await sched.stop(timeout=1)
+        assert [k for k, _ in done] == [(1, 1), (2, 1), (1, 1)]
+        assert sched.queued == 0 and sched.rejected == 1
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from bot.shard import Worker
+
+
+async def deliver_to(statuses: list[int], max_retries: int,
+                     delay: float = 0, timeout: float = 30) -> tuple[bool, int]:
+    """
+    Воркер-заглушка отвечает по очереди кодами из statuses (дальше — последним),
+    каждый раз выждав delay секунд.
+    """
+    calls = 0
+
+    async def handle(request: web.Request) -> web.Response:
+        nonlocal calls
+        status = statuses[min(calls, len(statuses) - 1)]
+        calls += 1
+        await asyncio.sleep(delay)
+        return web.Response(status=status)
+
+    app = web.Application()
+    app.router.add_post("/webhook", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    w = Worker(0, 1, "s", 10)
+    w.url = f"http://127.0.0.1:{port}/webhook"
+    w.max_retries = max_retries
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            ok = await w.deliver(session, b'{"update_id": 1}')
+    finally:
+        await runner.cleanup()
+    return ok, calls
+
+
+def test_deliver_retries_until_accepted():
+    assert asyncio.run(deliver_to([500, 500, 200], max_retries=5)) == (True, 3)
+
+
+def test_deliver_gives_up_after_max_retries():
+    assert asyncio.run(deliver_to([400], max_retries=3)) == (False, 3)
+
+
+def test_deliver_counts_timeouts_as_failed_attempts():
+    # ClientTimeout даёт asyncio.TimeoutError, а не ClientError: deliver не должен падать
+    assert asyncio.run(deliver_to([200], max_retries=2, delay=1, timeout=0.1)) == (False, 2)
+
+
+def test_forward_survives_hung_worker():
+    async def run():
+        w = Worker(0, 1, "s", 10)
+        w.url = "http://127.0.0.1:1/webhook"
+        outcomes = iter([asyncio.TimeoutError(), RuntimeError("boom"), True])
+
+        async def deliver(session, body):
+            o = next(outcomes)
+            if isinstance(o, Exception):
+                raise o
+            return o
+
+        w.deliver = deliver
+        w.forwarder = asyncio.create_task(w.forward(None))
+        for i in range(3):
+            w.queue.put_nowait(b"{}")
+        await asyncio.wait_for(w.queue.join(), 1)
+        alive = not w.forwarder.done()
+        w.forwarder.cancel()
+        return alive, w.forwarded, w.dropped
+
+    assert asyncio.run(run()) == (True, 1, 2)
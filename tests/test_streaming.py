@@ -0,0 +1,65 @@
+import asyncio
+
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import EditMessageText
+
+from bot.streaming import StreamingReply
+
+
+class FakeMessage:
+    """
+    Сообщение-заглушка: reply() отдаёт себя же, edit_text() пишет правки,
+    первые fail_edits правок падают сетевой ошибкой.
+    """
+
+    def __init__(self, fail_edits: int = 0):
+        self.fail_edits = fail_edits
+        self.edits: list[tuple[str, str | None]] = []
+
+    async def reply(self, text, **kw):
+        return self
+
+    async def answer(self, text, **kw):
+        return self
+
+    async def edit_text(self, text, parse_mode=None, reply_markup=None):
+        if self.fail_edits:
+            self.fail_edits -= 1
+            raise TelegramNetworkError(EditMessageText(text=text), "connection reset")
+        self.edits.append((text, parse_mode))
+
+
+def test_network_error_on_intermediate_edit_keeps_final_edit():
+    async def run():
+        m = FakeMessage(fail_edits=1)
+        reply = StreamingReply(m, interval=0.01)
+        await reply.start()
+        reply.update("начало")
+        await asyncio.sleep(0.05)       # первая правка упала
+        reply.update("начало и продолжение")
+        await asyncio.sleep(0.05)       # цикл жив — следующая прошла
+        await reply.finish("начало и конец")
+        await reply.close()
+        return m.edits
+
+    edits = asyncio.run(run())
+    assert ("начало и продолжение", None) in edits
+    assert edits[-1] == ("начало и конец", "Markdown")
+
+
+def test_final_edit_runs_even_if_edit_loop_died():
+    async def run():
+        m = FakeMessage()
+        reply = StreamingReply(m, interval=0.01)
+        await reply.start()
+
+        async def boom():
+            raise RuntimeError("loop crashed")
+
+        reply._task.cancel()
+        reply._task = asyncio.create_task(boom())
+        await asyncio.sleep(0)
+        await reply.finish("ответ")
+        return m.edits
+
+    assert asyncio.run(run())[-1] == ("ответ", "Markdown")
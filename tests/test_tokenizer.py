@@ -0,0 +1,33 @@
+import sys
+import types
+
+import pytest
+
+from bot.context import Tokenizer
+
+
+@pytest.fixture
+def no_encoding(monkeypatch):
+    def missing(*args):
+        raise OSError("o200k_base.tiktoken: no network")
+
+    monkeypatch.setitem(sys.modules, "tiktoken", types.SimpleNamespace(encoding_for_model=missing, get_encoding=missing))
+
+
+def test_missing_encoding_fails_load(no_encoding):
+    tok = Tokenizer("gpt-4o")
+    with pytest.raises(RuntimeError, match="fetch_tiktoken"):
+        tok.load()
+
+
+def test_fallback_is_explicit(no_encoding):
+    tok = Tokenizer("gpt-4o", fallback=True)
+    tok.load()
+    assert tok.enc is None
+    assert tok.count("x" * 40) == 10
+
+
+def test_count_does_not_load_on_the_caller(monkeypatch):
+    tok = Tokenizer("gpt-4o")
+    monkeypatch.setattr(tok, "load", lambda: pytest.fail("count() must not load the encoding"))
+    assert tok.count("x" * 40) == 10
@@ -0,0 +1,36 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+
+from bot import metrics
+from bot.webhook import WebhookServer
+
+
+def text_update(update_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "Test"}}}
+
+
+def test_feed_counts_and_logs_handler_error(caplog):
+    dp = Dispatcher()
+
+    @dp.message()
+    async def boom(m: Message):
+        raise RuntimeError("handler failed")
+
+    async def run():
+        bot = Bot("1:test")
+        try:
+            await WebhookServer(dp, bot)._feed(text_update(7, "hi"))
+        finally:
+            await bot.session.close()
+
+    before = metrics.ERRORS.values.get(("webhook", "RuntimeError"), 0)
+    with caplog.at_level(logging.ERROR, logger="bot.webhook"):
+        asyncio.run(run())
+    assert metrics.ERRORS.values[("webhook", "RuntimeError")] == before + 1
+    assert any("update 7 failed" in r.getMessage() and r.exc_info for r in caplog.records)
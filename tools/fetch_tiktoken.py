@@ -0,0 +1,28 @@
+# Кладёт словарь tiktoken для модели бота в TIKTOKEN_CACHE_DIR (по умолчанию
+# tiktoken_cache/ в корне репозитория), чтобы бот считал токены без сети.
+# tiktoken сам сверяет sha256 скачанного файла. Запускается при сборке
+# (bin/post_compile) или руками:
+#
+#   python -m tools.fetch_tiktoken [--model gpt-4o]
+import argparse
+import os
+import sys
+
+from bot.context import Tokenizer
+
+
+def main(args):
+    tok = Tokenizer(args.model)
+    tok.load()  # без словаря — RuntimeError с причиной
+    sample = "Проверка словаря: hello, world"
+    print(f"{args.model}: {tok.enc.name} in {os.environ['TIKTOKEN_CACHE_DIR']} "
+          f"({tok.count(sample)} tokens for {len(sample)} chars)")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default=os.getenv("OPENAI_MODEL_CHAT", "gpt-4o"))
+    try:
+        main(ap.parse_args())
+    except RuntimeError as e:
+        sys.exit(str(e))
@@ -0,0 +1,108 @@
+# Перераскладка пользователей по шардам БД при смене SHARD_WORKERS.
+# Запускать при остановленном боте. --from 0 — исходная однопроцессная база
+# (BOT_DB_PATH), из неё же воркеры потом читают общую базу знаний.
+#
+#   python -m tools.rebalance_shards --db /data/bot.sqlite --from 2 --to 3 --dry-run
+#   python -m tools.rebalance_shards --db /data/bot.sqlite --from 2 --to 3
+import argparse
+import os
+import time
+from collections import defaultdict
+
+from bot.shard import HashRing, shard_path
+from bot.storage import USER_TABLES, connect
+
+
+def sources(db: str, n: int) -> list[str]:
+    paths = [db] if n == 0 else [shard_path(db, i) for i in range(n)]
+    return [p for p in paths if os.path.exists(p)]
+
+
+def users(c) -> list[int]:
+    sql = " UNION ".join(f"SELECT user_id FROM {t}" for t in USER_TABLES)
+    return [r[0] for r in c.execute(sql)]
+
+
+def columns(c, schema: str, table: str) -> list[str]:
+    return [r[1] for r in c.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def move(src: str, dst: str, uids: list[int]) -> int:
+    """
+    Переносит строки пользователей uids из src в dst одной транзакцией.
+    id сообщений сдвигаются за максимум в dst с сохранением порядка, upto_id
+    конспектов — на тот же сдвиг. Повторный запуск после сбоя безопасен:
+    перед вставкой строки этих пользователей в dst удаляются.
+    """
+    connect(dst).close()  # создаст файл и применит миграции
+    c = connect(src)
+    try:
+        c.execute("ATTACH DATABASE ? AS dst", (dst,))
+        c.execute("CREATE TEMP TABLE moving(user_id INTEGER PRIMARY KEY)")
+        c.executemany("INSERT INTO moving VALUES(?)", ((u,) for u in uids))
+        c.execute("BEGIN")
+        try:
+            shift = c.execute("""SELECT COALESCE((SELECT MAX(id) FROM dst.messages), 0)
+                - COALESCE((SELECT MIN(id) FROM messages WHERE user_id IN moving), 1) + 1""").fetchone()[0]
+            shift = max(shift, 0)
+            rows = 0
+            for t in USER_TABLES:
+                cols = columns(c, "main", t)
+                expr = {"id": "id + :shift", "upto_id": "CASE WHEN upto_id > 0 THEN upto_id + :shift ELSE 0 END"}
+                select = ", ".join(expr.get(col, col) if t in ("messages", "summaries") else col for col in cols)
+                c.execute(f"DELETE FROM dst.{t} WHERE user_id IN moving")
+                rows += c.execute(f"""INSERT INTO dst.{t}({", ".join(cols)})
+                    SELECT {select} FROM main.{t} WHERE user_id IN moving ORDER BY rowid""",
+                                  {"shift": shift}).rowcount
+                c.execute(f"DELETE FROM main.{t} WHERE user_id IN moving")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+        return rows
+    finally:
+        c.close()
+
+
+def main(args):
+    ring = HashRing(args.to)
+    plan: dict[tuple[str, str], list[int]] = defaultdict(list)
+    total = 0
+    for src in sources(args.db, args.from_):
+        c = connect(src)
+        try:
+            for uid in users(c):
+                total += 1
+                dst = shard_path(args.db, ring.shard(uid))
+                if dst != src:
+                    plan[(src, dst)].append(uid)
+        finally:
+            c.close()
+
+    moving = sum(map(len, plan.values()))
+    print(f"users: {total}, to move: {moving} ({moving / total:.0%})" if total else "no users found")
+    for (src, dst), uids in sorted(plan.items()):
+        print(f"  {os.path.basename(src)} -> {os.path.basename(dst)}: {len(uids)}")
+    if args.dry_run or not plan:
+        return 0
+
+    t0 = time.perf_counter()
+    for (src, dst), uids in sorted(plan.items()):
+        for i in range(0, len(uids), args.batch):
+            move(src, dst, uids[i:i + args.batch])
+    print(f"done in {time.perf_counter() - t0:.1f} s")
+    extra = [p for p in sources(args.db, args.from_) if p not in {shard_path(args.db, i) for i in range(args.to)}]
+    if extra:
+        print("user data moved out of: " + ", ".join(extra) + " (files still hold other tables)")
+    print("run VACUUM on the source shards to reclaim space")
+    return 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", default=os.getenv("BOT_DB_PATH", "/data/bot.sqlite"))
+    ap.add_argument("--from", dest="from_", type=int, required=True, help="старое число шардов, 0 — обычная база")
+    ap.add_argument("--to", type=int, required=True, help="новое число шардов")
+    ap.add_argument("--batch", type=int, default=500, help="пользователей за одну транзакцию")
+    ap.add_argument("--dry-run", action="store_true")
+    raise SystemExit(main(ap.parse_args()))
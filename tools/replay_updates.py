@@ -0,0 +1,66 @@
+# Отправка записанных апдейтов на локальный вебхук — проверка режима BOT_MODE=webhook
+# без Telegram. Апдейты — JSONL (по одному на строку) или JSON-массив; записать
+# настоящие можно, запустив бота с WEBHOOK_RECORD=updates.jsonl.
+#
+#   python tools/replay_updates.py updates.jsonl --url http://127.0.0.1:8080/webhook --secret $WEBHOOK_SECRET
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import aiohttp
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def load(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        data = f.read().strip()
+    if data.startswith("["):
+        return json.loads(data)
+    return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+
+async def main(args):
+    updates = load(args.file)
+    if args.renumber:
+        # Telegram не присылает один update_id дважды — при повторах даём новые
+        base = int(time.time())
+        for i, u in enumerate(updates):
+            u["update_id"] = base + i
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+    sem = asyncio.Semaphore(args.concurrency)
+    statuses, lat = Counter(), []
+
+    async def post(session: aiohttp.ClientSession, update: dict):
+        async with sem:
+            t = time.perf_counter()
+            async with session.post(args.url, json=update, headers=headers) as r:
+                await r.read()
+                statuses[r.status] += 1
+            lat.append((time.perf_counter() - t) * 1000)
+            if args.delay:
+                await asyncio.sleep(args.delay)
+
+    t0 = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, u) for u in updates))
+    elapsed = time.perf_counter() - t0
+
+    lat.sort()
+    print(f"sent {len(updates)} updates in {elapsed:.2f} s, statuses: {dict(statuses)}")
+    if lat:
+        print(f"response time: p50={lat[len(lat) // 2]:.1f} ms  max={lat[-1]:.1f} ms")
+    return 0 if set(statuses) == {200} else 1
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("file")
+    ap.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    ap.add_argument("--secret", default="")
+    ap.add_argument("--concurrency", type=int, default=1, help="одновременных POST-ов")
+    ap.add_argument("--delay", type=float, default=0, help="пауза после каждого POST, сек")
+    ap.add_argument("--renumber", action="store_true", help="проставить новые update_id")
+    raise SystemExit(asyncio.run(main(ap.parse_args())))